@@ -30,6 +30,30 @@ parser.add_argument('--epochs', type=int, default=0,
 parser.add_argument('--patience', type=int, default=2,
                     help='Number of epochs to wait for \
                           before beginning cross-validation')
+parser.add_argument('--early_stop_patience', type=int, default=0,
+                    help='Stop training after this many dev evaluations \
+                          without improvement, 0 disables early stopping')
+parser.add_argument('--early_stop_min_delta', type=float, default=0.,
+                    help='Minimum decrease of the dev metric counted \
+                          as an improvement')
+parser.add_argument('--max_train_time', type=float, default=0.,
+                    help='Wall-clock budget in seconds for training \
+                          one model, 0 for no limit')
+parser.add_argument('--count_eval_interval', type=int, default=1,
+                    help='Evaluate the count model on dev data and \
+                          checkpoint it every count_eval_interval epochs')
+parser.add_argument('--count_epoch_fn', action='store_true', default=False,
+                    help='Compile a whole epoch of count model training \
+                          into one tf.function')
+parser.add_argument('--shuffle_buffer', type=int, default=0,
+                    help='Shuffle buffer of the training datasets, \
+                          0 keeps the examples in order')
+parser.add_argument('--no_dataset_cache', dest='dataset_cache',
+                    action='store_false', default=True,
+                    help='Do not cache the training datasets in memory')
+parser.add_argument('--prefetch_buffer', type=int, default=-1,
+                    help='Prefetch buffer of the training datasets, \
+                          -1 for AUTOTUNE and 0 to disable prefetching')
 
 parser.add_argument('--learning_rate', type=float, default=1e-3, nargs='+',
                    help='Learning rate for the training algorithm')
@@ -49,7 +73,7 @@ parser.add_argument('--seed', type=int,
                     default=42)
 
 # Bin size T_i - T_(i-1) in seconds
-parser.add_argument('--bin_size', type=int, default=0,
+parser.add_argument('--bin_size', type=int, default=0, nargs='+',
                     help='Number of seconds in a bin')
 
 # F(T_(i-1), T_(i-2) ..... , T_(i-r)) -> T(i)
@@ -67,7 +91,7 @@ parser.add_argument('--cnt_net_type', type=str, default='ff',
                     help='Count model network type (ff or rnn)')
 
 # enc_len = 80  # For RMTPP
-parser.add_argument('--enc_len', type=int, default=80,
+parser.add_argument('--enc_len', type=int, default=80, nargs='+',
                     help='Input length for rnn of rmtpp')
 
 # comp_enc_len = 40  # For Compound RMTPP
@@ -105,7 +129,21 @@ parser.add_argument('--generate_plots', action='store_true', default=False,
                     help='Generate dev and test plots, both per epochs \
                           and after training')
 parser.add_argument('--parallel_hparam', action='store_true', default=False,
-                    help='Parallel execution of hyperparameters')
+                    help='Parallel execution of hyperparameters, the grid over \
+                          the values of learning_rate, hidden_layer_size, \
+                          embed_size, enc_len and bin_size')
+parser.add_argument('--hparam_workers', type=int, default=0,
+                    help='Number of hyperparameter configurations run at \
+                          once with --parallel_hparam, 0 for one per CPU')
+parser.add_argument('--data_cache', type=str, default='use',
+                    choices=['use', 'bypass', 'rebuild'],
+                    help='On-disk cache of the processed datasets: use it, \
+                          bypass it, or rebuild it')
+parser.add_argument('--data_cache_dir', type=str, default='data/cache',
+                    help='Directory of the processed datasets cache')
+parser.add_argument('--check_binning', action='store_true', default=False,
+                    help='Check the vectorized create_bin and get_bins against \
+                          their loop versions while processing the data')
 
 # Flags for RMTPP calibration
 parser.add_argument('--calibrate_rmtpp', action='store_true', default=False,
@@ -122,6 +160,28 @@ parser.add_argument('--use_ratio_constraints', action='store_true', default=Fals
                     help='Maintain Ratios of adjacent RMTPP event predictions')
 parser.add_argument('--search', type=int, default=0,
                     help='Search algorithm over counts 0:binary, 1:linear')
+parser.add_argument('--opt_num_workers', type=int, default=1,
+                    help='Number of worker processes for the per-example \
+                          optimizer search, 1 runs it serially')
+parser.add_argument('--opt_solver', type=str, default='cvxpy',
+                    choices=['cvxpy', 'native'],
+                    help='Solver for the per-bin gap problems of the \
+                          optimizer models')
+parser.add_argument('--opt_solver_check_tol', type=float, default=0.,
+                    help='If > 0, cross-check the native solver against cvxpy \
+                          and report objectives differing by more than this \
+                          relative tolerance')
+parser.add_argument('--opt_bin_time_budget', type=float, default=0.,
+                    help='If > 0, wall-clock seconds for the count search of \
+                          one bin, the search then keeps the best count found \
+                          so far and is flagged as truncated')
+parser.add_argument('--opt_example_time_budget', type=float, default=0.,
+                    help='If > 0, wall-clock seconds for the count searches \
+                          of all the bins of one example')
+parser.add_argument('--opt_warm_start', action='store_true', default=False,
+                    help='Warm start the native solver of each candidate count \
+                          from the solution of the nearest count already \
+                          solved for the same bin')
 
 # Parameters for extra_var_model
 parser.add_argument('--num_grps', type=int, default=10,
@@ -255,6 +315,18 @@ if 'transformer' in model_names:
 if 'hawkes_model' in model_names:
     run_model_flags['hawkes_simu'] = True
 
+hparam_grid = utils.get_hparam_grid(args)
+if len(hparam_grid) > 1:
+    # Datasets are generated once here, before the runs share them
+    np.random.seed(args.seed)
+    os.makedirs(args.output_dir, exist_ok=True)
+    generate_dataset()
+    generate_twitter_dataset(twitter_dataset_names)
+    returncodes = utils.run_hparam_grid(args, hparam_grid)
+    sys.exit(0 if all(returncode == 0 for returncode in returncodes) else 1)
+for arg_name, arg_val in hparam_grid[0].items():
+    setattr(args, arg_name, arg_val)
+
 automate_bin_sz = False
 if args.bin_size == 0:
     automate_bin_sz = True
@@ -10,6 +10,7 @@ from utils import get_time_features
 
 import transformer_helpers.Constants as Constants
 from transformer_helpers.Layers import EncoderLayer
+from transformer_helpers.SubLayers import AttentionCache
 
 ETH = 10.0
 one_by = tf.math.reciprocal_no_nan
@@ -80,7 +81,11 @@ class InverseTransformSampling(layers.Layer):
     def call(self, inputs):
         D, WT = inputs
         # u = tf.ones_like(D) * tf.range(0.0, 1.0, 1.0/500.0)
-        u = tf.ones_like(D) * tf.random.uniform([500], minval=0.0, maxval=1.0, dtype=tf.dtypes.float32)
+        # One set of uniforms per row, the rows of a tiled batch (copies
+        # of one example) are then sampled independently
+        D_shape = tf.shape(D)
+        u_shape = tf.concat([D_shape[:1], tf.ones_like(D_shape[1:-1]), [500]], axis=0)
+        u = tf.ones_like(D) * tf.random.uniform(u_shape, minval=0.0, maxval=1.0, dtype=tf.dtypes.float32)
         c = -tf.exp(D)
         val = one_by(WT) * tf.math.log(WT * one_by(c) * tf.math.log(1.0 - u) + 1.0)
         val = tf.reduce_mean(val, axis=-1, keepdims=True)
@@ -132,68 +137,95 @@ class RMTPP(tf.keras.Model):
                                                    activation='softmax',
                                                    name='marks_output_layer')
 
-    def call(self, gaps, feats, types, initial_state=None):
-        ''' Forward pass of the RMTPP model'''
-
-        self.gaps = gaps
-        self.types = types
-        self.initial_state = initial_state
-        
-        # Gather input for the rnn
+    def get_rnn_inputs(self, gaps, feats, types):
+        ''' Gather input for the rnn '''
         if self.num_types>1:
-            self.types_embd = self.embedding_layer(self.types)
+            types_embd = self.embedding_layer(types)
         if self.use_time_feats:
             feats = feats/24.
-            rnn_inputs = tf.concat([self.gaps, feats], axis=-1)
+            rnn_inputs = tf.concat([gaps, feats], axis=-1)
         if self.num_types>1:
-            rnn_inputs = tf.concat([rnn_inputs, self.types_embd], axis=-1)
+            rnn_inputs = tf.concat([rnn_inputs, types_embd], axis=-1)
         else:
-            rnn_inputs = self.gaps
+            rnn_inputs = gaps
+        return rnn_inputs
 
-        self.hidden_states, self.final_state \
-                = self.rnn_layer(rnn_inputs,
-                                 mask=gaps>0.,
-                                 initial_state=self.initial_state)
-
-        # Generate D, WT, and gaps_pred
-        self.D = self.D_layer(self.hidden_states)
+    def get_outputs(self, hidden_states):
+        ''' Generate gaps_pred, types_logits, D, and WT from hidden states '''
+        D = self.D_layer(hidden_states)
         if self.use_intensity:
-            self.D = -self.D
+            D = -D
         
         if self.use_intensity:
-            self.WT = self.WT_layer(self.hidden_states)
-            self.gaps_pred = self.gaps_output_layer((self.D, self.WT))
+            WT = self.WT_layer(hidden_states)
+            gaps_pred = self.gaps_output_layer((D, WT))
         elif self.use_count_model:
-            self.WT = self.WT_layer(self.hidden_states)
-            self.gaps_pred = self.WT
+            WT = self.WT_layer(hidden_states)
+            gaps_pred = WT
         elif self.use_var_model:
-            self.WT = self.WT_layer(self.hidden_states) # Mean of sistribution
-            out_mean = self.D
-            out_stddev = self.WT
+            WT = self.WT_layer(hidden_states) # Mean of sistribution
+            out_mean = D
+            out_stddev = WT
             gaussian_distribution = tfp.distributions.Normal(
                 out_mean, out_stddev, validate_args=False, allow_nan_stats=True, 
                 name='Normal'
             )
             # output_samples = gaussian_distribution.sample(1000)
-            # self.gaps_pred = tf.reduce_mean(output_samples, axis=0)
-            self.gaps_pred = out_mean
+            # gaps_pred = tf.reduce_mean(output_samples, axis=0)
+            gaps_pred = out_mean
         else:
-            self.gaps_pred = self.D
-            self.WT = tf.zeros_like(self.D)
+            gaps_pred = D
+            WT = tf.zeros_like(D)
 
         if self.num_types>1:
-            self.types_logits = self.marks_output_layer(self.hidden_states)
+            types_logits = self.marks_output_layer(hidden_states)
         else:
             # Dummy logits
-            self.types_logits = tf.concat(
-                [tf.ones_like(self.gaps_pred),
-                 tf.zeros_like(self.gaps_pred)],
+            types_logits = tf.concat(
+                [tf.ones_like(gaps_pred),
+                 tf.zeros_like(gaps_pred)],
                 axis=-1,
             )
+        return gaps_pred, types_logits, D, WT
+
+    def call(self, gaps, feats, types, initial_state=None):
+        ''' Forward pass of the RMTPP model'''
+
+        self.gaps = gaps
+        self.types = types
+        self.initial_state = initial_state
+        
+        rnn_inputs = self.get_rnn_inputs(self.gaps, feats, self.types)
+
+        self.hidden_states, self.final_state \
+                = self.rnn_layer(rnn_inputs,
+                                 mask=gaps>0.,
+                                 initial_state=self.initial_state)
+
+        # Generate D, WT, and gaps_pred
+        self.gaps_pred, self.types_logits, self.D, self.WT \
+                = self.get_outputs(self.hidden_states)
         
         final_state = self.hidden_states[:,-1]
         return self.gaps_pred, self.types_logits, self.D, self.WT, final_state
 
+    def step(self, gaps, feats, types, state):
+        ''' Single-step forward pass on the carried hidden state
+
+        gaps, feats and types hold one event per sequence, i.e. shapes
+        (batch, 1, .). Runs the GRU cell once instead of the full GRU layer
+        and returns the same outputs as call() for that event.
+        '''
+        rnn_inputs = self.get_rnn_inputs(gaps, feats, types)
+        hidden_state, _ = self.rnn_layer.cell(rnn_inputs[:, 0], [state])
+        # A masked step of the GRU layer (zero gap) outputs zeros, and call()
+        # returns that output as the final state
+        hidden_state = tf.where(gaps[:, 0]>0., hidden_state, tf.zeros_like(hidden_state))
+
+        gaps_pred, types_logits, D, WT \
+                = self.get_outputs(tf.expand_dims(hidden_state, axis=1))
+        return gaps_pred, types_logits, D, WT, hidden_state
+
 def build_rmtpp_model(args, use_intensity, use_var_model, num_types):
     hidden_layer_size = args.hidden_layer_size
     batch_size = args.batch_size
@@ -904,18 +936,31 @@ def get_attn_key_pad_mask(seq_k, seq_q):
     return padding_mask
 
 
-def get_subsequent_mask(seq):
-    """ For masking out the subsequent info, i.e., masked self-attention. """
+def get_subsequent_mask(seq, len_cache=0):
+    """
+    For masking out the subsequent info, i.e., masked self-attention.
+    len_cache earlier positions (already cached) precede the ones in seq.
+    """
 
     sz_b, len_s = seq.shape
     #subsequent_mask = torch.triu(
     #    torch.ones((len_s, len_s), device=seq.device, dtype=torch.uint8), diagonal=1)
-    subsequent_mask = tf.linalg.band_part(
-        tf.ones((len_s, len_s)), 0, -1)
+    q_pos = tf.range(len_s) + len_cache
+    k_pos = tf.range(len_cache + len_s)
+    subsequent_mask = tf.cast(
+        tf.expand_dims(k_pos, axis=0) > tf.expand_dims(q_pos, axis=1), tf.float32)
     #subsequent_mask = subsequent_mask.unsqueeze(0).expand(sz_b, -1, -1)  # b x ls x ls
-    subsequent_mask = tf.tile(tf.expand_dims(subsequent_mask, axis=0), [sz_b, 1, 1])  # b x ls x ls
+    subsequent_mask = tf.tile(tf.expand_dims(subsequent_mask, axis=0), [sz_b, 1, 1])  # b x ls x lk
     return subsequent_mask
 
+class TransformerCache(object):
+    """ State kept across incremental calls of the Transformer. """
+
+    def __init__(self):
+        self.event_type = None
+        self.layers = None
+        self.rnn_state = None
+
 class Encoder(tf.keras.Model):
     """ A encoder model with self attention mechanism. """
 
@@ -963,13 +1008,26 @@ class Encoder(tf.keras.Model):
         #return result * non_pad_mask
         return result
 
-    def call(self, event_type, event_time, event_feats, non_pad_mask):
-        """ Encode event sequences via masked self-attention. """
+    def call(self, event_type, event_time, event_feats, non_pad_mask, cache=None):
+        """
+        Encode event sequences via masked self-attention.
+        With a TransformerCache, event_type continues the events seen by
+        the previous calls, whose keys/values are reused from the cache.
+        """
+
+        seq_k, len_cache = event_type, 0
+        if cache is not None:
+            if cache.event_type is not None:
+                seq_k = tf.concat([cache.event_type, event_type], axis=1)
+                len_cache = cache.event_type.shape[1]
+            else:
+                cache.layers = [AttentionCache() for _ in self.layer_stack]
+            cache.event_type = seq_k
 
         # prepare attention masks
         # slf_attn_mask is where we cannot look, i.e., the future and the padding
-        slf_attn_mask_subseq = get_subsequent_mask(event_type)
-        slf_attn_mask_keypad = get_attn_key_pad_mask(seq_k=event_type, seq_q=event_type)
+        slf_attn_mask_subseq = get_subsequent_mask(event_type, len_cache)
+        slf_attn_mask_keypad = get_attn_key_pad_mask(seq_k=seq_k, seq_q=event_type)
         #slf_attn_mask_keypad = slf_attn_mask_keypad.type_as(slf_attn_mask_subseq)
         slf_attn_mask_keypad = tf.cast(slf_attn_mask_keypad, dtype=slf_attn_mask_subseq.dtype)
         slf_attn_mask = (slf_attn_mask_keypad + slf_attn_mask_subseq)>(0)
@@ -979,13 +1037,14 @@ class Encoder(tf.keras.Model):
         feats_enc = self.feature_enc_layer(event_feats)
         enc_output = self.event_emb(event_type)
 
-        for enc_layer in self.layer_stack:
+        for i, enc_layer in enumerate(self.layer_stack):
             enc_output += (tem_enc + feats_enc)
             enc_output, _ = enc_layer(
                 enc_output,
                 event_feats,
                 non_pad_mask=non_pad_mask,
-                slf_attn_mask=slf_attn_mask)
+                slf_attn_mask=slf_attn_mask,
+                cache=cache.layers[i] if cache is not None else None)
         return enc_output
 
 class TypePredictor(tf.keras.Model):
@@ -1048,7 +1107,7 @@ class RNN_layers(tf.keras.Model):
         #self.projection = nn.Linear(d_rnn, d_model)
         self.projection = layers.Dense(d_model)
 
-    def call(self, data, non_pad_mask):
+    def call(self, data, non_pad_mask, cache=None):
         #TODO: Resolve packedsequence part
 
         #lengths = non_pad_mask.squeeze(2).long().sum(1).cpu()
@@ -1061,7 +1120,12 @@ class RNN_layers(tf.keras.Model):
         #temp = self.rnn(pack_enc_output)[0]
         #out = nn.utils.rnn.pad_packed_sequence(temp, batch_first=True)[0]
 
-        out, _, _ = self.rnn(data)
+        if cache is not None and cache.rnn_state is not None:
+            out, h, c = self.rnn(data, initial_state=cache.rnn_state)
+        else:
+            out, h, c = self.rnn(data)
+        if cache is not None:
+            cache.rnn_state = [h, c]
 
         out = self.projection(out)
         return out
@@ -1103,12 +1167,16 @@ class Transformer(tf.keras.Model):
         # prediction of next event type
         self.type_predictor = TypePredictor(d_model, num_types)
 
-    def call(self, event_time, event_feats, event_type):
+    def call(self, event_time, event_feats, event_type, cache=None):
         """
         Return the hidden representations and predictions.
         For a sequence (l_1, l_2, ..., l_N), we predict (l_2, ..., l_N, l_{N+1}).
         Input: event_type: batch*seq_len;
                event_time: batch*seq_len.
+               cache: optional TransformerCache. Pass the same (initially
+                      empty) cache to successive calls, each with only the
+                      new events, to reuse the encoder keys/values and the
+                      LSTM state of the events seen so far.
         Output: enc_output: batch*seq_len*model_dim;
                 type_prediction: batch*seq_len*num_classes (not normalized);
                 time_prediction: batch*seq_len.
@@ -1119,8 +1187,8 @@ class Transformer(tf.keras.Model):
 
         non_pad_mask = get_non_pad_mask(event_type)
 
-        enc_output = self.encoder(event_type, event_time, event_feats, non_pad_mask)
-        enc_output = self.rnn(enc_output, non_pad_mask)
+        enc_output = self.encoder(event_type, event_time, event_feats, non_pad_mask, cache=cache)
+        enc_output = self.rnn(enc_output, non_pad_mask, cache=cache)
 
         time_prediction = self.time_predictor(enc_output, non_pad_mask)
 
@@ -10,6 +10,7 @@ import numpy as np
 import pandas as pd
 from itertools import chain
 from bisect import bisect_right, bisect_left
+import multiprocessing
 from multiprocessing import Pool
 import matplotlib.pyplot as plt
 import properscoring as ps
@@ -29,6 +30,7 @@ from utils import add_metrics_to_dict
 from utils import write_arr_to_file
 from utils import write_pe_metrics_to_file
 from utils import write_opt_losses_to_file
+from utils import write_solver_telemetry_to_file
 
 #from transformer_helpers import Utils
 import transformer_utils
@@ -100,6 +102,110 @@ class Gaussian_MSE(tf.keras.losses.Loss):
 		loss = -tf.reduce_mean(gaussian_distribution.log_prob(gaps_true))
 		return loss
 
+#####################################################
+# 				Input Pipelines						#
+#####################################################
+
+def build_train_dataset(args, tensors, batch_size):
+	'''
+		Batched training tf.data.Dataset over the tuple of arrays tensors,
+		shared by all trainers. Shuffling (--shuffle_buffer, seeded by
+		--seed), caching (--dataset_cache) and prefetching (--prefetch_buffer)
+		follow the command line flags.
+	'''
+	dataset = tf.data.Dataset.from_tensor_slices(tuple(tensors))
+	if args.shuffle_buffer > 0:
+		# Cache the unbatched examples so that every epoch is reshuffled
+		if args.dataset_cache:
+			dataset = dataset.cache()
+		dataset = dataset.shuffle(args.shuffle_buffer, seed=args.seed,
+								  reshuffle_each_iteration=True)
+		dataset = dataset.batch(batch_size, drop_remainder=True)
+	else:
+		dataset = dataset.batch(batch_size, drop_remainder=True)
+		if args.dataset_cache:
+			dataset = dataset.cache()
+	if args.prefetch_buffer < 0:
+		dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+	elif args.prefetch_buffer > 0:
+		dataset = dataset.prefetch(args.prefetch_buffer)
+	return dataset
+
+#####################################################
+# 				Early Stopping						#
+#####################################################
+
+class EarlyStopping(object):
+	'''
+		Tracks the dev metric of a trainer and keeps the weights of the
+		best epoch in memory. Training stops after --early_stop_patience
+		dev evaluations without an improvement of --early_stop_min_delta,
+		or after --max_train_time seconds. Evaluations behind the patience
+		gate (allow_best=False) are not counted. The checkpoint is written
+		once, by restore_best.
+	'''
+	def __init__(self, args, model, checkpoint_path):
+		self.model = model
+		self.checkpoint_path = checkpoint_path
+		self.patience = args.early_stop_patience
+		self.min_delta = args.early_stop_min_delta
+		self.max_train_time = args.max_train_time
+		self.best_metric = np.inf
+		self.best_epoch = 0
+		self.best_weights = None
+		self.last_epoch = None
+		self.num_bad_evals = 0
+		self.start_time = time.time()
+
+	def update(self, epoch, dev_metric, allow_best=True):
+		'''
+			Returns True if dev_metric is the new best one, in which case
+			the current weights are kept.
+		'''
+		self.last_epoch = epoch
+		if not allow_best:
+			return False
+		dev_metric = float(dev_metric)
+		if self.best_metric - self.min_delta > dev_metric:
+			self.best_metric = dev_metric
+			self.best_epoch = epoch
+			self.best_weights = self.model.get_weights()
+			self.num_bad_evals = 0
+			return True
+		self.num_bad_evals += 1
+		return False
+
+	def should_stop(self):
+		if self.patience > 0 and self.num_bad_evals >= self.patience:
+			print('Early stopping, no dev improvement in', self.num_bad_evals, 'evaluations')
+			return True
+		if self.max_train_time > 0 and time.time() - self.start_time > self.max_train_time:
+			print('Early stopping, training time budget of', self.max_train_time, 'seconds used')
+			return True
+		return False
+
+	def restore_best(self):
+		'''
+			Sets the best weights back on the model and saves them to
+			the checkpoint. If training ran but no epoch was kept (stopped
+			before the patience gate), the current weights are saved.
+			Without training epochs the existing checkpoint is loaded, if
+			there is one.
+		'''
+		if self.best_weights is not None:
+			print("Loading best model from epoch", self.best_epoch)
+			self.model.set_weights(self.best_weights)
+			self.model.save_weights(self.checkpoint_path)
+		elif self.last_epoch is not None:
+			print("No epoch was kept, saving the model of epoch", self.last_epoch)
+			self.model.save_weights(self.checkpoint_path)
+		elif (tf.io.gfile.exists(self.checkpoint_path)
+			  or tf.io.gfile.exists(self.checkpoint_path+'.index')):
+			print("Loading model from", self.checkpoint_path)
+			self.model.load_weights(self.checkpoint_path)
+		else:
+			print("No checkpoint at", self.checkpoint_path, "keeping the initial weights")
+
 #####################################################
 # 				Run Models Function					#
 #####################################################
@@ -121,10 +227,9 @@ def run_rmtpp_var(args, data, test_data, trained_rmtpp_model):
 
 	dev_data_gaps = nc_event_dev_in_gaps
 
-	os.makedirs('saved_models/training_'+model_name+'_'+args.current_dataset+'/', exist_ok=True)
-	checkpoint_path = "saved_models/training_"+model_name+"_"+args.current_dataset+"/cp_"+args.current_dataset+".ckpt"
-	best_dev_gap_mse = np.inf
-	best_dev_epoch = 0
+	os.makedirs(args.saved_models+'/training_'+model_name+'_'+args.current_dataset+'/', exist_ok=True)
+	checkpoint_path = args.saved_models+"/training_"+model_name+"_"+args.current_dataset+"/cp_"+args.current_dataset+".ckpt"
+	early_stopping = EarlyStopping(args, model, checkpoint_path)
 
 	train_losses = list()
 	for epoch in range(args.epochs):
@@ -189,24 +294,22 @@ def run_rmtpp_var(args, data, test_data, trained_rmtpp_model):
 		dev_gap_mse = dev_gap_metric_mse.result()
 		dev_gap_metric_mae.reset_states()
 		dev_gap_metric_mse.reset_states()
-		if best_dev_gap_mse > dev_gap_mse:
-			best_dev_gap_mse = dev_gap_mse
-			best_dev_epoch = epoch
-			print('Saving model at epoch', epoch)
-			model.save_weights(checkpoint_path)
+		if early_stopping.update(epoch, dev_gap_mse):
+			print('Keeping model weights of epoch', epoch)
 
 		step_train_loss /= step_cnt
 		print('Training loss after epoch %s: %s' %(epoch, float(step_train_loss)))
 		print('MAE and MSE of Dev data %s: %s' \
 			%(float(dev_gap_mae), float(dev_gap_mse)))
 		train_losses.append(step_train_loss)
+		if early_stopping.should_stop():
+			break
 
 	plt.plot(range(len(train_losses)), train_losses)
 	plt.savefig(os.path.join(args.output_dir, 'train_'+args.current_model+'_'+args.current_dataset+'_loss.png'))
 	plt.close()
 
-	print("Loading best model from epoch", best_dev_epoch)
-	model.load_weights(checkpoint_path)
+	early_stopping.restore_best()
 
 	dev_gaps_pred, _, _, _, _ = model(nc_event_dev_in_gaps)
 	dev_gaps_pred_unnorm = utils.denormalize_avg(dev_gaps_pred, 
@@ -241,9 +344,8 @@ def run_rmtpp(args, model, optimizer, data, var_data, NLL_loss,
 	model_name = args.current_model
 
 	os.makedirs(args.saved_models+'/training_'+model_name+'_'+args.current_dataset+'/', exist_ok=True)
-	checkpoint_path = "saved_models/training_"+model_name+"_"+args.current_dataset+"/cp_"+args.current_dataset+".ckpt"
-	best_dev_gap_mse = np.inf
-	best_dev_epoch = 0
+	checkpoint_path = args.saved_models+"/training_"+model_name+"_"+args.current_dataset+"/cp_"+args.current_dataset+".ckpt"
+	early_stopping = EarlyStopping(args, model, checkpoint_path)
 	enc_len = args.enc_len
 	comp_enc_len = args.comp_enc_len
 	batch_size = args.batch_size
@@ -282,53 +384,66 @@ def run_rmtpp(args, model, optimizer, data, var_data, NLL_loss,
 	else:
 		rmtpp_var_model = None
 
+	train_loss_metric = tf.keras.metrics.Mean()
+	train_gap_loss_metric = tf.keras.metrics.Mean()
+	train_type_loss_metric = tf.keras.metrics.Mean()
+	type_loss_fn = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True)
+
+	# Forward pass, loss and update compiled into one graph, the losses
+	# stay on device in the metrics and are read once per epoch
+	@tf.function(input_signature=list(train_dataset_gaps.element_spec))
+	def train_step(gaps_batch_in, feats_batch_in, types_batch_in,
+				   gaps_batch_out, feats_batch_out, types_batch_out):
+		with tf.GradientTape() as tape:
+			gaps_pred, types_logits_pred, D, WT, _ = model(
+				gaps_batch_in,
+				feats_batch_in,
+				types_batch_in)
+
+			# Compute the loss for this minibatch.
+			if use_var_model:
+				gap_loss_fn = Gaussian_MSE(D, WT)
+			elif NLL_loss:
+				gap_loss_fn = NegativeLogLikelihood(D, WT)
+			else:
+				gap_loss_fn = MeanSquareLoss()
+
+			gap_loss = gap_loss_fn(gaps_batch_out, gaps_pred)
+			type_loss = type_loss_fn(types_batch_out-1, types_logits_pred)
+			loss = gap_loss + type_loss
+
+		grads = tape.gradient(loss, model.trainable_weights)
+		optimizer.apply_gradients(zip(grads, model.trainable_weights))
+
+		train_loss_metric.update_state(loss)
+		train_gap_loss_metric.update_state(gap_loss)
+		train_type_loss_metric.update_state(type_loss)
+		train_gap_metric_mae.update_state(gaps_batch_out, gaps_pred)
+		train_gap_metric_mse.update_state(gaps_batch_out, gaps_pred)
+
 	train_losses = list()
 	for epoch in range(args.epochs):
 		print('Starting epoch', epoch)
 		var_epoch_loss = 0.
-		step_train_loss = 0.0
-		step_cnt = 0
 		next_initial_state = None
 		st = time.time()
-		for sm_step, (gaps_batch_in, feats_batch_in, types_batch_in,
-					  gaps_batch_out, feats_batch_out, types_batch_out) \
-						in enumerate(train_dataset_gaps):
-			with tf.GradientTape() as tape:
-				gaps_pred, types_logits_pred, D, WT, _ = model(
-					gaps_batch_in,
-					feats_batch_in,
-					types_batch_in)
-
-				# Compute the loss for this minibatch.
-				if use_var_model:
-					gap_loss_fn = Gaussian_MSE(D, WT)
-				elif NLL_loss:
-					gap_loss_fn = NegativeLogLikelihood(D, WT)
-				else:
-					gap_loss_fn = MeanSquareLoss()
-
-				type_loss_fn = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True)
-				
-				gap_loss = gap_loss_fn(gaps_batch_out, gaps_pred)
-				type_loss = type_loss_fn(types_batch_out-1, types_logits_pred)
-				loss = gap_loss + type_loss
-				step_train_loss+=loss.numpy()
-
-			grads = tape.gradient(loss, model.trainable_weights)
-			optimizer.apply_gradients(zip(grads, model.trainable_weights))
-
-			train_gap_metric_mae(gaps_batch_out, gaps_pred)
-			train_gap_metric_mse(gaps_batch_out, gaps_pred)
-			train_gap_mae = train_gap_metric_mae.result()
-			train_gap_mse = train_gap_metric_mse.result()
-			train_gap_metric_mae.reset_states()
-			train_gap_metric_mse.reset_states()
-
-			# print(float(train_gap_mae), float(train_gap_mse))
-			print('Training loss (for one batch) at step %s: %s, %s, %s' %(sm_step, float(loss), float(gap_loss), float(type_loss)))
-			step_cnt += 1
+		for (gaps_batch_in, feats_batch_in, types_batch_in,
+			 gaps_batch_out, feats_batch_out, types_batch_out) in train_dataset_gaps:
+			train_step(gaps_batch_in, feats_batch_in, types_batch_in,
+					   gaps_batch_out, feats_batch_out, types_batch_out)
 		et = time.time()
 		print(model_name, 'time_reqd:', et-st)
+
+		step_train_loss = float(train_loss_metric.result())
+		print('Training gap and type loss after epoch %s: %s, %s' \
+			%(epoch, float(train_gap_loss_metric.result()), float(train_type_loss_metric.result())))
+		print('MAE and MSE of Train data %s: %s' \
+			%(float(train_gap_metric_mae.result()), float(train_gap_metric_mse.result())))
+		train_loss_metric.reset_states()
+		train_gap_loss_metric.reset_states()
+		train_type_loss_metric.reset_states()
+		train_gap_metric_mae.reset_states()
+		train_gap_metric_mse.reset_states()
 		
 		# Dev calculations
 		dev_gaps_pred, dev_logits_pred, _, _, _ = model(nc_event_dev_in_gaps, nc_event_dev_in_feats, nc_event_dev_in_types)
@@ -346,17 +461,15 @@ def run_rmtpp(args, model, optimizer, data, var_data, NLL_loss,
 		dev_types_acc = types_metric(nc_event_dev_out_types-1, dev_logits_pred)
 		types_metric.reset_states()
 
-		if best_dev_gap_mse > dev_gap_mse:
-			best_dev_gap_mse = dev_gap_mse
-			best_dev_epoch = epoch
-			print('Saving model at epoch', epoch)
-			model.save_weights(checkpoint_path)
+		if early_stopping.update(epoch, dev_gap_mse):
+			print('Keeping model weights of epoch', epoch)
 
-		step_train_loss /= step_cnt
 		print('Training loss after epoch %s: %s' %(epoch, float(step_train_loss)))
 		print('MAE and MSE of Dev data %s: %s' \
 			%(float(dev_gap_mae), float(dev_gap_mse)))
 		train_losses.append(step_train_loss)
+		if early_stopping.should_stop():
+			break
 
 	if args.extra_var_model and rmtpp_type=='mse':# and epoch%5==0:
 		var_gaps_pred_lst, bin_ids_lst, grp_ids_lst, pos_ids_lst = [], [], [], []
@@ -410,8 +523,7 @@ def run_rmtpp(args, model, optimizer, data, var_data, NLL_loss,
 	plt.savefig(os.path.join(args.output_dir, 'train_'+model_name+'_'+args.current_dataset+'_loss.png'))
 	plt.close()
 
-	print("Loading best model from epoch", best_dev_epoch)
-	model.load_weights(checkpoint_path)
+	early_stopping.restore_best()
 	dev_gaps_pred, dev_logits_pred, _, _, _ = model(nc_event_dev_in_gaps, nc_event_dev_in_feats, nc_event_dev_in_types)
 	dev_gaps_pred_unnorm = utils.denormalize_avg(dev_gaps_pred, 
 												 event_train_norma,
@@ -475,10 +587,9 @@ def run_pure_hierarchical(args, model, optimizer, data, NLL_loss, rmtpp_epochs=1
 	[event_train_norma, event_train_normd] = train_norm_gaps
 	model_name = args.current_model
 
-	os.makedirs('saved_models/training_'+model_name+'_'+args.current_dataset+'/', exist_ok=True)
-	checkpoint_path = "saved_models/training_"+model_name+"_"+args.current_dataset+"/cp_"+args.current_dataset+".ckpt"
-	best_dev_gap_mse = np.inf
-	best_dev_epoch = 0
+	os.makedirs(args.saved_models+'/training_'+model_name+'_'+args.current_dataset+'/', exist_ok=True)
+	checkpoint_path = args.saved_models+"/training_"+model_name+"_"+args.current_dataset+"/cp_"+args.current_dataset+".ckpt"
+	early_stopping = EarlyStopping(args, model, checkpoint_path)
 	enc_len = args.enc_len
 	comp_enc_len = args.comp_enc_len
 	batch_size = args.batch_size
@@ -545,24 +656,22 @@ def run_pure_hierarchical(args, model, optimizer, data, NLL_loss, rmtpp_epochs=1
 		dev_gap_metric_mae.reset_states()
 		dev_gap_metric_mse.reset_states()
 
-		if best_dev_gap_mse > dev_gap_mse:
-			best_dev_gap_mse = dev_gap_mse
-			best_dev_epoch = epoch
-			print('Saving model at epoch', epoch)
-			model.save_weights(checkpoint_path)
+		if early_stopping.update(epoch, dev_gap_mse):
+			print('Keeping model weights of epoch', epoch)
 
 		step_train_loss /= step_cnt
 		print('Training loss after epoch %s: %s' %(epoch, float(step_train_loss)))
 		print('MAE and MSE of Dev data %s: %s' \
 			%(float(dev_gap_mae), float(dev_gap_mse)))
 		train_losses.append(step_train_loss)
+		if early_stopping.should_stop():
+			break
 
 	plt.plot(range(len(train_losses)), train_losses)
 	plt.savefig(os.path.join(args.output_dir, 'train_'+model_name+'_'+args.current_dataset+'_loss.png'))
 	plt.close()
 
-	print("Loading best model from epoch", best_dev_epoch)
-	model.load_weights(checkpoint_path)
+	early_stopping.restore_best()
 	dev_gaps_pred_l2, _,_, dev_gaps_pred, _,_,_,_ = model(nc_event_dev_in_gaps)
 	dev_gaps_pred_unnorm = utils.denormalize_avg(dev_gaps_pred, 
 									event_train_norma, event_train_normd)
@@ -710,78 +819,92 @@ def run_count_model(args, data, test_data):
 	#count_train_in_feats = count_train_in_feats[:train_data_size]
 
 	batch_size = args.batch_size
-	train_dataset = tf.data.Dataset.from_tensor_slices(
+	train_dataset = build_train_dataset(
+		args,
 		(
 			count_train_in_counts,
 			count_train_in_feats,
 			count_train_out_counts
-		)
-	).batch(batch_size, drop_remainder=True)
+		),
+		batch_size
+	)
 
 	model, optimizer = models.build_count_model(args, distribution_name)
 	#model.summary()
 
 	os.makedirs(args.saved_models+'/training_count_'+args.current_dataset+'/', exist_ok=True)
 	checkpoint_path = args.saved_models+"/training_count_"+args.current_dataset+"/cp_"+args.current_dataset+".ckpt"
-	best_dev_gap_mae = np.inf
-	best_dev_epoch = 0
+	early_stopping = EarlyStopping(args, model, checkpoint_path)
 
-	train_losses = list()
-	stddev_sample = list()
-	dev_mae_list = list()
-	for epoch in range(num_epochs):
-		#print('Starting epoch', epoch)
-		step_train_loss = 0.0
-		step_cnt = 0
-		for sm_step, (bin_count_batch_in, bin_count_batch_in_feats,
-						bin_count_batch_out) in enumerate(train_dataset):
-			with tf.GradientTape() as tape:
-				#import ipdb
-				#ipdb.set_trace()
-				bin_counts_pred, distribution_params = model(
-					bin_count_batch_in,
-					bin_count_batch_in_feats,
-					bin_count_batch_out
-				)
+	train_loss_metric = tf.keras.metrics.Mean()
 
-				loss_fn = models.NegativeLogLikelihood_CountModel(distribution_params, distribution_name)
-				loss = loss_fn(bin_count_batch_out, bin_counts_pred)
+	def train_step_fn(bin_count_batch_in, bin_count_batch_in_feats, bin_count_batch_out):
+		with tf.GradientTape() as tape:
+			bin_counts_pred, distribution_params = model(
+				bin_count_batch_in,
+				bin_count_batch_in_feats,
+				bin_count_batch_out
+			)
 
-				step_train_loss+=loss.numpy()
-				
-				grads = tape.gradient(loss, model.trainable_weights)
-				optimizer.apply_gradients(zip(grads, model.trainable_weights))
+			loss_fn = models.NegativeLogLikelihood_CountModel(distribution_params, distribution_name)
+			loss = loss_fn(bin_count_batch_out, bin_counts_pred)
 
-			# print('Training loss (for one batch) at step %s: %s' %(sm_step, float(loss)))
-			step_cnt += 1
-		
-		# Dev calculations
-		count_dev_pred, _ = model(count_dev_in_counts, count_dev_in_feats)
-		count_dev_pred_unnorm = utils.denormalize_data(count_dev_pred, count_test_normm, count_test_norms)
-		dev_gap_metric_mae(count_dev_pred_unnorm, count_dev_out_counts)
-		dev_gap_metric_mse(count_dev_pred_unnorm, count_dev_out_counts)
-		dev_gap_mae = dev_gap_metric_mae.result()
-		dev_gap_mse = dev_gap_metric_mse.result()
-		dev_gap_metric_mae.reset_states()
-		dev_gap_metric_mse.reset_states()
+		grads = tape.gradient(loss, model.trainable_weights)
+		optimizer.apply_gradients(zip(grads, model.trainable_weights))
+		train_loss_metric.update_state(loss)
 
-		if best_dev_gap_mae > dev_gap_mae and patience <= epoch:
-			best_dev_gap_mae = dev_gap_mae
-			best_dev_epoch = epoch
-			print('Saving model at epoch', epoch)
-			model.save_weights(checkpoint_path)
+	train_step = tf.function(train_step_fn, input_signature=list(train_dataset.element_spec))
 
-		step_train_loss /= step_cnt
-		print('Training loss after epoch %s: %s' %(epoch, float(step_train_loss)))
-		print('MAE and MSE of Dev data %s: %s' \
-			%(float(dev_gap_mae), float(dev_gap_mse)))
-		train_losses.append(step_train_loss)
+	# Whole epoch as one graph, loops over the dataset inside the graph
+	@tf.function
+	def train_epoch(dataset):
+		for bin_count_batch_in, bin_count_batch_in_feats, bin_count_batch_out in dataset:
+			train_step_fn(bin_count_batch_in, bin_count_batch_in_feats, bin_count_batch_out)
+
+	eval_interval = max(1, args.count_eval_interval)
+	train_losses = list()
+	stddev_sample = list()
+	dev_mae_list = list()
+	for epoch in range(num_epochs):
+		#print('Starting epoch', epoch)
+		if args.count_epoch_fn:
+			train_epoch(train_dataset)
+		else:
+			for bin_count_batch_in, bin_count_batch_in_feats, bin_count_batch_out \
+					in train_dataset:
+				train_step(bin_count_batch_in, bin_count_batch_in_feats, bin_count_batch_out)
+
+		# Kept as a tensor, read back after training
+		train_losses.append(train_loss_metric.result())
+		train_loss_metric.reset_states()
+
+		if (epoch+1) % eval_interval == 0 or epoch == num_epochs-1:
+			# Dev calculations
+			count_dev_pred, _ = model(count_dev_in_counts, count_dev_in_feats)
+			count_dev_pred_unnorm = utils.denormalize_data(count_dev_pred, count_test_normm, count_test_norms)
+			dev_gap_metric_mae(count_dev_pred_unnorm, count_dev_out_counts)
+			dev_gap_metric_mse(count_dev_pred_unnorm, count_dev_out_counts)
+			dev_gap_mae = dev_gap_metric_mae.result()
+			dev_gap_mse = dev_gap_metric_mse.result()
+			dev_gap_metric_mae.reset_states()
+			dev_gap_metric_mse.reset_states()
+
+			if early_stopping.update(epoch, dev_gap_mae, allow_best=patience <= epoch):
+				print('Keeping model weights of epoch', epoch)
+
+			print('Training loss after epoch %s: %s' %(epoch, float(train_losses[-1])))
+			print('MAE and MSE of Dev data %s: %s' \
+				%(float(dev_gap_mae), float(dev_gap_mse)))
+			dev_mae_list.append((epoch, dev_gap_mae))
 
-		dev_mae_list.append(dev_gap_mae)
 		if epoch%10 == 0:
 			_, [_, test_distribution_stddev] = model(count_test_in_counts, count_test_in_feats)
 			stddev_sample.append(test_distribution_stddev[0])
 
+		if early_stopping.should_stop():
+			break
+
+	train_losses = [float(loss) for loss in train_losses]
 	stddev_sample = np.array(stddev_sample)
 
 	if num_epochs>0:
@@ -801,14 +924,14 @@ def run_count_model(args, data, test_data):
 		'count_model_train_loss_'+distribution_name+'_'+args.current_dataset+'.png'))
 	plt.close()
 
-	plt.plot(range(len(dev_mae_list)), dev_mae_list)
+	# Dev MAE is only computed every eval_interval epochs
+	plt.plot([epoch for epoch, _ in dev_mae_list], [float(mae) for _, mae in dev_mae_list])
 	plt.savefig(os.path.join(
 		args.output_dir,
 		'count_model_dev_mae_'+distribution_name+'_'+args.current_dataset+'.png'))
 	plt.close()
 
-	print("Loading best model from epoch", best_dev_epoch)
-	model.load_weights(checkpoint_path)
+	early_stopping.restore_best()
 	count_dev_pred, _ = model(count_dev_in_counts, count_dev_in_feats)		
 	count_dev_pred_unnorm = utils.denormalize_data(count_dev_pred, count_test_normm, count_test_norms)
 	dev_gap_metric_mae(count_dev_pred_unnorm, count_dev_out_counts)
@@ -901,9 +1024,7 @@ def run_wgan(args, data, test_data):
 
 	os.makedirs(args.saved_models+'/training_wgan_'+args.current_dataset+'/', exist_ok=True)
 	checkpoint_path = args.saved_models+"/training_wgan_"+args.current_dataset+"/cp_"+args.current_dataset+".ckpt"
-	best_dev_gap_mse = np.inf
-	best_dev_gap_mae = np.inf
-	best_dev_epoch = 0
+	early_stopping = EarlyStopping(args, model, checkpoint_path)
 
 	# pre-train wgan model
 	pre_train_losses = list()
@@ -1007,18 +1128,17 @@ def run_wgan(args, data, test_data):
 		dev_gap_mse = dev_gap_metric_mse.result()
 		dev_gap_metric_mae.reset_states()
 		dev_gap_metric_mse.reset_states()
-		#if best_dev_gap_mse > dev_gap_mse:
-		if best_dev_gap_mae > dev_gap_mae:
-			best_dev_gap_mae = dev_gap_mae
-			best_dev_epoch = epoch
-			print('Saving model at epoch', epoch)
-			model.save_weights(checkpoint_path)
+		#if early_stopping.update(epoch, dev_gap_mse):
+		if early_stopping.update(epoch, dev_gap_mae):
+			print('Keeping model weights of epoch', epoch)
 
 		step_train_loss /= step_cnt
 		print('Training loss after epoch %s: %s' %(epoch, float(step_train_loss)))
 		print('MAE and MSE of Dev data %s: %s' \
 			%(float(dev_gap_mae), float(dev_gap_mse)))
 		train_losses.append(step_train_loss)
+		if early_stopping.should_stop():
+			break
 
 	plt.plot(range(len(train_losses)), train_losses)
 	plt.savefig(os.path.join(
@@ -1026,8 +1146,7 @@ def run_wgan(args, data, test_data):
 		'train_wgan_'+args.current_dataset+'_loss.png'))
 	plt.close()
 
-	print("Loading best model from epoch", best_dev_epoch)
-	model.load_weights(checkpoint_path)
+	early_stopping.restore_best()
 	nc_event_dev_in_gaps = dev_data_gaps[:, :wgan_enc_len]
 	nc_event_dev_in_feats = dev_data_feats[:, :wgan_enc_len]
 	nc_event_dev_out_gaps = dev_data_gaps[:, wgan_enc_len:]
@@ -1097,9 +1216,7 @@ def run_seq2seq(args, data, test_data):
 
 	os.makedirs(args.saved_models+'/training_'+model_name+'_'+args.current_dataset+'/', exist_ok=True)
 	checkpoint_path = args.saved_models+"/training_"+model_name+"_"+args.current_dataset+"/cp_"+args.current_dataset+".ckpt"
-	best_dev_gap_mse = np.inf
-	best_dev_gap_mae = np.inf
-	best_dev_epoch = 0
+	early_stopping = EarlyStopping(args, model, checkpoint_path)
 
 	# pre-train wgan model
 	pre_train_losses = list()
@@ -1204,19 +1321,17 @@ def run_seq2seq(args, data, test_data):
 		dev_gap_mse = dev_gap_metric_mse.result()
 		dev_gap_metric_mae.reset_states()
 		dev_gap_metric_mse.reset_states()
-		if best_dev_gap_mse > dev_gap_mse:
-		#if best_dev_gap_mae > dev_gap_mae:
-			best_dev_gap_mae = dev_gap_mae
-			best_dev_gap_mse = dev_gap_mse
-			best_dev_epoch = epoch
-			print('Saving model at epoch', epoch)
-			model.save_weights(checkpoint_path)
+		if early_stopping.update(epoch, dev_gap_mse):
+		#if early_stopping.update(epoch, dev_gap_mae):
+			print('Keeping model weights of epoch', epoch)
 
 		step_train_loss /= step_cnt
 		print('Training loss after epoch %s: %s' %(epoch, float(step_train_loss)))
 		print('MAE and MSE of Dev data %s: %s' \
 			%(float(dev_gap_mae), float(dev_gap_mse)))
 		train_losses.append(step_train_loss)
+		if early_stopping.should_stop():
+			break
 
 	plt.plot(range(len(train_losses)), train_losses)
 	plt.savefig(os.path.join(
@@ -1224,8 +1339,7 @@ def run_seq2seq(args, data, test_data):
 		'train_wgan_'+args.current_dataset+'_loss.png'))
 	plt.close()
 
-	print("Loading best model from epoch", best_dev_epoch)
-	model.load_weights(checkpoint_path)
+	early_stopping.restore_best()
 	nc_event_dev_in_gaps = dev_data_gaps[:, :wgan_enc_len]
 	nc_event_dev_in_feats = dev_data_feats[:, :wgan_enc_len]
 	nc_event_dev_out_gaps = dev_data_gaps[:, wgan_enc_len:]
@@ -1289,8 +1403,7 @@ def run_transformer(args, data, test_data):
 
 	os.makedirs(args.saved_models+'/training_'+model_name+'_'+args.current_dataset+'/', exist_ok=True)
 	checkpoint_path = args.saved_models+"/training_"+model_name+"_"+args.current_dataset+"/cp_"+args.current_dataset+".ckpt"
-	best_dev_gap_mse = np.inf
-	best_dev_epoch = 0
+	early_stopping = EarlyStopping(args, model, checkpoint_path)
 	enc_len = args.enc_len
 	comp_enc_len = args.comp_enc_len
 	batch_size = args.batch_size
@@ -1376,17 +1489,16 @@ def run_transformer(args, data, test_data):
 		dev_gap_metric_mae.reset_states()
 		dev_gap_metric_mse.reset_states()
 
-		if best_dev_gap_mse > dev_gap_mse:
-			best_dev_gap_mse = dev_gap_mse
-			best_dev_epoch = epoch
-			print('Saving model at epoch', epoch)
-			model.save_weights(checkpoint_path)
+		if early_stopping.update(epoch, dev_gap_mse):
+			print('Keeping model weights of epoch', epoch)
 
 		step_train_loss /= step_cnt
 		print('Training loss after epoch %s: %s' %(epoch, float(step_train_loss)))
 		print('MAE and MSE of Dev data %s: %s' \
 			%(float(dev_gap_mae), float(dev_gap_mse)))
 		train_losses.append(step_train_loss)
+		if early_stopping.should_stop():
+			break
 
 	plt.plot(range(len(train_losses)), train_losses)
 	plt.savefig(os.path.join(
@@ -1394,8 +1506,7 @@ def run_transformer(args, data, test_data):
 		'train_'+model_name+'_'+args.current_dataset+'_loss.png'))
 	plt.close()
 
-	print("Loading best model from epoch", best_dev_epoch)
-	model.load_weights(checkpoint_path)
+	early_stopping.restore_best()
 	_, (dev_logits_pred, dev_gaps_pred) = model(nc_event_dev_in_gaps, nc_event_dev_in_feats, nc_event_dev_in_types)
 	dev_gaps_pred_unnorm = utils.denormalize_avg(dev_gaps_pred, 
 												 event_train_norma,
@@ -1516,17 +1627,42 @@ def simulate_v2(model, times_in, gaps_in, bins_end_hrs, normalizers,
 	return all_gaps_pred, all_times_pred, bin_ids, grp_ids, pos_ids
 
 
+#%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%#
+# Compiled single-step RMTPP decoder shared by the simulators.
+# RMTPP.step runs the GRU cell and the output heads on the carried hidden
+# state, one tf.function is kept per model so that it is traced once.
+rmtpp_step_fns = dict()
+
+def get_rmtpp_step_fn(model):
+	if id(model) not in rmtpp_step_fns:
+		rmtpp_step_fns[id(model)] = (model, tf.function(model.step))
+	return rmtpp_step_fns[id(model)][1]
+
+def write_simulation_buffer(buf, step, value, num_steps=16):
+	'''
+	Writes value of shape (batch, ...) at position step of the
+	(batch, steps, ...) buffer. The buffer is allocated for num_steps on
+	the first write and doubled along the steps axis when it is full.
+	'''
+	value = np.asarray(value)
+	if buf is None:
+		buf = np.zeros((value.shape[0], max(num_steps, 1))+value.shape[1:], dtype=value.dtype)
+	if step >= buf.shape[1]:
+		buf = np.concatenate([buf, np.zeros_like(buf)], axis=1)
+	buf[:, step] = value
+	return buf
+#%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%#
+
 #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%#
 # Simulate model until t_b_plus
 def simulate_rmtpp(model, times_in, gaps_in, feats_in, types_in,
 			 	   t_b_plus, normalizers, use_nowcast=False,
 				   nc_gaps_in=None, nc_feats_in=None, nc_types_in=None,):
 	#TODO: Check for this modification in functions which calls this def
-	gaps_pred = list()
-	types_pred = list()
-	times_pred = list()
-	D_pred, WT_pred = [], []
+	gaps_pred, types_pred, times_pred = None, None, None
+	D_pred, WT_pred = None, None
 	data_norm_a, data_norm_d = normalizers
+	step_fn = get_rmtpp_step_fn(model)
 	
 	# step_gaps_pred = gaps_in[:, -1]
 	step_gaps_pred, step_types_logits, D, WT, prev_hidden_state \
@@ -1552,24 +1688,22 @@ def simulate_rmtpp(model, times_in, gaps_in, feats_in, types_in,
 		feats_in = nc_feats_in[:, 0:1]
 	#import ipdb
 	#ipdb.set_trace()
-	gaps_pred.append(last_gaps_pred_unnorm)
-	types_pred.append(step_types_pred)
-	times_pred.append(last_times_pred)
-	D_pred.append(D[:, -1:])
-	WT_pred.append(WT[:, -1:])
+	gaps_pred = write_simulation_buffer(gaps_pred, 0, last_gaps_pred_unnorm)
+	types_pred = write_simulation_buffer(types_pred, 0, step_types_pred)
+	times_pred = write_simulation_buffer(times_pred, 0, last_times_pred)
+	D_pred = write_simulation_buffer(D_pred, 0, D[:, -1])
+	WT_pred = write_simulation_buffer(WT_pred, 0, WT[:, -1])
 
 	simul_step = 0
 
-	while any(times_pred[-1]<t_b_plus):
+	while any(last_times_pred<t_b_plus):
 		simul_step += 1
 
 		step_gaps_pred, step_types_logits, D, WT, prev_hidden_state \
-				= model(gaps_in, feats_in, types_in, initial_state=prev_hidden_state)
+				= step_fn(gaps_in, feats_in, types_in, prev_hidden_state)
 
 		step_types_pred = tf.argmax(step_types_logits, axis=-1) + 1
 
-		step_gaps_pred = step_gaps_pred[:,-1:]
-		step_types_pred = step_types_pred[:,-1:]
 		if not use_nowcast:
 			gaps_in = step_gaps_pred
 			types_in = step_types_pred
@@ -1579,28 +1713,27 @@ def simulate_rmtpp(model, times_in, gaps_in, feats_in, types_in,
 
 		step_gaps_pred = tf.squeeze(step_gaps_pred, axis=-1)
 		last_gaps_pred_unnorm = utils.denormalize_avg(step_gaps_pred, data_norm_a, data_norm_d)
-		last_times_pred = times_pred[-1] + last_gaps_pred_unnorm
+		last_times_pred = last_times_pred + last_gaps_pred_unnorm
 		step_feats_pred = get_time_features(tf.expand_dims(last_times_pred, axis=-1))
 		if not use_nowcast:
 			feats_in = step_feats_pred
 		else:
 			feats_in = nc_feats_in[:, simul_step:simul_step+1]
-		gaps_pred.append(last_gaps_pred_unnorm)
-		types_pred.append(step_types_pred)
-		times_pred.append(last_times_pred)
-		D_pred.append(D[:, -1:])
-		WT_pred.append(WT[:, -1:])
+		gaps_pred = write_simulation_buffer(gaps_pred, simul_step, last_gaps_pred_unnorm)
+		types_pred = write_simulation_buffer(types_pred, simul_step, step_types_pred)
+		times_pred = write_simulation_buffer(times_pred, simul_step, last_times_pred)
+		D_pred = write_simulation_buffer(D_pred, simul_step, D[:, -1])
+		WT_pred = write_simulation_buffer(WT_pred, simul_step, WT[:, -1])
 		
 
-	gaps_pred = tf.stack(gaps_pred, axis=1)
-	types_pred = tf.squeeze(tf.stack(types_pred, axis=1), axis=2)
-	all_gaps_pred = gaps_pred
+	num_steps = simul_step + 1
+	all_gaps_pred = tf.convert_to_tensor(gaps_pred[:, :num_steps])
+	types_pred = tf.convert_to_tensor(np.squeeze(types_pred[:, :num_steps], axis=2))
 
-	times_pred = tf.squeeze(tf.stack(times_pred, axis=1), axis=2)
-	all_times_pred = times_pred
+	all_times_pred = tf.convert_to_tensor(np.squeeze(times_pred[:, :num_steps], axis=2))
 
-	D_pred = tf.squeeze(tf.concat(D_pred, axis=1), axis=-1)
-	WT_pred = tf.squeeze(tf.concat(WT_pred, axis=1), axis=-1)
+	D_pred = tf.convert_to_tensor(np.squeeze(D_pred[:, :num_steps], axis=-1))
+	WT_pred = tf.convert_to_tensor(np.squeeze(WT_pred[:, :num_steps], axis=-1))
 
 	return all_gaps_pred, all_times_pred, types_pred, prev_hidden_state, D_pred, WT_pred
 #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%#
@@ -1830,12 +1963,11 @@ def simulate_count_for_D_WT(model, times_in, gaps_in, out_gaps_count, normalizer
 def simulate_with_counter(model, times_in, gaps_in, feats_in, types_in,
 						  out_gaps_count, normalizers, use_nowcast=False,
 						  nc_gaps_in=None, nc_feats_in=None, nc_types_in=None,):
-	gaps_pred = list()
-	D_pred = list()
-	WT_pred = list()
-	types_pred = list()
-	times_pred = list()
+	gaps_pred, D_pred, WT_pred = None, None, None
+	types_pred, times_pred = None, None
 	data_norm_a, data_norm_d = normalizers
+	step_fn = get_rmtpp_step_fn(model)
+	num_steps = 1 + int(max(np.ceil(np.max(out_gaps_count)), 0))
 	
 	# step_gaps_pred = gaps_in[:, -1]
 	step_gaps_pred, step_types_logits, D, WT, prev_hidden_state \
@@ -1845,8 +1977,8 @@ def simulate_with_counter(model, times_in, gaps_in, feats_in, types_in,
 
 	step_gaps_pred = step_gaps_pred[:,-1:]
 	step_types_pred = step_types_pred[:,-1:]
-	D_pred.append(D[:, -1:])
-	WT_pred.append(WT[:, -1:])
+	D_pred = write_simulation_buffer(D_pred, 0, D[:, -1], num_steps)
+	WT_pred = write_simulation_buffer(WT_pred, 0, WT[:, -1], num_steps)
 	if not use_nowcast:
 		gaps_in = step_gaps_pred
 		types_in = step_types_pred
@@ -1861,9 +1993,9 @@ def simulate_with_counter(model, times_in, gaps_in, feats_in, types_in,
 		feats_in = step_feats_pred
 	else:
 		feats_in = nc_feats_in[:, 0:1]
-	gaps_pred.append(last_gaps_pred_unnorm)
-	types_pred.append(step_types_pred)
-	times_pred.append(last_times_pred)
+	gaps_pred = write_simulation_buffer(gaps_pred, 0, last_gaps_pred_unnorm, num_steps)
+	types_pred = write_simulation_buffer(types_pred, 0, step_types_pred, num_steps)
+	times_pred = write_simulation_buffer(times_pred, 0, last_times_pred, num_steps)
 
 	simul_step = 0
 
@@ -1871,16 +2003,13 @@ def simulate_with_counter(model, times_in, gaps_in, feats_in, types_in,
 	while any(simul_step < out_gaps_count):
 		simul_step += 1
 
-		print(simul_step, np.sum(simul_step<out_gaps_count), out_gaps_count[0])
 		step_gaps_pred, step_types_logits, D, WT, prev_hidden_state \
-				= model(gaps_in, feats_in, types_in, initial_state=prev_hidden_state)
+				= step_fn(gaps_in, feats_in, types_in, prev_hidden_state)
 
 		step_types_pred = tf.argmax(step_types_logits, axis=-1) + 1
 			
-		step_gaps_pred = step_gaps_pred[:,-1:]
-		step_types_pred = step_types_pred[:,-1:]
-		D_pred.append(D[:, -1:])
-		WT_pred.append(WT[:, -1:])
+		D_pred = write_simulation_buffer(D_pred, simul_step, D[:, -1])
+		WT_pred = write_simulation_buffer(WT_pred, simul_step, WT[:, -1])
 		if not use_nowcast:
 			gaps_in = step_gaps_pred
 			types_in = step_types_pred
@@ -1889,28 +2018,27 @@ def simulate_with_counter(model, times_in, gaps_in, feats_in, types_in,
 			types_in = nc_types_in[:, simul_step:simul_step+1]
 		step_gaps_pred = tf.squeeze(step_gaps_pred, axis=-1)
 		last_gaps_pred_unnorm = utils.denormalize_avg(step_gaps_pred, data_norm_a, data_norm_d)
-		last_times_pred = times_pred[-1] + last_gaps_pred_unnorm
+		last_times_pred = last_times_pred + last_gaps_pred_unnorm
 		last_times_pred = (simul_step <= out_gaps_count) * last_times_pred
 		step_feats_pred = get_time_features(tf.expand_dims(last_times_pred, axis=-1))
 		if not use_nowcast:
 			feats_in = step_feats_pred
 		else:
 			feats_in = nc_feats_in[:, simul_step:simul_step+1]
-		gaps_pred.append(last_gaps_pred_unnorm)
-		types_pred.append(step_types_pred)
-		times_pred.append(last_times_pred)
+		gaps_pred = write_simulation_buffer(gaps_pred, simul_step, last_gaps_pred_unnorm)
+		types_pred = write_simulation_buffer(types_pred, simul_step, step_types_pred)
+		times_pred = write_simulation_buffer(times_pred, simul_step, last_times_pred)
 		
 	end_time = time.time()
 	print('Time Reqd in simulate_with_counter:', end_time-start_time)
 
-	gaps_pred = tf.stack(gaps_pred, axis=1)
-	types_pred = tf.squeeze(tf.stack(types_pred, axis=1), axis=2)
-	all_gaps_pred = gaps_pred
-	D_pred = tf.concat(D_pred, axis=1)
-	WT_pred = tf.concat(WT_pred, axis=1)
+	num_steps = simul_step + 1
+	all_gaps_pred = tf.convert_to_tensor(gaps_pred[:, :num_steps])
+	types_pred = tf.convert_to_tensor(np.squeeze(types_pred[:, :num_steps], axis=2))
+	D_pred = tf.convert_to_tensor(D_pred[:, :num_steps])
+	WT_pred = tf.convert_to_tensor(WT_pred[:, :num_steps])
 
-	times_pred = tf.squeeze(tf.stack(times_pred, axis=1), axis=2)
-	all_times_pred = times_pred
+	all_times_pred = tf.convert_to_tensor(np.squeeze(times_pred[:, :num_steps], axis=2))
 
 	return all_gaps_pred, all_times_pred, types_pred, D_pred, WT_pred
 #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%#
@@ -2066,8 +2194,12 @@ def simulate_transformer(
 	times_pred = list()
 	data_norm_a, data_norm_d = normalizers
 	
+	# Attention keys/values and LSTM state of the events seen so far,
+	# so each step below only encodes the newly generated event.
+	cache = models.TransformerCache()
+
 	# step_gaps_pred = gaps_in[:, -1]
-	enc_out, (step_types_logits, step_gaps_pred) = model(gaps_in, feats_in, types_in)
+	enc_out, (step_types_logits, step_gaps_pred) = model(gaps_in, feats_in, types_in, cache=cache)
 
 	step_types_pred = tf.argmax(step_types_logits, axis=-1) + 1
 
@@ -2099,7 +2231,7 @@ def simulate_transformer(
 		print('transformer sim:', np.sum(times_pred[-1]<t_b_plus), t_b_plus.shape)
 		#print(np.squeeze(t_b_plus-times_pred[-1], axis=-1))
 		#print(gaps_in[0, :, 0])
-		enc_out, (step_types_logits, step_gaps_pred) = model(gaps_in, feats_in, types_in)
+		enc_out, (step_types_logits, step_gaps_pred) = model(gaps_in, feats_in, types_in, cache=cache)
 
 		step_types_pred = tf.argmax(step_types_logits, axis=-1) + 1
 
@@ -2763,22 +2895,21 @@ def run_hawkes_model(args, hawkes_timestamps_pred, data=None, test_data=None):
 	dec_len = args.out_bin_sz
 	bin_size = args.bin_size
 	
-	all_times_pred = list()
-	for batch_idx in range(len(count_test_out_binend)):
-		batch_times_pred = list()
-		for dec_idx in range(len(count_test_out_binend[batch_idx])):
-			test_start_idx = bisect_right(hawkes_timestamps_pred, count_test_out_binend[batch_idx,dec_idx,0]-bin_size)
-			test_end_idx = bisect_right(hawkes_timestamps_pred, count_test_out_binend[batch_idx,dec_idx,0])
-			batch_times_pred.append(hawkes_timestamps_pred[test_start_idx:test_end_idx])
-		all_times_pred.append(batch_times_pred)
-	all_times_pred = np.array(all_times_pred)
-
-	all_bins_count_pred_lst = list()
-	for dec_idx in range(dec_len):
-		t_b_plus = count_test_out_binend[:,dec_idx] - bin_size
-		t_e_plus = count_test_out_binend[:,dec_idx]
-		all_bins_count_pred_lst.append(np.array(count_events(all_times_pred[:,dec_idx], t_b_plus, t_e_plus)))
-	all_bins_count_pred = np.array(all_bins_count_pred_lst).T
+	# The predicted timestamps are one sorted sequence shared by all the
+	# examples, the events of every (example, bin) are found with one
+	# searchsorted over all the bin boundaries
+	hawkes_timestamps_pred = np.asarray(hawkes_timestamps_pred)
+	bin_end = count_test_out_binend[:, :, 0]
+	test_start_idx = np.searchsorted(hawkes_timestamps_pred, bin_end-bin_size, side='right')
+	test_end_idx = np.searchsorted(hawkes_timestamps_pred, bin_end, side='right')
+
+	all_times_pred = np.empty(bin_end.shape, dtype=object)
+	for batch_idx, dec_idx in np.ndindex(bin_end.shape):
+		all_times_pred[batch_idx, dec_idx] \
+			= hawkes_timestamps_pred[test_start_idx[batch_idx, dec_idx]:test_end_idx[batch_idx, dec_idx]]
+
+	# Events of a bin are exactly those in (t_b_plus, t_e_plus]
+	all_bins_count_pred = (test_end_idx - test_start_idx)[:, :dec_len]
 
 	return all_bins_count_pred, all_times_pred
 #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%#
@@ -3227,9 +3358,10 @@ def run_rmtpp_with_optimization_fixed_cnt(args, query_models, data, test_data):
 					  test_data_init_time,
 					  events_count_per_batch,
 					  test_data_count_normalizer,
-					  test_data_rmtpp_normalizer):
+					  test_data_rmtpp_normalizer,
+					  solve_records=None):
 
-		
+		start_time = time.time()
 		model = OPT(model_cnt_distribution_params,
 					model_rmtpp_params,
 					joint_likelihood_loss,
@@ -3248,6 +3380,7 @@ def run_rmtpp_with_optimization_fixed_cnt(args, query_models, data, test_data):
 		all_bins_gaps_pred = model.gaps.numpy()
 		prev_nll, rmtpp_nll, boundary_nll = model()
 		print('Loss before optimization:', prev_nll)
+		canon_time = time.time() - start_time
 		nll = prev_nll
 		e = 0
 		#while nll<=prev_nll:
@@ -3269,6 +3402,12 @@ def run_rmtpp_with_optimization_fixed_cnt(args, query_models, data, test_data):
 				#    ipdb.set_trace()
 		
 		print('Loss after optimization:', model())
+
+		if solve_records is not None:
+			wall_time = time.time() - start_time
+			solve_records.append(get_solve_record(
+				'adam', 'max_iters', e, canon_time, wall_time - canon_time, wall_time,
+			))
 	
 		# Shape: list of 92 different length tensors
 		return all_bins_gaps_pred, prev_nll
@@ -3320,6 +3459,7 @@ def run_rmtpp_with_optimization_fixed_cnt(args, query_models, data, test_data):
 	all_times_pred_simu = all_times_pred
 	count2loss = dict()
 	count2pred = dict()
+	all_solve_records = list()
 	for nc in range(-num_counts, num_counts):
 		all_times_pred_lst = list()
 		output_event_count_curr = output_event_count_pred + nc
@@ -3413,7 +3553,7 @@ def run_rmtpp_with_optimization_fixed_cnt(args, query_models, data, test_data):
 		test_data_rmtpp_normalizer = [event_test_norma, event_test_normd]
 
 	
-	
+		solve_records = list()
 		all_bins_gaps_pred, nc_loss = optimize_gaps(model_cnt_distribution_params,
 										model_rmtpp_params,
 										joint_likelihood_loss,
@@ -3422,7 +3562,11 @@ def run_rmtpp_with_optimization_fixed_cnt(args, query_models, data, test_data):
 										test_data_init_time,
 										events_count_per_batch,
 										test_data_count_normalizer,
-										test_data_rmtpp_normalizer)
+										test_data_rmtpp_normalizer,
+										solve_records=solve_records)
+		for record in solve_records:
+			record['count_offset'] = nc
+		all_solve_records.extend(solve_records)
 	
 		all_times_pred_nc = (test_data_init_time + tf.cumsum(all_bins_gaps_pred, axis=1)) * tf.cast(all_bins_gaps_pred>0., tf.float32)
 		all_times_pred_nc = all_times_pred_nc.numpy()
@@ -3440,7 +3584,272 @@ def run_rmtpp_with_optimization_fixed_cnt(args, query_models, data, test_data):
 	ipdb.set_trace()
 	print('Best nc:', best_nc, 'Best all_times_pred', best_all_times_pred)
 
-	return None, best_all_times_pred
+	return None, best_all_times_pred, all_solve_records
+#%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%#
+
+#%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%#
+# Telemetry of the gap problem solves of the optimizer models, one record
+# (dict) per solve, written by utils.write_solver_telemetry_to_file
+def get_solve_record(solver, status, num_iters, canon_time, solve_time,
+					 wall_time, scs_fallback=False):
+	return {
+		'solver': solver,
+		'status': status,
+		'num_iters': num_iters,
+		'canon_time': canon_time,
+		'solve_time': solve_time,
+		'wall_time': wall_time,
+		'scs_fallback': scs_fallback,
+	}
+
+def solve_with_telemetry(prob, solve_records=None, **solve_kwargs):
+	'''
+		prob.solve(**solve_kwargs), retried with SCS on a SolverError.
+		If solve_records is a list, the record of the solve is appended.
+	'''
+	start_time = time.time()
+	scs_fallback = False
+	try:
+		loss = prob.solve(**solve_kwargs)
+	except cp.error.SolverError:
+		scs_fallback = True
+		loss = prob.solve(solver='SCS', **solve_kwargs)
+	wall_time = time.time() - start_time
+
+	if solve_records is not None:
+		solver_stats = prob.solver_stats
+		solve_time = solver_stats.solve_time
+		# Time cvxpy spent compiling the problem for the solver, the rest
+		# of wall_time is the solver setup and a failed first attempt
+		canon_time = getattr(prob, 'compilation_time', None)
+		if canon_time is None and solve_time is not None:
+			canon_time = wall_time - solve_time
+		solve_records.append(get_solve_record(
+			solver_stats.solver_name, prob.status, solver_stats.num_iters,
+			canon_time, solve_time, wall_time, scs_fallback,
+		))
+	return loss
+#%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%#
+
+#%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%#
+# Native solver for the per-bin gap problems of the optimizer models.
+# The RMTPP nll, mse and mse_var losses are separable and convex in the
+# gaps, so the minimizer of phi(g) + lam*g is known in closed form for any
+# shift lam. The constrained problems then reduce to monotone 1-D root
+# finding over the dual shift, solved by safeguarded Newton steps.
+# Rows of all input arrays are independent problems.
+def native_gap_loss(loss_type, gaps, D, WT):
+	if loss_type=='nll':
+		log_lambda_ = D + gaps*WT
+		return -(log_lambda_ + np.exp(D)/WT - np.exp(log_lambda_)/WT)
+	elif loss_type=='mse':
+		return np.square(gaps-D)
+	elif loss_type=='mse_var':
+		return (-np.log(1./(((2*np.pi)**0.5)*WT))
+				+ np.square(gaps-D)/(2.*np.square(WT)))
+	else:
+		assert False, "loss_type must be nll, mse or mse_var"
+
+def native_gap_loss_grad(loss_type, gaps, D, WT):
+	if loss_type=='nll':
+		return -WT + np.exp(D + gaps*WT)
+	elif loss_type=='mse':
+		return 2.*(gaps-D)
+	elif loss_type=='mse_var':
+		return (gaps-D)/np.square(WT)
+	else:
+		assert False, "loss_type must be nll, mse or mse_var"
+
+def native_gap_loss_hess(loss_type, gaps, D, WT):
+	if loss_type=='nll':
+		return WT*np.exp(D + gaps*WT)
+	elif loss_type=='mse':
+		return 2.*np.ones_like(gaps*D)
+	elif loss_type=='mse_var':
+		return np.ones_like(gaps)/np.square(WT)
+	else:
+		assert False, "loss_type must be nll, mse or mse_var"
+
+def native_gaps_given_shift(loss_type, lam, D, WT, lower):
+	'''
+		Returns argmin_{g>=lower} phi(g) + lam*g and its derivative w.r.t. lam
+	'''
+	if loss_type=='nll':
+		arg = WT - lam
+		valid = arg > 0.
+		arg = np.where(valid, arg, 1.)
+		gaps = np.where(valid, (np.log(arg)-D)/WT, -np.inf)
+		dgaps = np.where(valid, -1./(WT*arg), 0.)
+	elif loss_type=='mse':
+		gaps = D - lam/2.
+		dgaps = -0.5*np.ones_like(gaps)
+	elif loss_type=='mse_var':
+		gaps = D - lam*np.square(WT)
+		dgaps = -np.square(WT)*np.ones_like(gaps)
+	else:
+		assert False, "loss_type must be nll, mse or mse_var"
+	at_lower = (gaps <= lower)
+	gaps = np.where(at_lower, lower, gaps)
+	dgaps = np.where(at_lower, 0., dgaps)
+	return gaps, dgaps
+
+def native_find_shift(fn, target, max_iters=100, tol=1e-10, lam_init=None):
+	'''
+		Solves fn(lam) = target for every row, fn must be non-increasing
+		in lam and return (value, derivative). Rows without a root end at
+		the edge of the bracket. lam_init, if given, is a per-row guess of
+		the root (e.g. from a neighbouring problem) that the bracket and
+		the Newton steps start from.
+		Returns the roots and the number of evaluations of fn.
+	'''
+	lo = -np.ones_like(target)
+	hi = np.ones_like(target)
+	if lam_init is not None:
+		# Widen the initial bracket to contain the guess
+		lam_init = np.asarray(lam_init, dtype=np.float64) * np.ones_like(target)
+		margin = 1e-2 * (1. + np.abs(lam_init))
+		lo = np.minimum(lo, lam_init - margin)
+		hi = np.maximum(hi, lam_init + margin)
+	num_iters = 0
+	for _ in range(64):
+		val_lo, _ = fn(lo)
+		val_hi, _ = fn(hi)
+		num_iters += 2
+		grow_lo = val_lo < target
+		grow_hi = val_hi > target
+		if not (np.any(grow_lo) or np.any(grow_hi)):
+			break
+		lo = np.where(grow_lo, 2.*lo, lo)
+		hi = np.where(grow_hi, 2.*hi, hi)
+
+	if lam_init is None:
+		lam = (lo + hi) / 2.
+	else:
+		lam = np.clip(lam_init, lo, hi)
+	for _ in range(max_iters):
+		val, dval = fn(lam)
+		num_iters += 1
+		res = val - target
+		if np.all(np.abs(res) <= tol*(1.+np.abs(target))):
+			break
+		lo = np.where(res > 0., lam, lo)
+		hi = np.where(res > 0., hi, lam)
+		safe_dval = np.where(dval < 0., dval, -1.)
+		lam_newton = lam - res/safe_dval
+		use_newton = (dval < 0.) & (lam_newton > lo) & (lam_newton < hi)
+		lam = np.where(use_newton, lam_newton, (lo + hi) / 2.)
+	return lam, num_iters
+
+def native_solve_bin_gaps(loss_type, D, WT, nc, init_end_diff_norm, first_gap_lb,
+						  unconstrained=False, init_gaps=None):
+	'''
+		Native counterpart of the cvxpy problem in optimize_gaps of
+		run_rmtpp_optimizer_model, without the ratio constraints.
+		D, WT have shape (B, num_gaps), nc, init_end_diff_norm and
+		first_gap_lb have shape (B,). init_gaps, if given, is a solution
+		of a nearby problem (e.g. the same bin with another count) used to
+		warm start the shift search.
+		Returns the optimal gaps, objective, a feasibility flag per row
+		and the number of shift evaluations.
+	'''
+	num_rows, num_gaps = D.shape
+	if unconstrained:
+		gaps, _ = native_gaps_given_shift(loss_type, np.zeros_like(D), D, WT, -np.inf)
+		objective = np.sum(native_gap_loss(loss_type, gaps, D, WT), axis=1) / num_gaps
+		return gaps, objective, np.ones(num_rows, dtype=bool), 0
+
+	nc = np.asarray(nc).astype(int)
+	gap_idx = np.arange(num_gaps)[np.newaxis]
+	in_a = (gap_idx < nc[:, np.newaxis])
+	at_nc = (gap_idx == nc[:, np.newaxis])
+	lower = np.full_like(D, 1e-3)
+	lower[:, 0] = np.maximum(1e-3, first_gap_lb + 1e-2)
+
+	# sum(gaps[:nc]) <= a and sum(gaps[:nc+1]) >= b
+	a = init_end_diff_norm - 1e-2
+	b = init_end_diff_norm + 1e-2
+
+	def masked_sum(mask):
+		def fn(lam):
+			gaps, dgaps = native_gaps_given_shift(loss_type, lam[:, np.newaxis], D, WT, lower)
+			return np.sum(gaps*mask, axis=1), np.sum(dgaps*mask, axis=1)
+		return fn
+
+	zeros = np.zeros(num_rows)
+	sum_a_0, _ = masked_sum(in_a)(zeros)
+	gap_nc_0, _ = masked_sum(at_nc)(zeros)
+
+	# The gaps of a solution above their lower bound share the shift
+	# -phi'(g), the median over gaps[:nc] ignores the gap that moved
+	# in or out of the count.
+	lam_init = None
+	if init_gaps is not None:
+		init_gaps = np.asarray(init_gaps, dtype=np.float64)
+		init_shift = -native_gap_loss_grad(loss_type, init_gaps, D, WT)
+		init_free = in_a & (init_gaps > lower + 1e-6)
+		lam_init = np.array([
+			np.median(shift[free]) if np.any(free) else 0.
+			for shift, free in zip(init_shift, init_free)
+		])
+
+	# Only first constraint active: shared shift on gaps[:nc]
+	lam_a, iters_a = native_find_shift(masked_sum(in_a), a, lam_init=lam_init)
+	# Only second constraint active: shared shift on gaps[:nc+1]
+	lam_b, iters_b = native_find_shift(masked_sum(in_a | at_nc), b, lam_init=lam_init)
+	sum_a_b, _ = masked_sum(in_a)(lam_b)
+	# Both active: gaps[nc] = b-a, which is above its lower bound
+	row_idx = np.arange(num_rows)
+	lam_nc = -native_gap_loss_grad(loss_type, b-a, D[row_idx, nc], WT[row_idx, nc])
+
+	none_active = (sum_a_0 <= a) & (sum_a_0 + gap_nc_0 >= b)
+	only_a = (sum_a_0 > a) & (a + gap_nc_0 >= b)
+	only_b = (sum_a_0 + gap_nc_0 < b) & (sum_a_b <= a)
+	lam_first = np.select([none_active, only_a, only_b], [zeros, lam_a, lam_b], lam_a)
+	lam_last = np.select([none_active, only_a, only_b], [zeros, zeros, lam_b], lam_nc)
+
+	lam = (in_a * lam_first[:, np.newaxis]) + (at_nc * lam_last[:, np.newaxis])
+	gaps, _ = native_gaps_given_shift(loss_type, lam, D, WT, lower)
+	objective = np.sum(native_gap_loss(loss_type, gaps, D, WT), axis=1) / num_gaps
+
+	feasible = np.sum(lower*in_a, axis=1) <= a
+	objective = np.where(feasible, objective, np.inf)
+	return gaps, objective, feasible, iters_a + iters_b
+
+def native_solve_comp_gaps(loss_type, D, WT, D_comp, WT_comp, sum_scale):
+	'''
+		Native counterpart of the cvxpy problem in optimize_gaps of
+		run_rmtpp_optimizer_model_comp:
+			min sum(psi(sum_scale*sum(g))) + len(D_comp)*sum(phi(g))/num_gaps
+			s.t. g >= 0
+		D, WT have shape (B, num_gaps), D_comp, WT_comp have shape
+		(B, num_comp) and sum_scale has shape (B,).
+		Returns the optimal gaps, objective and the number of shift
+		evaluations.
+	'''
+	num_rows, num_gaps = D.shape
+	num_comp = D_comp.shape[1]
+	weight = num_comp / num_gaps
+	lower = np.zeros_like(D)
+
+	# Stationarity: weight*phi'(g_i) + sum_scale*psi'(sum_scale*s) = 0, so
+	# every gap sees the same shift lam = sum_scale*psi'(.)/weight.
+	def shift_residual(lam):
+		gaps, dgaps = native_gaps_given_shift(loss_type, lam[:, np.newaxis], D, WT, lower)
+		comp_gaps = (sum_scale*np.sum(gaps, axis=1))[:, np.newaxis]
+		dcomp_gaps = (sum_scale*np.sum(dgaps, axis=1))[:, np.newaxis]
+		grad_comp = np.sum(native_gap_loss_grad(loss_type, comp_gaps, D_comp, WT_comp), axis=1)
+		hess_comp = np.sum(native_gap_loss_hess(loss_type, comp_gaps, D_comp, WT_comp)
+						   * dcomp_gaps, axis=1)
+		res = sum_scale*grad_comp/weight - lam
+		dres = sum_scale*hess_comp/weight - 1.
+		return res, dres
+
+	lam, num_iters = native_find_shift(shift_residual, np.zeros(num_rows))
+	gaps, _ = native_gaps_given_shift(loss_type, lam[:, np.newaxis], D, WT, lower)
+	comp_gaps = (sum_scale*np.sum(gaps, axis=1))[:, np.newaxis]
+	objective = (np.sum(native_gap_loss(loss_type, comp_gaps, D_comp, WT_comp), axis=1)
+				 + weight*np.sum(native_gap_loss(loss_type, gaps, D, WT), axis=1))
+	return gaps, objective, num_iters
 #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%#
 
 #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%#
@@ -3450,6 +3859,14 @@ def run_rmtpp_with_optimization_fixed_cnt(args, query_models, data, test_data):
 # by using solver library
 # Select the final count as the count that produces best rmtpp_loss across
 # all counts
+
+# Per-example search closure of run_rmtpp_optimizer_model, set before the
+# optimizer pool forks so that the workers can reach it.
+_opt_search_example = None
+
+def _opt_search_worker(task):
+	return _opt_search_example(*task)
+
 def run_rmtpp_optimizer_model(
 	args,
 	query_models,
@@ -3505,6 +3922,80 @@ def run_rmtpp_optimizer_model(
 	def mse_loglikelihood_loss(gaps, D, WT, events_count_per_batch):
 		return -(cp.log(1/(((2*np.pi)**0.5)*WT)) - (((gaps - D)**2) / (2*(WT)**2)))
 
+	# Compiled cvxpy problems keyed by (count, num_gaps, loss type, ratio flag).
+	# Every per-example input of the problem is a cp.Parameter so that a
+	# repeated solve only updates parameter values instead of re-building
+	# and re-canonicalizing the whole problem.
+	opt_problems_cache = dict()
+
+	def get_opt_loss_type():
+		if rmtpp_type=='mse' and not args.extra_var_model:
+			return 'mse'
+		elif rmtpp_type=='nll':
+			return 'nll'
+		else:
+			return 'mse_var'
+
+	def get_opt_problem(nc, num_gaps, unconstrained):
+		use_ratio = (unconstrained==False and args.use_ratio_constraints)
+		loss_type = get_opt_loss_type()
+		key = (nc, num_gaps, loss_type, unconstrained, use_ratio)
+		if key in opt_problems_cache:
+			return opt_problems_cache[key]
+
+		shape = (1, num_gaps)
+		gaps = cp.Variable(shape)
+		params = dict()
+		if loss_type=='nll':
+			# log_f_star = D + g*WT + exp(D)/WT - exp(D + g*WT)/WT, with
+			# exp(D)/WT and D-log(WT) precomputed to keep the problem DPP.
+			params['D'] = cp.Parameter(shape)
+			params['WT'] = cp.Parameter(shape, nonneg=True)
+			params['D_log_WT'] = cp.Parameter(shape)
+			params['exp_D_by_WT'] = cp.Parameter(shape)
+			log_f_star = (params['D'] + cp.multiply(gaps, params['WT'])
+						  + params['exp_D_by_WT']
+						  - cp.exp(params['D_log_WT'] + cp.multiply(gaps, params['WT'])))
+			opt_loss = -cp.sum(log_f_star)/num_gaps
+		elif loss_type=='mse':
+			params['D'] = cp.Parameter(shape)
+			opt_loss = cp.sum(cp.power(gaps-params['D'], 2))/num_gaps
+		else:
+			# (g-D)^2/(2*WT^2) written as (g*s - D*s)^2 with s = 1/(sqrt(2)*WT)
+			params['scale'] = cp.Parameter(shape, nonneg=True)
+			params['D_scale'] = cp.Parameter(shape)
+			params['log_norm'] = cp.Parameter(shape)
+			opt_loss = cp.sum(
+				params['log_norm']
+				+ cp.power(cp.multiply(gaps, params['scale'])-params['D_scale'], 2)
+			)/num_gaps
+
+		params['init_end_diff_norm'] = cp.Parameter()
+		params['first_gap_lb'] = cp.Parameter()
+		constraints = [cp.sum(gaps[0, :nc])<=params['init_end_diff_norm']-1e-2,
+					   cp.sum(gaps[0, :nc+1])>=params['init_end_diff_norm']+1e-2,
+					   gaps[0, 0]>=params['first_gap_lb']+1e-2,
+					   gaps>=1e-3]
+
+		if use_ratio:
+			params['gaps_uc_cumsum'] = cp.Parameter(max(nc, 1))
+			gaps_uc_cumsum = params['gaps_uc_cumsum']
+			for j in range(nc-1):
+				constraints.append(
+					(
+						(cp.sum(gaps[0, :j+1])*gaps_uc_cumsum[j+1])
+						== (cp.sum(gaps[0, :j+2])*gaps_uc_cumsum[j])
+					)
+				)
+
+		if unconstrained:
+			prob = cp.Problem(cp.Minimize(opt_loss))
+		else:
+			prob = cp.Problem(cp.Minimize(opt_loss), constraints)
+
+		opt_problems_cache[key] = (prob, gaps, params, opt_loss, loss_type)
+		return opt_problems_cache[key]
+
 	def optimize_gaps(model_rmtpp_params,
 					  rmtpp_loglikelihood_loss,
 					  model_cnt_distribution_params,
@@ -3517,30 +4008,22 @@ def run_rmtpp_optimizer_model(
 					  test_data_rmtpp_normalizer,
 					  test_data_out_gaps_bin_batch,
 					  unconstrained=False,
-					  gaps_uc=None):
-
-		gaps = cp.Variable(all_bins_gaps_pred.shape)
-		gaps.value = all_bins_gaps_pred
-
-		D, WT = model_rmtpp_params[0], model_rmtpp_params[1]
+					  gaps_uc=None,
+					  init_gaps=None,
+					  solve_info=None):
+		'''
+		init_gaps: normalized gaps of a solved neighbouring count of the
+			same bin, used to warm start the native solver.
+		solve_info: if a dict, receives the normalized gaps of the solver
+			('gaps', all num_gaps of them), its iteration count ('num_iters')
+			and the telemetry records of the solves ('solve_records').
+		'''
+		solve_records = list()
+
+		D = np.array(model_rmtpp_params[0], dtype=np.float64)
+		WT = np.array(model_rmtpp_params[1], dtype=np.float64)
 		#print(all_bins_gaps_pred.shape, D.shape, WT.shape)
 
-		if rmtpp_type=='nll':
-			opt_loss = -cp.sum(rmtpp_loglikelihood_loss(gaps, D, WT, events_count_per_batch))/all_bins_gaps_pred.shape[1]
-		elif rmtpp_type=='mse':
-			if args.extra_var_model:
-				opt_loss = cp.sum(mse_loglikelihood_loss(gaps, D, WT, events_count_per_batch))/all_bins_gaps_pred.shape[1]
-			else:
-				WT = np.ones_like(WT)
-				opt_loss = cp.sum(mse_loss(gaps, D, WT, events_count_per_batch))/all_bins_gaps_pred.shape[1]
-		elif rmtpp_type=='mse_var':
-			opt_loss = cp.sum(mse_loglikelihood_loss(gaps, D, WT, events_count_per_batch))/all_bins_gaps_pred.shape[1]
-
-		rmtpp_loss_cont = opt_loss.value
-
-		objective = cp.Minimize(opt_loss)
-
-
 		test_norm_a, test_norm_d = test_data_rmtpp_normalizer
 		init_end_diff = all_bins_end_time-test_data_init_time
 		init_end_diff_norm = utils.normalize_avg_given_param(
@@ -3553,57 +4036,116 @@ def run_rmtpp_optimizer_model(
 			test_norm_a,
 			test_norm_d
 		)
-		constraints = [cp.sum(gaps[0, :nc])<=init_end_diff_norm-1e-2,
-					   cp.sum(gaps[0, :nc+1])>=init_end_diff_norm+1e-2,
-					   gaps[0, 0]>=first_gap_lb+1e-2,
-					   gaps>=1e-3]
+		init_end_diff_norm = np.array(init_end_diff_norm, dtype=np.float64).reshape(-1)[0]
+		first_gap_lb = np.array(first_gap_lb, dtype=np.float64).reshape(-1)[0]
 
-		if unconstrained==False and args.use_ratio_constraints:
-			assert gaps_uc is not None
-			for j in range(nc-1):
-				constraints.append(
-					(
-						(cp.sum(gaps[0, :j+1])*cp.sum(gaps_uc[0, :j+2]))
-						== (cp.sum(gaps[0, :j+2])*cp.sum(gaps_uc[0, :j+1]))
-					)
-				)
+		def solve_cvxpy():
+			prob, gaps, params, opt_loss, loss_type = get_opt_problem(
+				nc, all_bins_gaps_pred.shape[1], unconstrained
+			)
+			gaps.value = np.array(all_bins_gaps_pred, dtype=np.float64)
+
+			if loss_type=='nll':
+				params['D'].value = D
+				params['WT'].value = WT
+				params['D_log_WT'].value = D - np.log(WT)
+				params['exp_D_by_WT'].value = np.exp(D) / WT
+			elif loss_type=='mse':
+				params['D'].value = D
+			else:
+				scale = 1. / ((2.**0.5) * WT)
+				params['scale'].value = scale
+				params['D_scale'].value = D * scale
+				params['log_norm'].value = -np.log(1. / (((2*np.pi)**0.5) * WT))
+
+			params['init_end_diff_norm'].value = init_end_diff_norm
+			params['first_gap_lb'].value = first_gap_lb
+
+			if 'gaps_uc_cumsum' in params:
+				assert gaps_uc is not None
+				gaps_uc_cumsum = np.cumsum(np.array(gaps_uc, dtype=np.float64)[0])
+				num_uc = params['gaps_uc_cumsum'].shape[0]
+				if len(gaps_uc_cumsum) < num_uc:
+					gaps_uc_cumsum = np.pad(gaps_uc_cumsum, (0, num_uc-len(gaps_uc_cumsum)), mode='edge')
+				params['gaps_uc_cumsum'].value = gaps_uc_cumsum[:num_uc]
+
+			rmtpp_loss_cont = opt_loss.value
+
+			# The compiled problem is shared across examples, so solver-side
+			# warm starts are disabled to keep every solve independent of the
+			# order in which examples are processed.
+			rmtpp_loss = solve_with_telemetry(prob, solve_records, warm_start=False)
+			#rmtpp_loss = prob.solve(warm_start=True, solver=cp.OSQP)
+
+			#if gaps.value is None:
+			#	gaps.value = all_bins_gaps_pred
+			#	rmtpp_loss = opt_loss.value
+			if gaps.value is None:
+				import ipdb
+				ipdb.set_trace()
 
-		if unconstrained:
-			prob = cp.Problem(objective)
+			num_iters = prob.solver_stats.num_iters
+			return gaps.value, rmtpp_loss, rmtpp_loss_cont, (num_iters or 0)
+
+		def solve_native():
+			loss_type = get_opt_loss_type()
+			start_time = time.time()
+			gaps_value, rmtpp_loss, feasible, num_iters = native_solve_bin_gaps(
+				loss_type, D, WT,
+				np.array([nc]),
+				np.array([init_end_diff_norm]),
+				np.array([first_gap_lb]),
+				unconstrained=unconstrained,
+				init_gaps=init_gaps,
+			)
+			solve_time = time.time() - start_time
+			solve_records.append(get_solve_record(
+				'native', 'optimal' if feasible[0] else 'infeasible', num_iters,
+				0., solve_time, solve_time,
+			))
+			rmtpp_loss_cont = np.sum(native_gap_loss(
+				loss_type, np.array(all_bins_gaps_pred, dtype=np.float64), D, WT
+			)) / D.shape[1]
+			return gaps_value, rmtpp_loss[0], rmtpp_loss_cont, num_iters
+
+		# Ratio constraints are not separable, those problems stay on cvxpy
+		use_native = (args.opt_solver=='native'
+					  and (unconstrained or not args.use_ratio_constraints))
+		if use_native:
+			gaps_value, rmtpp_loss, rmtpp_loss_cont, num_iters = solve_native()
+			if args.opt_solver_check_tol > 0.:
+				_, rmtpp_loss_cvx, _, _ = solve_cvxpy()
+				if (np.abs(rmtpp_loss - rmtpp_loss_cvx)
+					> args.opt_solver_check_tol * (1. + np.abs(rmtpp_loss_cvx))):
+					print('Native solver mismatch for count', nc, ':',
+						  rmtpp_loss, 'vs cvxpy', rmtpp_loss_cvx)
 		else:
-			prob = cp.Problem(objective, constraints)
+			gaps_value, rmtpp_loss, rmtpp_loss_cont, num_iters = solve_cvxpy()
 
-		try:
-			rmtpp_loss = prob.solve(warm_start=True)
-		except cp.error.SolverError:
-			rmtpp_loss = prob.solve(solver='SCS', warm_start=True)
-		#rmtpp_loss = prob.solve(warm_start=True, solver=cp.OSQP)
+		if solve_info is not None:
+			solve_info['gaps'] = np.array(gaps_value, dtype=np.float64)
+			solve_info['num_iters'] = num_iters
+			solve_info['solve_records'] = solve_records
 
 		rmtpp_loss_opt = rmtpp_loss
-		#if gaps.value is None:
-		#	gaps.value = all_bins_gaps_pred
-		#	rmtpp_loss = opt_loss.value
 
 		count_test_normm, count_test_norms = test_data_count_normalizer
 		nc_norm = utils.normalize_data_given_param(nc, count_test_normm, count_test_norms)
 		mu, sigma = model_cnt_distribution_params[0], model_cnt_distribution_params[1]
-		count_loss = -tfp.distributions.Normal(
-				mu, sigma, validate_args=False, allow_nan_stats=True,
-				name='Normal'
-			).log_prob(nc_norm)
+		# Gaussian negative log-likelihood computed in numpy so that
+		# optimize_gaps can run in optimizer worker processes.
+		count_loss = (0.5*np.square((nc_norm-mu)/sigma)
+					  + np.log(sigma) + 0.5*np.log(2.*np.pi))
 		count_loss = np.sum(count_loss)
 
 		#import ipdb
 		#ipdb.set_trace()
 
 
-		if gaps.value is None:
-			import ipdb
-			ipdb.set_trace()
 		#loss = rmtpp_loss + count_loss
 		loss = rmtpp_loss + count_loss
 
-		all_bins_gaps_pred = gaps.value[0:1, :nc]
+		all_bins_gaps_pred = gaps_value[0:1, :nc]
 		#print('Loss after optimization:', loss)
 	
 		# Shape: list of 92 different length tensors
@@ -3662,53 +4204,92 @@ def run_rmtpp_optimizer_model(
 	#full_cnt_event_all_bins_pred += event_count_preds_stddev
 
 
-	def get_optimized_gaps(
+	# RMTPP outputs used by get_optimized_gaps, keyed by
+	# (batch_idx, dec_idx, max_cnt). The model inputs only depend on the
+	# simulated events up to max_cnt and not on the candidate count, so a
+	# single forward pass serves every count evaluated by the search.
+	rmtpp_params_cache = dict()
+
+	def get_rmtpp_params(
 		batch_idx,
 		dec_idx,
-		curr_cnt,
+		example,
 		max_cnt,
 		best_past_cnt,
-		bin_start,
 		batch_times_pred,
 		batch_types_pred,
-		unconstrained=False,
-		gaps_uc=None
 	):
 
-		event_cnt = best_past_cnt + int(max_cnt)+1
-		output_event_count_curr = np.zeros_like(output_event_count_pred) + max_cnt+1
-
-		batch_bin_curr_cnt_times_pred = all_times_pred_simu[batch_idx,best_past_cnt:event_cnt]
-		batch_bin_curr_cnt_types_pred = all_types_pred_simu[batch_idx,best_past_cnt:event_cnt]
-		#batch_bin_curr_cnt_types_pred = np.squeeze(batch_bin_curr_cnt_types_pred, axis=-1)
-
-		batch_bin_curr_cnt_times_pred_scaled = batch_bin_curr_cnt_times_pred.numpy()
+		key = (batch_idx, dec_idx, int(max_cnt))
+		if key in rmtpp_params_cache:
+			return rmtpp_params_cache[key]
 
+		event_cnt = best_past_cnt + int(max_cnt)+1
+		batch_bin_curr_cnt_times_pred = example['times_simu'][best_past_cnt:event_cnt]
+		batch_bin_curr_cnt_types_pred = example['types_simu'][best_past_cnt:event_cnt]
 
 		if dec_idx == 0:
-			batch_temp_times_pred = [batch_bin_curr_cnt_times_pred_scaled]
+			batch_temp_times_pred = [batch_bin_curr_cnt_times_pred]
 			batch_temp_types_pred = [batch_bin_curr_cnt_types_pred]
 		else:
-			batch_temp_times_pred = batch_times_pred[:dec_idx]
-			batch_temp_types_pred = batch_types_pred[:dec_idx]
-			batch_temp_times_pred.append(batch_bin_curr_cnt_times_pred_scaled)
+			batch_temp_times_pred = list(batch_times_pred[:dec_idx])
+			batch_temp_types_pred = list(batch_types_pred[:dec_idx])
+			batch_temp_times_pred.append(batch_bin_curr_cnt_times_pred)
 			batch_temp_types_pred.append(batch_bin_curr_cnt_types_pred)
 
+		batch_temp_times_pred_flatten = np.concatenate(
+			[np.reshape(times, -1) for times in batch_temp_times_pred]
+		).astype(np.float64)
+		batch_temp_types_pred_flatten = np.concatenate(
+			[np.reshape(types, -1) for types in batch_temp_types_pred]
+		)
+		batch_temp_gaps_pred_unnorm = np.diff(
+			np.concatenate(
+				[np.reshape(test_data_init_time[batch_idx], -1)[-1:],
+				 batch_temp_times_pred_flatten]
+			)
+		)[np.newaxis]
 
 		if args.no_rescale_rmtpp_params:
-			D = D_pred[batch_idx:batch_idx+1]
-			WT = WT_pred[batch_idx:batch_idx+1]
+			D = example['D'][np.newaxis]
+			WT = example['WT'][np.newaxis]
 		else:
-			_, D, WT, _, batch_input_final_state = model_rmtpp(
+			# Teacher-force the past bins and the simulated events of the
+			# current bin after the input sequence of the example.
+			enc_len = test_data_input_gaps_bin.shape[1]
+			num_temp = batch_temp_times_pred_flatten.shape[0]
+			batch_temp_gaps_pred = utils.normalize_avg_given_param(
+				batch_temp_gaps_pred_unnorm,
+				event_test_norma,
+				event_test_normd
+			)
+			batch_temp_gaps_pred = np.concatenate(
+				[test_data_input_gaps_bin[batch_idx:batch_idx+1],
+				 np.expand_dims(batch_temp_gaps_pred, axis=-1)],
+				axis=1
+			).astype(np.float32)
+			batch_temp_feats_pred = np.concatenate(
+				[event_test_in_feats[batch_idx:batch_idx+1],
+				 np.expand_dims(
+					get_time_features(np.expand_dims(batch_temp_times_pred_flatten, axis=-1)),
+					axis=0
+				 )],
+				axis=1
+			).astype(np.float32)
+			batch_temp_types_pred = np.concatenate(
+				[event_test_in_types[batch_idx:batch_idx+1],
+				 np.expand_dims(batch_temp_types_pred_flatten, axis=0)],
+				axis=1
+			).astype(np.int64)
+			_, _, D, WT, _ = model_rmtpp(
 				batch_temp_gaps_pred,
 				batch_temp_feats_pred,
-				initial_state=input_final_state
+				batch_temp_types_pred,
 			)
+			D = np.asarray(D)[:, enc_len-1:enc_len-1+num_temp]
+			WT = np.asarray(WT)[:, enc_len-1:enc_len-1+num_temp]
 
 		if args.extra_var_model and rmtpp_type=='mse':
-			batch_temp_times_pred_flatten \
-				= np.concatenate(batch_temp_times_pred)
-
 			batch_temp_times_pred_flatten = np.expand_dims(
 				batch_temp_times_pred_flatten,
 				axis=0
@@ -3737,17 +4318,52 @@ def run_rmtpp_optimizer_model(
 
 			rmtpp_var_input = tf.cumsum(batch_temp_gaps_pred_unnorm, axis=1)
 			WT = rmtpp_var_model(rmtpp_var_input, bin_ids, grp_ids, pos_ids)
-			WT = tf.expand_dims(WT, axis=0)
+			WT = np.asarray(tf.expand_dims(WT, axis=0))
+
+		rmtpp_params_cache[key] = (D, WT)
+		return rmtpp_params_cache[key]
+
+	def get_optimized_gaps(
+		batch_idx,
+		dec_idx,
+		example,
+		curr_cnt,
+		max_cnt,
+		best_past_cnt,
+		bin_start,
+		batch_times_pred,
+		batch_types_pred,
+		unconstrained=False,
+		gaps_uc=None,
+		init_gaps=None,
+		solve_info=None,
+	):
+
+		event_cnt = best_past_cnt + int(max_cnt)+1
+		output_event_count_curr = np.zeros_like(output_event_count_pred) + max_cnt+1
 
-		batch_bin_curr_cnt_D_pred = D[:, best_past_cnt:event_cnt, 0].numpy()
-		batch_bin_curr_cnt_WT_pred = WT[:, best_past_cnt:event_cnt, 0].numpy()
+		batch_bin_curr_cnt_types_pred = example['types_simu'][best_past_cnt:event_cnt]
+		#batch_bin_curr_cnt_types_pred = np.squeeze(batch_bin_curr_cnt_types_pred, axis=-1)
+
+		D, WT = get_rmtpp_params(
+			batch_idx,
+			dec_idx,
+			example,
+			max_cnt,
+			best_past_cnt,
+			batch_times_pred,
+			batch_types_pred,
+		)
+
+		batch_bin_curr_cnt_D_pred = np.asarray(D[:, best_past_cnt:event_cnt, 0])
+		batch_bin_curr_cnt_WT_pred = np.asarray(WT[:, best_past_cnt:event_cnt, 0])
 
 		model_rmtpp_params = [batch_bin_curr_cnt_D_pred, batch_bin_curr_cnt_WT_pred]
-		model_count_params = [model_cnt_distribution_params[0][batch_idx, dec_idx],
-							  model_cnt_distribution_params[1][batch_idx, dec_idx]]
+		model_count_params = [example['count_mu'][dec_idx],
+							  example['count_sigma'][dec_idx]]
 
 		bin_size = args.bin_size
-		batch_bin_end_time = tf.squeeze(count_test_out_binend[batch_idx:batch_idx+1, dec_idx:dec_idx+1].astype(np.float32), axis=-1)
+		batch_bin_end_time = np.squeeze(count_test_out_binend[batch_idx:batch_idx+1, dec_idx:dec_idx+1].astype(np.float32), axis=-1)
 		batch_bin_start_time = batch_bin_end_time - bin_size
 		batch_bin_mid_time = (batch_bin_start_time+batch_bin_end_time)/2.
 
@@ -3781,7 +4397,9 @@ def run_rmtpp_optimizer_model(
 							test_data_rmtpp_normalizer,
 							test_data_out_gaps_bin_batch,
 							unconstrained=unconstrained,
-							gaps_uc=gaps_uc)
+							gaps_uc=gaps_uc,
+							init_gaps=init_gaps,
+							solve_info=solve_info)
 
 		batch_bin_curr_cnt_opt_gaps_pred = utils.denormalize_avg(batch_bin_curr_cnt_opt_gaps_pred,
 												event_test_norma,
@@ -3796,10 +4414,10 @@ def run_rmtpp_optimizer_model(
 		#	= ((test_data_init_time_batch + tf.cast(tf.cumsum(batch_bin_curr_cnt_opt_gaps_pred, axis=1), tf.float64))
 		#	   * tf.cast(batch_bin_curr_cnt_opt_gaps_pred>0., tf.float64))
 		batch_bin_curr_cnt_opt_gaps_pred \
-			= batch_bin_curr_cnt_opt_gaps_pred * tf.cast(batch_bin_curr_cnt_opt_gaps_pred>0., tf.float64)
+			= batch_bin_curr_cnt_opt_gaps_pred * (batch_bin_curr_cnt_opt_gaps_pred>0.).astype(np.float64)
 		batch_bin_curr_cnt_opt_times_pred \
-			= (test_data_init_time_batch + tf.cast(tf.cumsum(batch_bin_curr_cnt_opt_gaps_pred, axis=1), tf.float64))
-		batch_bin_curr_cnt_opt_times_pred = batch_bin_curr_cnt_opt_times_pred[0].numpy()
+			= (test_data_init_time_batch + np.cumsum(batch_bin_curr_cnt_opt_gaps_pred, axis=1).astype(np.float64))
+		batch_bin_curr_cnt_opt_times_pred = batch_bin_curr_cnt_opt_times_pred[0]
 
 		return (
 			batch_bin_curr_cnt_opt_times_pred,
@@ -3912,179 +4530,179 @@ def run_rmtpp_optimizer_model(
 		return all_tps_adjst, all_typs_adjst, D_pred_adjst, WT_pred_adjst
 
 
-	count_sigma = args.opt_num_counts
-	all_times_pred = [[] for _ in range(len(test_data_input_gaps_bin))]
-	all_types_pred = [[] for _ in range(len(test_data_input_gaps_bin))]
-	all_counts_pred = [[] for _ in range(len(test_data_input_gaps_bin))]
-	all_sigms_pred = [[] for _ in range(len(test_data_input_gaps_bin))]
-	all_best_opt_nc_losses = [[] for _ in range(len(test_data_input_gaps_bin))]
-	all_best_cont_nc_losses = [[] for _ in range(len(test_data_input_gaps_bin))]
-	all_best_nc_count_losses = [[] for _ in range(len(test_data_input_gaps_bin))]
-	all_best_cnt = [0 for _ in range(len(test_data_input_gaps_bin))]
-	for dec_idx in range(dec_len):
-		#event_cnt=0
-		#best_past_cnt=0
-
-		if dec_idx == 0:
-			(
-				all_gaps_pred_simu, all_times_pred_simu, all_types_pred_simu,
-				D_pred, WT_pred
-			) = simulate_with_counter(
-				model_rmtpp, 
-				test_data_init_time, 
-				test_data_input_gaps_bin,
-				event_test_in_feats,
-				event_test_in_types,
-				full_cnt_event_all_bins_pred,
-				(event_test_norma,
-				event_test_normd),
-			)
-		else:
-			all_times_pred_simu, all_types_pred_simu, D_pred, WT_pred = resimulate(
-				model_rmtpp, test_data_init_time, test_data_input_gaps_bin,
-				all_times_pred, all_types_pred,
-				(event_test_norma, event_test_normd),
-				all_best_cnt, dec_idx,
-			)
+	def search_example(batch_idx, dec_idx, example, bin_start):
 
-		for batch_idx in range(len(all_times_pred_simu)):
+		print(batch_idx, dec_idx)
 
-			print(batch_idx, dec_idx)
+		best_past_cnt = example['best_past_cnt']
 
-			best_past_cnt = all_best_cnt[batch_idx]
+		batch_times_pred = example['times_pred']
+		batch_types_pred = example['types_pred']
 
-			batch_times_pred = all_times_pred[batch_idx]
-			batch_types_pred = all_types_pred[batch_idx]
-			batch_best_opt_nc_losses = all_best_opt_nc_losses[batch_idx]
-			batch_best_cont_nc_losses = all_best_cont_nc_losses[batch_idx]
-			batch_best_nc_count_losses = all_best_nc_count_losses[batch_idx]
+		clipped_stddev = np.clip(event_count_preds_stddev[batch_idx, dec_idx], 1.0, count_sigma)
+		min_cnt = event_count_preds_cnt[batch_idx, dec_idx] - clipped_stddev
+		min_cnt = int(np.maximum(1., min_cnt))
+		max_cnt = int(event_count_preds_cnt[batch_idx, dec_idx] + clipped_stddev)
 
-			clipped_stddev = np.clip(event_count_preds_stddev[batch_idx, dec_idx], 1.0, count_sigma)
-			min_cnt = event_count_preds_cnt[batch_idx, dec_idx] - clipped_stddev
-			min_cnt = int(np.maximum(1., min_cnt))
-			max_cnt = int(event_count_preds_cnt[batch_idx, dec_idx] + clipped_stddev)
 
+		search_stats = {'memo_hits': 0, 'memo_misses': 0,
+						'num_solves': 0, 'solver_iters': 0,
+						'truncated': 0, 'search_time': 0.}
 
-			if dec_idx == 0:
-				gaps_before_bin = all_times_pred_simu[batch_idx,:1] - test_data_init_time[batch_idx]
-				gaps_before_bin = gaps_before_bin * np.random.uniform(size=gaps_before_bin.shape)
-				bin_start = test_data_init_time[batch_idx] + gaps_before_bin
-			else:
-				gaps_before_bin = (all_times_pred_simu[batch_idx, best_past_cnt]
-								   - all_times_pred_simu[batch_idx, best_past_cnt-1])
-				gaps_before_bin = gaps_before_bin * np.random.uniform(size=gaps_before_bin.shape)
-				bin_start = all_times_pred_simu[batch_idx, best_past_cnt-1] + gaps_before_bin
+		# Wall-clock budget of this bin's search, None for no limit. It is
+		# checked between solves, the count search always completes at
+		# least one solve and then returns the best count found so far.
+		search_start = time.time()
+		time_budget = example['time_budget']
+		def time_up():
+			return (time_budget is not None
+					and time.time() - search_start > time_budget)
+		solve_records = list()
+		def add_solve_stats(solve_info, curr_cnt, unconstrained=False):
+			search_stats['num_solves'] += 1
+			search_stats['solver_iters'] += solve_info['num_iters']
+			for record in solve_info['solve_records']:
+				record.update({
+					'batch_idx': batch_idx, 'dec_idx': dec_idx,
+					'count': curr_cnt, 'unconstrained': unconstrained,
+				})
+				solve_records.append(record)
 
-			#TODO Add flag for rescaling
+		#TODO Add flag for rescaling
 
-			if args.no_rescale_rmtpp_params:	
-				# 1. Get number of peaks in the bin by solving unconstrained problem
-				# 2. Change the nc_range based on num_peaks_in_bin and mu
-				# 3. use gaps_uc solution if args.use_ratio_constraints is True
-				(
-					batch_bin_cnrr_cnt_opt_times_pred_uc, 
-					batch_bin_curr_cnt_opt_gaps_pred_uc,
-					batch_bin_curr_cnt_opt_types_pred,
-					batch_bin_curr_cnt_opt_sigms,
-					nc_loss,
-					nc_loss_opt,
-					nc_loss_cont,
-					nc_count_loss,
-				) = get_optimized_gaps(
+		if args.no_rescale_rmtpp_params:	
+			# 1. Get number of peaks in the bin by solving unconstrained problem
+			# 2. Change the nc_range based on num_peaks_in_bin and mu
+			# 3. use gaps_uc solution if args.use_ratio_constraints is True
+			solve_info = dict()
+			(
+				batch_bin_cnrr_cnt_opt_times_pred_uc, 
+				batch_bin_curr_cnt_opt_gaps_pred_uc,
+				batch_bin_curr_cnt_opt_types_pred,
+				batch_bin_curr_cnt_opt_sigms,
+				nc_loss,
+				nc_loss_opt,
+				nc_loss_cont,
+				nc_count_loss,
+			) = get_optimized_gaps(
+				batch_idx,
+				dec_idx,
+				example,
+				max_cnt,
+				max_cnt,
+				best_past_cnt,
+				bin_start,
+				batch_times_pred,
+				batch_types_pred,
+				unconstrained=True,
+				solve_info=solve_info,
+			)
+			add_solve_stats(solve_info, max_cnt, unconstrained=True)
+			bs = count_test_out_binend[batch_idx, dec_idx] - args.bin_size
+			be = count_test_out_binend[batch_idx, dec_idx]
+			bs_cnt = bisect_right(batch_bin_cnrr_cnt_opt_times_pred_uc, bs)
+			be_cnt = bisect_right(batch_bin_cnrr_cnt_opt_times_pred_uc, be)
+			num_peaks_in_bin = np.maximum(be_cnt - bs_cnt, 1)
+			if num_peaks_in_bin <= event_count_preds_cnt[batch_idx, dec_idx]:
+				min_cnt = int(num_peaks_in_bin)
+				max_cnt = int(event_count_preds_cnt[batch_idx, dec_idx])
+			else:
+				min_cnt = int(event_count_preds_cnt[batch_idx, dec_idx])
+				max_cnt = int(num_peaks_in_bin)
+
+			if args.use_ratio_constraints:
+				gaps_uc = batch_bin_curr_cnt_opt_gaps_pred_uc
+				gaps_uc = utils.normalize_avg_given_param(
+					gaps_uc,
+					event_test_norma,
+					event_test_normd
+				)
+			else:
+				gaps_uc = None
+		else:
+			gaps_uc = None
+
+		#min_cnt = dataset['count_test_out_counts'][batch_idx, dec_idx]
+		#max_cnt = min_cnt
+		if inference_model_name in ['rmtpp_mse_coopt', 'rmtpp_mse_var_coopt']:
+			min_cnt = int(event_count_preds_cnt[batch_idx, dec_idx])
+			max_cnt = int(event_count_preds_cnt[batch_idx, dec_idx])
+		if args.search == 1:
+			min_cnt = int(event_count_preds_cnt[batch_idx, dec_idx] - event_count_preds_stddev[batch_idx, dec_idx])
+			max_cnt = int(event_count_preds_cnt[batch_idx, dec_idx] + event_count_preds_stddev[batch_idx, dec_idx])
+		nc_range = np.arange(min_cnt, max_cnt+1)
+
+		# Memo of count -> get_optimized_gaps output for this (example, dec_idx)
+		# so that no count is solved twice, binary_search revisits neighbours.
+		# With --opt_warm_start each new count starts from the solution of
+		# the nearest count solved so far, the gaps for count k+1 being
+		# close to those for count k.
+		count_memo = dict()
+		count_solved_gaps = dict()
+		def get_optimized_gaps_memo(curr_cnt):
+			curr_cnt = int(curr_cnt)
+			if curr_cnt in count_memo:
+				search_stats['memo_hits'] += 1
+			else:
+				search_stats['memo_misses'] += 1
+				init_gaps = None
+				if args.opt_warm_start and count_solved_gaps:
+					near_cnt = min(count_solved_gaps, key=lambda cnt: abs(cnt-curr_cnt))
+					init_gaps = count_solved_gaps[near_cnt]
+				solve_info = dict()
+				count_memo[curr_cnt] = get_optimized_gaps(
 					batch_idx,
 					dec_idx,
-					max_cnt,
+					example,
+					curr_cnt,
 					max_cnt,
 					best_past_cnt,
 					bin_start,
 					batch_times_pred,
 					batch_types_pred,
-					unconstrained=True,
-				)
-				bs = count_test_out_binend[batch_idx, dec_idx] - args.bin_size
-				be = count_test_out_binend[batch_idx, dec_idx]
-				bs_cnt = bisect_right(batch_bin_cnrr_cnt_opt_times_pred_uc, bs)
-				be_cnt = bisect_right(batch_bin_cnrr_cnt_opt_times_pred_uc, be)
-				num_peaks_in_bin = np.maximum(be_cnt - bs_cnt, 1)
-				if num_peaks_in_bin <= event_count_preds_cnt[batch_idx, dec_idx]:
-					min_cnt = int(num_peaks_in_bin)
-					max_cnt = int(event_count_preds_cnt[batch_idx, dec_idx])
-				else:
-					min_cnt = int(event_count_preds_cnt[batch_idx, dec_idx])
-					max_cnt = int(num_peaks_in_bin)
-
-				if args.use_ratio_constraints:
-					gaps_uc = batch_bin_curr_cnt_opt_gaps_pred_uc
-					gaps_uc = utils.normalize_avg_given_param(
-						gaps_uc,
-						event_test_norma,
-						event_test_normd
-					)
-				else:
-					gaps_uc = None
-			else:
-				gaps_uc = None
-
-			#min_cnt = dataset['count_test_out_counts'][batch_idx, dec_idx]
-			#max_cnt = min_cnt
-			if inference_model_name in ['rmtpp_mse_coopt', 'rmtpp_mse_var_coopt']:
-				min_cnt = int(event_count_preds_cnt[batch_idx, dec_idx])
-				max_cnt = int(event_count_preds_cnt[batch_idx, dec_idx])
-			if args.search == 1:
-				min_cnt = int(event_count_preds_cnt[batch_idx, dec_idx] - event_count_preds_stddev[batch_idx, dec_idx])
-				max_cnt = int(event_count_preds_cnt[batch_idx, dec_idx] + event_count_preds_stddev[batch_idx, dec_idx])
-			nc_range = np.arange(min_cnt, max_cnt+1)
-			def linear_search(counts_range, low, high):
-				nc_loss_min = np.inf
-				for mid_1 in range(len(counts_range)):
-					(
-						batch_bin_curr_cnt_opt_times_pred_mid_1,
-						batch_bin_curr_cnt_opt_gaps_pred_mid_1,
-						batch_bin_curr_cnt_opt_types_pred_mid_1,
-						batch_bin_curr_cnt_opt_sigms_mid_1,
-						nc_loss_mid_1,
-						nc_loss_mid_1_opt,
-						nc_loss_mid_1_cont,
-						nc_count_loss_mid_1,
-					) = get_optimized_gaps(
-						batch_idx,
-						dec_idx,
-						counts_range[mid_1],
-						max_cnt,
-						best_past_cnt,
-						bin_start,
-						batch_times_pred,
-						batch_types_pred,
-						gaps_uc=gaps_uc,
-					)
-					if nc_loss_mid_1 <= nc_loss_min:
-						min_c = mid_1,
-						nc_loss_min = nc_loss_mid_1
-						batch_bin_curr_cnt_opt_times_pred_min = batch_bin_curr_cnt_opt_times_pred_mid_1
-						batch_bin_curr_cnt_opt_gaps_pred_min = batch_bin_curr_cnt_opt_gaps_pred_mid_1
-						batch_bin_curr_cnt_opt_types_pred_min = batch_bin_curr_cnt_opt_types_pred_mid_1
-						batch_bin_curr_cnt_opt_sigms_min = batch_bin_curr_cnt_opt_sigms_mid_1
-						nc_loss_min_opt = nc_loss_mid_1_opt
-						nc_loss_min_cont = nc_loss_mid_1_cont
-						nc_count_loss_min = nc_count_loss_mid_1
-
-				return (
-					min_c,
-					nc_loss_min,
-					batch_bin_curr_cnt_opt_times_pred_min,
-					batch_bin_curr_cnt_opt_gaps_pred_min,
-					batch_bin_curr_cnt_opt_types_pred_min,
-					batch_bin_curr_cnt_opt_sigms_min,
-					counts_range[min_c],
-					nc_loss_min_opt,
-					nc_loss_min_cont,
-					nc_count_loss_min,
+					gaps_uc=gaps_uc,
+					init_gaps=init_gaps,
+					solve_info=solve_info,
 				)
-			def binary_search(counts_range, low, high):
-				# print('low=', low, 'high=', high)
+				count_solved_gaps[curr_cnt] = solve_info['gaps']
+				add_solve_stats(solve_info, curr_cnt)
+			return count_memo[curr_cnt]
+
+		def best_solved_count(counts_range):
+			# Result of the search over the counts solved so far
+			best_nc_loss, best_idx = min(
+				(count_memo[int(cnt)][4], idx) for idx, cnt in enumerate(counts_range)
+				if int(cnt) in count_memo
+			)
+			(
+				batch_bin_curr_cnt_opt_times_pred_best,
+				batch_bin_curr_cnt_opt_gaps_pred_best,
+				batch_bin_curr_cnt_opt_types_pred_best,
+				batch_bin_curr_cnt_opt_sigms_best,
+				nc_loss_best,
+				nc_loss_best_opt,
+				nc_loss_best_cont,
+				nc_count_loss_best,
+			) = count_memo[int(counts_range[best_idx])]
+			return (
+				best_idx,
+				nc_loss_best,
+				batch_bin_curr_cnt_opt_times_pred_best,
+				batch_bin_curr_cnt_opt_gaps_pred_best,
+				batch_bin_curr_cnt_opt_types_pred_best,
+				batch_bin_curr_cnt_opt_sigms_best,
+				counts_range[best_idx],
+				nc_loss_best_opt,
+				nc_loss_best_cont,
+				nc_count_loss_best,
+			)
 
-				mid_1 = (low + high) // 2
-				mid_2 = mid_1 + 1
+		def linear_search(counts_range, low, high):
+			nc_loss_min = np.inf
+			for mid_1 in range(len(counts_range)):
+				if mid_1 > 0 and time_up():
+					search_stats['truncated'] = 1
+					break
 				(
 					batch_bin_curr_cnt_opt_times_pred_mid_1,
 					batch_bin_curr_cnt_opt_gaps_pred_mid_1,
@@ -4094,101 +4712,248 @@ def run_rmtpp_optimizer_model(
 					nc_loss_mid_1_opt,
 					nc_loss_mid_1_cont,
 					nc_count_loss_mid_1,
-				) = get_optimized_gaps(
-					batch_idx,
-					dec_idx,
+				) = get_optimized_gaps_memo(counts_range[mid_1])
+				if nc_loss_mid_1 <= nc_loss_min:
+					min_c = mid_1,
+					nc_loss_min = nc_loss_mid_1
+					batch_bin_curr_cnt_opt_times_pred_min = batch_bin_curr_cnt_opt_times_pred_mid_1
+					batch_bin_curr_cnt_opt_gaps_pred_min = batch_bin_curr_cnt_opt_gaps_pred_mid_1
+					batch_bin_curr_cnt_opt_types_pred_min = batch_bin_curr_cnt_opt_types_pred_mid_1
+					batch_bin_curr_cnt_opt_sigms_min = batch_bin_curr_cnt_opt_sigms_mid_1
+					nc_loss_min_opt = nc_loss_mid_1_opt
+					nc_loss_min_cont = nc_loss_mid_1_cont
+					nc_count_loss_min = nc_count_loss_mid_1
+
+			return (
+				min_c,
+				nc_loss_min,
+				batch_bin_curr_cnt_opt_times_pred_min,
+				batch_bin_curr_cnt_opt_gaps_pred_min,
+				batch_bin_curr_cnt_opt_types_pred_min,
+				batch_bin_curr_cnt_opt_sigms_min,
+				counts_range[min_c],
+				nc_loss_min_opt,
+				nc_loss_min_cont,
+				nc_count_loss_min,
+			)
+		def binary_search(counts_range, low, high):
+			# print('low=', low, 'high=', high)
+
+			if count_memo and time_up():
+				search_stats['truncated'] = 1
+				return best_solved_count(counts_range)
+
+			mid_1 = (low + high) // 2
+			mid_2 = mid_1 + 1
+			(
+				batch_bin_curr_cnt_opt_times_pred_mid_1,
+				batch_bin_curr_cnt_opt_gaps_pred_mid_1,
+				batch_bin_curr_cnt_opt_types_pred_mid_1,
+				batch_bin_curr_cnt_opt_sigms_mid_1,
+				nc_loss_mid_1,
+				nc_loss_mid_1_opt,
+				nc_loss_mid_1_cont,
+				nc_count_loss_mid_1,
+			) = get_optimized_gaps_memo(counts_range[mid_1])
+
+			if high > low:
+				(
+					batch_bin_curr_cnt_opt_times_pred_mid_2,
+					batch_bin_curr_cnt_opt_gaps_pred_mid_2,
+					batch_bin_curr_cnt_opt_types_pred_mid_2,
+					batch_bin_curr_cnt_opt_sigms_mid_2,
+					nc_loss_mid_2,
+					nc_loss_mid2_opt,
+					nc_loss_mid2_cont,
+					nc_count_loss_mid_2,
+				) = get_optimized_gaps_memo(counts_range[mid_2])
+
+				if nc_loss_mid_1 < nc_loss_mid_2:
+					high = mid_1
+				elif nc_loss_mid_1 > nc_loss_mid_2:
+					low = mid_2
+
+				return binary_search(counts_range, low, high)
+
+			elif high == low:
+				return (
+					mid_1,
+					nc_loss_mid_1,
+					batch_bin_curr_cnt_opt_times_pred_mid_1,
+					batch_bin_curr_cnt_opt_gaps_pred_mid_1,
+					batch_bin_curr_cnt_opt_types_pred_mid_1,
+					batch_bin_curr_cnt_opt_sigms_mid_1,
 					counts_range[mid_1],
-					max_cnt,
-					best_past_cnt,
-					bin_start,
-					batch_times_pred,
-					batch_types_pred,
-					gaps_uc=gaps_uc,
+					nc_loss_mid_1_opt,
+					nc_loss_mid_1_cont,
+					nc_count_loss_mid_1,
 				)
 
-				if high > low:
-					(
-						batch_bin_curr_cnt_opt_times_pred_mid_2,
-						batch_bin_curr_cnt_opt_gaps_pred_mid_2,
-						batch_bin_curr_cnt_opt_types_pred_mid_2,
-						batch_bin_curr_cnt_opt_sigms_mid_2,
-						nc_loss_mid_2,
-						nc_loss_mid2_opt,
-						nc_loss_mid2_cont,
-						nc_count_loss_mid_2,
-					) = get_optimized_gaps(
-						batch_idx,
-						dec_idx,
-						counts_range[mid_2],
-						max_cnt,
-						best_past_cnt,
-						bin_start,
-						batch_times_pred,
-						batch_types_pred,
-						gaps_uc=gaps_uc,
-					)
+		if args.search == 0:
+			(
+				best_nc_idx, best_nc_loss,
+				batch_bin_times_pred, batch_bin_gaps_pred,
+				batch_bin_types_pred, batch_bin_sigms_pred,
+				best_count, best_nc_loss_opt, best_nc_loss_cont,
+				best_nc_count_loss,
+			) = binary_search(nc_range, 0, len(nc_range)-1)
+		elif args.search == 1:
+			(
+				best_nc_idx, best_nc_loss,
+				batch_bin_times_pred, batch_bin_gaps_pred,
+				batch_bin_types_pred, batch_bin_sigms_pred,
+				best_count, best_nc_loss_opt, best_nc_loss_cont,
+				best_nc_count_loss,
+			) = linear_search(nc_range, 0, len(nc_range)-1)
 
-					if nc_loss_mid_1 < nc_loss_mid_2:
-						high = mid_1
-					elif nc_loss_mid_1 > nc_loss_mid_2:
-						low = mid_2
-
-					return binary_search(counts_range, low, high)
-
-				elif high == low:
-					return (
-						mid_1,
-						nc_loss_mid_1,
-						batch_bin_curr_cnt_opt_times_pred_mid_1,
-						batch_bin_curr_cnt_opt_gaps_pred_mid_1,
-						batch_bin_curr_cnt_opt_types_pred_mid_1,
-						batch_bin_curr_cnt_opt_sigms_mid_1,
-						counts_range[mid_1],
-						nc_loss_mid_1_opt,
-						nc_loss_mid_1_cont,
-						nc_count_loss_mid_1,
-					)
+		search_stats['search_time'] = time.time() - search_start
 
-			if args.search == 0:
+		return (
+			batch_bin_times_pred, batch_bin_types_pred, best_count,
+			batch_bin_sigms_pred, best_nc_loss_opt, best_nc_loss_cont,
+			best_nc_count_loss, search_stats, solve_records,
+		)
+
+	count_dist_mu = np.asarray(model_cnt_distribution_params[0])
+	count_dist_sigma = np.asarray(model_cnt_distribution_params[1])
+
+	count_sigma = args.opt_num_counts
+	all_times_pred = [[] for _ in range(len(test_data_input_gaps_bin))]
+	all_types_pred = [[] for _ in range(len(test_data_input_gaps_bin))]
+	all_counts_pred = [[] for _ in range(len(test_data_input_gaps_bin))]
+	all_sigms_pred = [[] for _ in range(len(test_data_input_gaps_bin))]
+	all_best_opt_nc_losses = [[] for _ in range(len(test_data_input_gaps_bin))]
+	all_best_cont_nc_losses = [[] for _ in range(len(test_data_input_gaps_bin))]
+	all_best_nc_count_losses = [[] for _ in range(len(test_data_input_gaps_bin))]
+	all_opt_search_stats = dict()
+	all_best_cnt = [0 for _ in range(len(test_data_input_gaps_bin))]
+	all_search_time = [0. for _ in range(len(test_data_input_gaps_bin))]
+	all_solve_records = list()
+
+	def get_time_budget(batch_idx):
+		# Search budget of the next bin of the example, None for no limit
+		time_budget = None
+		if args.opt_bin_time_budget > 0.:
+			time_budget = args.opt_bin_time_budget
+		if args.opt_example_time_budget > 0.:
+			example_time_left = max(args.opt_example_time_budget - all_search_time[batch_idx], 0.)
+			time_budget = (example_time_left if time_budget is None
+						   else min(time_budget, example_time_left))
+		return time_budget
+
+	# Per-example searches are independent given the simulated D/WT, so they
+	# can be spread over a pool of forked workers. The pool is only used on
+	# the no-rescale path because the rescale path runs the RMTPP model
+	# inside the search.
+	num_workers = max(1, args.opt_num_workers)
+	if num_workers > 1 and (not args.no_rescale_rmtpp_params or args.extra_var_model):
+		print('opt_num_workers > 1 requires --no_rescale_rmtpp_params and no --extra_var_model,',
+			  'falling back to serial search')
+		num_workers = 1
+	opt_pool = None
+	if num_workers > 1:
+		global _opt_search_example
+		_opt_search_example = search_example
+		opt_pool = multiprocessing.get_context('fork').Pool(num_workers)
+
+	try:
+		for dec_idx in range(dec_len):
+			#event_cnt=0
+			#best_past_cnt=0
+			rmtpp_params_cache.clear()
+
+			if dec_idx == 0:
 				(
-					best_nc_idx, best_nc_loss,
-					batch_bin_times_pred, batch_bin_gaps_pred,
-					batch_bin_types_pred, batch_bin_sigms_pred,
-					best_count, best_nc_loss_opt, best_nc_loss_cont,
-					best_nc_count_loss,
-				) = binary_search(nc_range, 0, len(nc_range)-1)
-			elif args.search == 1:
+					all_gaps_pred_simu, all_times_pred_simu, all_types_pred_simu,
+					D_pred, WT_pred
+				) = simulate_with_counter(
+					model_rmtpp, 
+					test_data_init_time, 
+					test_data_input_gaps_bin,
+					event_test_in_feats,
+					event_test_in_types,
+					full_cnt_event_all_bins_pred,
+					(event_test_norma,
+					event_test_normd),
+				)
+			else:
+				all_times_pred_simu, all_types_pred_simu, D_pred, WT_pred = resimulate(
+					model_rmtpp, test_data_init_time, test_data_input_gaps_bin,
+					all_times_pred, all_types_pred,
+					(event_test_norma, event_test_normd),
+					all_best_cnt, dec_idx,
+				)
+
+			examples = list()
+			for batch_idx in range(len(all_times_pred_simu)):
+				best_past_cnt = all_best_cnt[batch_idx]
+				example = {
+					'times_simu': np.asarray(all_times_pred_simu[batch_idx]),
+					'types_simu': np.asarray(all_types_pred_simu[batch_idx]),
+					'D': np.asarray(D_pred[batch_idx]),
+					'WT': np.asarray(WT_pred[batch_idx]),
+					'count_mu': count_dist_mu[batch_idx],
+					'count_sigma': count_dist_sigma[batch_idx],
+					'best_past_cnt': best_past_cnt,
+					'times_pred': all_times_pred[batch_idx],
+					'types_pred': all_types_pred[batch_idx],
+					'time_budget': get_time_budget(batch_idx),
+				}
+
+				# bin_start is drawn here so that the random stream is the
+				# same for the serial and the pooled search.
+				if dec_idx == 0:
+					gaps_before_bin = example['times_simu'][:1] - test_data_init_time[batch_idx]
+					gaps_before_bin = gaps_before_bin * np.random.uniform(size=gaps_before_bin.shape)
+					bin_start = test_data_init_time[batch_idx] + gaps_before_bin
+				else:
+					gaps_before_bin = (example['times_simu'][best_past_cnt]
+									   - example['times_simu'][best_past_cnt-1])
+					gaps_before_bin = gaps_before_bin * np.random.uniform(size=gaps_before_bin.shape)
+					bin_start = example['times_simu'][best_past_cnt-1] + gaps_before_bin
+
+				examples.append((batch_idx, dec_idx, example, bin_start))
+
+			if opt_pool is None:
+				examples_results = [search_example(*task) for task in examples]
+			else:
+				examples_results = opt_pool.map(_opt_search_worker, examples)
+
+			for batch_idx, example_result in enumerate(examples_results):
 				(
-					best_nc_idx, best_nc_loss,
-					batch_bin_times_pred, batch_bin_gaps_pred,
-					batch_bin_types_pred, batch_bin_sigms_pred,
-					best_count, best_nc_loss_opt, best_nc_loss_cont,
-					best_nc_count_loss,
-				) = linear_search(nc_range, 0, len(nc_range)-1)
-
-			#batch_times_pred.append(batch_bin_times_pred)
-			#batch_best_opt_nc_losses.append(best_nc_loss_opt)
-			#batch_best_cont_nc_losses.append(best_nc_loss_cont)
-			#batch_best_nc_count_losses.append(best_nc_count_loss)
-			#best_past_cnt += best_count
-
-			all_times_pred[batch_idx].append(batch_bin_times_pred)
-			all_types_pred[batch_idx].append(batch_bin_types_pred)
-			all_counts_pred[batch_idx].append(best_count)
-			all_sigms_pred[batch_idx].append(batch_bin_sigms_pred)
-			all_best_opt_nc_losses[batch_idx].append(best_nc_loss_opt)
-			all_best_cont_nc_losses[batch_idx].append(best_nc_loss_cont)
-			all_best_nc_count_losses[batch_idx].append(best_nc_count_loss)
-			all_best_cnt[batch_idx] += best_count
-
-			#print('Example:', batch_idx, 'dec_idx:', dec_idx, 'Best count:', \
-			#	best_count, 'Mean:', event_count_preds_cnt[batch_idx, dec_idx])
-
-		#batch_times_pred = [t for bin_list in batch_times_pred for t in bin_list]
-		#all_times_pred.append(batch_times_pred)
-		#all_best_opt_nc_losses.append(batch_best_opt_nc_losses)
-		#all_best_cont_nc_losses.append(batch_best_cont_nc_losses)
-		#all_best_nc_count_losses.append(batch_best_nc_count_losses)
+					batch_bin_times_pred, batch_bin_types_pred, best_count,
+					batch_bin_sigms_pred, best_nc_loss_opt, best_nc_loss_cont,
+					best_nc_count_loss, search_stats, solve_records,
+				) = example_result
+
+				all_times_pred[batch_idx].append(batch_bin_times_pred)
+				all_types_pred[batch_idx].append(batch_bin_types_pred)
+				all_counts_pred[batch_idx].append(best_count)
+				all_sigms_pred[batch_idx].append(batch_bin_sigms_pred)
+				all_best_opt_nc_losses[batch_idx].append(best_nc_loss_opt)
+				all_best_cont_nc_losses[batch_idx].append(best_nc_loss_cont)
+				all_best_nc_count_losses[batch_idx].append(best_nc_count_loss)
+				for stat_name, stat_val in search_stats.items():
+					if stat_name not in all_opt_search_stats:
+						all_opt_search_stats[stat_name] = [[] for _ in range(len(test_data_input_gaps_bin))]
+					all_opt_search_stats[stat_name][batch_idx].append(stat_val)
+				all_best_cnt[batch_idx] += best_count
+				all_search_time[batch_idx] += search_stats['search_time']
+				all_solve_records.extend(solve_records)
+
+				#print('Example:', batch_idx, 'dec_idx:', dec_idx, 'Best count:', \
+				#	best_count, 'Mean:', event_count_preds_cnt[batch_idx, dec_idx])
+
+			#batch_times_pred = [t for bin_list in batch_times_pred for t in bin_list]
+			#all_times_pred.append(batch_times_pred)
+			#all_best_opt_nc_losses.append(batch_best_opt_nc_losses)
+			#all_best_cont_nc_losses.append(batch_best_cont_nc_losses)
+			#all_best_nc_count_losses.append(batch_best_nc_count_losses)
+	finally:
+		# terminate also stops the workers when the search raises
+		if opt_pool is not None:
+			opt_pool.terminate()
+			opt_pool.join()
 
 	all_times_pred = np.array(all_times_pred)
 	all_types_pred = np.array(all_types_pred)
@@ -4197,10 +4962,24 @@ def run_rmtpp_optimizer_model(
 	all_best_opt_nc_losses = np.array(all_best_opt_nc_losses)
 	all_best_cont_nc_losses = np.array(all_best_cont_nc_losses)
 	all_best_nc_count_losses = np.array(all_best_nc_count_losses)
+	all_opt_search_stats = {
+		stat_name: np.array(stat_val) for stat_name, stat_val in all_opt_search_stats.items()
+	}
+	if 'memo_hits' in all_opt_search_stats:
+		print('Optimizer count memo hits:', np.sum(all_opt_search_stats['memo_hits']),
+			  'misses:', np.sum(all_opt_search_stats['memo_misses']))
+	if 'num_solves' in all_opt_search_stats:
+		print('Optimizer solver iterations per solve:',
+			  np.sum(all_opt_search_stats['solver_iters'])
+			  / max(np.sum(all_opt_search_stats['num_solves']), 1))
+	if 'truncated' in all_opt_search_stats:
+		print('Optimizer searches truncated by the time budget:',
+			  np.sum(all_opt_search_stats['truncated']),
+			  'of', all_opt_search_stats['truncated'].size)
 
 	all_types_pred_flatten = []
 	for seq in all_types_pred:
-		seq = [s.numpy().tolist() for s in seq]
+		seq = [np.asarray(s).tolist() for s in seq]
 		all_types_pred_flatten.append(np.array(flatten(seq)))
 	all_types_pred = np.array(all_types_pred_flatten)
 
@@ -4232,7 +5011,8 @@ def run_rmtpp_optimizer_model(
 	return (
 		all_times_pred, all_types_pred, all_counts_pred,
 		event_dist_params, count_dist_params,
-		all_best_opt_nc_losses, all_best_cont_nc_losses, all_best_nc_count_losses
+		all_best_opt_nc_losses, all_best_cont_nc_losses, all_best_nc_count_losses,
+		all_opt_search_stats, all_solve_records,
 	)
 #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%#
 
@@ -4324,62 +5104,98 @@ def run_rmtpp_optimizer_model_comp(
 					  comp_bin_sz,
 					  test_data_init_time,
 					  test_data_rmtpp_normalizer,
-					  test_data_rmtpp_normalizer_comp):
+					  test_data_rmtpp_normalizer_comp,
+					  solve_records=None):
 
 		D, WT = model_rmtpp_params[0][:,:comp_bin_sz], model_rmtpp_params[1][:,:comp_bin_sz]
 		D_comp, WT_comp = model_rmtpp_params_comp[0].numpy(), model_rmtpp_params_comp[1].numpy()
 
-		gaps = cp.Variable(D.shape)
-		gaps.value = D
-
 		test_norm_a, test_norm_d = test_data_rmtpp_normalizer
 		test_norm_a_comp, test_norm_d_comp = test_data_rmtpp_normalizer_comp
 
-		gaps_sum = utils.normalize_avg_given_param(
-			utils.denormalize_avg(
-				cp.sum(gaps),
-				test_norm_a,
-				test_norm_d,
-			),
-			test_norm_a_comp,
-			test_norm_d_comp,
-		)
+		def solve_cvxpy():
+			gaps = cp.Variable(D.shape)
+			gaps.value = D
 
-		if rmtpp_type=='nll':
-			#WT = np.minimum(WT, ETH)
-			opt_loss = cp.sum(rmtpp_loglikelihood_loss(gaps_sum, D_comp, WT_comp) + \
-					cp.sum(rmtpp_loglikelihood_loss(gaps, D, WT))/D.shape[1])
-		elif rmtpp_type=='mse':
-			if args.extra_var_model:
-				opt_loss = cp.sum(mse_loglikelihood_loss(cp.sum(gaps), D_comp, WT_comp) + \
+			gaps_sum = utils.normalize_avg_given_param(
+				utils.denormalize_avg(
+					cp.sum(gaps),
+					test_norm_a,
+					test_norm_d,
+				),
+				test_norm_a_comp,
+				test_norm_d_comp,
+			)
+
+			if rmtpp_type=='nll':
+				#WT = np.minimum(WT, ETH)
+				opt_loss = cp.sum(rmtpp_loglikelihood_loss(gaps_sum, D_comp, WT_comp) + \
+						cp.sum(rmtpp_loglikelihood_loss(gaps, D, WT))/D.shape[1])
+			elif rmtpp_type=='mse':
+				if args.extra_var_model:
+					opt_loss = cp.sum(mse_loglikelihood_loss(cp.sum(gaps), D_comp, WT_comp) + \
+						cp.sum(mse_loglikelihood_loss(gaps, D, WT))/D.shape[1])
+				else:
+					opt_loss = cp.sum(mse_loss(gaps_sum, D_comp, WT_comp) + \
+							cp.sum(mse_loss(gaps, D, np.ones_like(WT)))/D.shape[1])
+			elif rmtpp_type=='mse_var':
+				opt_loss = cp.sum(mse_loglikelihood_loss(gaps_sum, D_comp, WT_comp) + \
 					cp.sum(mse_loglikelihood_loss(gaps, D, WT))/D.shape[1])
-			else:
-				WT = np.ones_like(WT)
-				opt_loss = cp.sum(mse_loss(gaps_sum, D_comp, WT_comp) + \
-						cp.sum(mse_loss(gaps, D, WT))/D.shape[1])
-		elif rmtpp_type=='mse_var':
-			opt_loss = cp.sum(mse_loglikelihood_loss(gaps_sum, D_comp, WT_comp) + \
-				cp.sum(mse_loglikelihood_loss(gaps, D, WT))/D.shape[1])
 
-		objective = cp.Minimize(opt_loss)
+			objective = cp.Minimize(opt_loss)
 
-		constraints = [gaps>=0]
+			constraints = [gaps>=0]
 
-		prob = cp.Problem(objective, constraints)
+			prob = cp.Problem(objective, constraints)
 
-		try:
-			rmtpp_loss = prob.solve(warm_start=True)
-		except cp.error.SolverError:
-			rmtpp_loss = prob.solve(solver='SCS', warm_start=True)
+			rmtpp_loss = solve_with_telemetry(prob, solve_records, warm_start=True)
 
-		#if gaps.value is None:
-		#	gaps.value = all_bins_gaps_pred[:,:comp_bin_sz]
-		#	rmtpp_loss = opt_loss.value
+			#if gaps.value is None:
+			#	gaps.value = all_bins_gaps_pred[:,:comp_bin_sz]
+			#	rmtpp_loss = opt_loss.value
 
-		#import ipdb
-		#ipdb.set_trace()
+			#import ipdb
+			#ipdb.set_trace()
+
+			return gaps.value, rmtpp_loss
 
-		all_bins_gaps_pred = gaps.value[0:1, :comp_bin_sz]
+		def solve_native():
+			if rmtpp_type=='nll':
+				loss_type, sum_scale = 'nll', test_norm_d / test_norm_d_comp
+			elif rmtpp_type=='mse' and not args.extra_var_model:
+				loss_type, sum_scale = 'mse', test_norm_d / test_norm_d_comp
+			elif rmtpp_type=='mse':
+				# extra_var model compares the unscaled sum of gaps
+				loss_type, sum_scale = 'mse_var', 1.
+			else:
+				loss_type, sum_scale = 'mse_var', test_norm_d / test_norm_d_comp
+			start_time = time.time()
+			gaps_value, rmtpp_loss, num_iters = native_solve_comp_gaps(
+				loss_type,
+				np.array(D, dtype=np.float64),
+				np.array(WT, dtype=np.float64),
+				np.array(D_comp, dtype=np.float64).reshape(1, -1),
+				np.array(WT_comp, dtype=np.float64).reshape(1, -1),
+				np.array([sum_scale], dtype=np.float64).reshape(-1),
+			)
+			if solve_records is not None:
+				solve_time = time.time() - start_time
+				solve_records.append(get_solve_record(
+					'native', 'optimal', num_iters, 0., solve_time, solve_time,
+				))
+			return gaps_value, rmtpp_loss[0]
+
+		if args.opt_solver=='native':
+			gaps_value, rmtpp_loss = solve_native()
+			if args.opt_solver_check_tol > 0.:
+				_, rmtpp_loss_cvx = solve_cvxpy()
+				if (np.abs(rmtpp_loss - rmtpp_loss_cvx)
+					> args.opt_solver_check_tol * (1. + np.abs(rmtpp_loss_cvx))):
+					print('Native solver mismatch:', rmtpp_loss, 'vs cvxpy', rmtpp_loss_cvx)
+		else:
+			gaps_value, rmtpp_loss = solve_cvxpy()
+
+		all_bins_gaps_pred = gaps_value[0:1, :comp_bin_sz]
 		#print('Loss after optimization:', rmtpp_loss)
 	
 		return all_bins_gaps_pred, rmtpp_loss
@@ -4442,6 +5258,7 @@ def run_rmtpp_optimizer_model_comp(
 	all_types_pred = [[] for _ in range(len(test_data_input_gaps_bin))]
 	all_sigms_pred = [[] for _ in range(len(test_data_input_gaps_bin))]
 	all_best_cnt = [0 for _ in range(len(test_data_input_gaps_bin))]
+	all_solve_records = list()
 	#import ipdb
 	#ipdb.set_trace()
 	for dec_idx in range(all_times_pred_comp.shape[1]):
@@ -4483,6 +5300,7 @@ def run_rmtpp_optimizer_model_comp(
 				#ipdb.set_trace()
 	
 		
+				solve_records = list()
 				batch_bin_curr_cnt_opt_gaps_pred, nc_loss \
 					= optimize_gaps(model_rmtpp_params,
 									model_rmtpp_params_comp,
@@ -4490,7 +5308,11 @@ def run_rmtpp_optimizer_model_comp(
 									comp_bin_sz,
 									test_data_init_time_batch,
 									test_data_rmtpp_normalizer,
-									test_data_rmtpp_normalizer_comp)
+									test_data_rmtpp_normalizer_comp,
+									solve_records=solve_records)
+				for record in solve_records:
+					record.update({'batch_idx': batch_idx, 'dec_idx': dec_idx})
+				all_solve_records.extend(solve_records)
 				batch_bin_curr_cnt_opt_gaps_pred = utils.denormalize_avg(batch_bin_curr_cnt_opt_gaps_pred,
 														event_test_norma,
 														event_test_normd)
@@ -4553,7 +5375,7 @@ def run_rmtpp_optimizer_model_comp(
 
 	return (
 		all_times_pred, all_types_pred, all_counts_pred,
-		event_dist_params, count_dist_params,
+		event_dist_params, count_dist_params, all_solve_records,
 	)
 #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%#
 
@@ -4858,12 +5680,94 @@ def run_transformer_simulation(
 #####################################################
 # 				Utils Functions						#
 #####################################################
+def pad_event_seqs(all_event_seqs):
+	'''
+		Pads a batch of ragged event sequences with +inf into one array.
+		Returns (padded, lengths, is_sorted, all_event_seqs), rows that
+		are not sorted are searched with bisect_right on the original
+		sequence.
+	'''
+	all_event_seqs = [np.ravel(np.asarray(seq)) for seq in all_event_seqs]
+	lengths = np.array([len(seq) for seq in all_event_seqs], dtype=np.int64)
+	nonempty_seqs = [seq for seq in all_event_seqs if len(seq)]
+	dtype = np.result_type(*nonempty_seqs) if nonempty_seqs else np.float64
+	if not np.issubdtype(dtype, np.floating):
+		dtype = np.float64
+
+	max_len = max(int(lengths.max(initial=0)), 1)
+	padded = np.full((len(all_event_seqs), max_len), np.inf, dtype=dtype)
+	if nonempty_seqs:
+		padded[np.arange(max_len) < lengths[:, None]] = np.concatenate(nonempty_seqs)
+	is_sorted = np.all(padded[:, 1:] >= padded[:, :-1], axis=1)
+	return padded, lengths, is_sorted, all_event_seqs
+
+def search_event_seqs(padded_seqs, t):
+	'''
+		bisect_right(all_event_seqs[idx], t[idx]) for every sequence of
+		a batch padded by pad_event_seqs, t is of shape (batch,) or
+		(batch, 1).
+	'''
+	padded, _, is_sorted, all_event_seqs = padded_seqs
+	t = np.reshape(np.asarray(t), (len(padded),))
+	indices = np.sum(padded <= t[:, None], axis=1)
+	for idx in np.where(~is_sorted)[0]:
+		indices[idx] = bisect_right(all_event_seqs[idx], t[idx])
+	return indices
+
+def trim_padded_event_seqs(padded_seqs, t_b_plus, t_e_plus):
+	'''
+		Events of each sequence in (t_b_plus, t_e_plus], left aligned and
+		zero padded, along with their counts.
+	'''
+	padded = padded_seqs[0]
+	idx_tb = search_event_seqs(padded_seqs, t_b_plus)
+	idx_te = search_event_seqs(padded_seqs, t_e_plus)
+	counts = np.maximum(idx_te - idx_tb, 0)
+	max_cnt = max(int(counts.max(initial=0)), 1)
+	positions = np.minimum(idx_tb[:, None] + np.arange(max_cnt), padded.shape[1]-1)
+	trimmed = np.take_along_axis(padded, positions, axis=1)
+	trimmed = np.where(np.arange(max_cnt) < counts[:, None], trimmed, 0)
+	return trimmed, counts
+
+def segment_sums(values, lengths):
+	'''
+		np.sum(values[idx, :lengths[idx]]) for every row. Rows of the same
+		length are reduced together so each row keeps the summation order
+		of np.sum over it.
+	'''
+	sums = np.zeros(len(values), dtype=values.dtype)
+	order = np.argsort(lengths, kind='stable')
+	group_lengths, group_starts = np.unique(lengths[order], return_index=True)
+	group_ends = np.append(group_starts[1:], len(order))
+	for length, start, end in zip(group_lengths, group_starts, group_ends):
+		rows = order[start:end]
+		sums[rows] = np.sum(values[rows, :length], axis=1)
+	return sums
+
 def count_events(all_times_pred, t_b_plus, t_e_plus):
-	times_out_indices_tb = [bisect_right(t_out, t_b) for t_out, t_b in zip(all_times_pred, t_b_plus)]
-	times_out_indices_te = [bisect_right(t_out, t_e) for t_out, t_e in zip(all_times_pred, t_e_plus)]
-	event_count_preds = [times_out_indices_te[idx] - times_out_indices_tb[idx] for idx in range(len(t_b_plus))]
+	padded_seqs = pad_event_seqs(all_times_pred)
+	times_out_indices_tb = search_event_seqs(padded_seqs, t_b_plus)
+	times_out_indices_te = search_event_seqs(padded_seqs, t_e_plus)
+	event_count_preds = (times_out_indices_te - times_out_indices_tb).tolist()
 	return event_count_preds
 
+def count_events_grid(padded_seqs, t_b_plus, t_e_plus):
+	'''
+		count_events for a grid of intervals, t_b_plus and t_e_plus are
+		(rows x points) arrays. Every sorted sequence is searched once
+		with np.searchsorted for all its interval boundaries.
+	'''
+	padded, _, is_sorted, all_event_seqs = padded_seqs
+	num_points = t_b_plus.shape[1]
+	queries = np.concatenate([t_b_plus, t_e_plus], axis=1)
+	indices = np.zeros(queries.shape, dtype=np.int64)
+	for idx in range(len(padded)):
+		if is_sorted[idx]:
+			indices[idx] = np.searchsorted(padded[idx], queries[idx], side='right')
+		else:
+			indices[idx] = [bisect_right(all_event_seqs[idx], t) for t in queries[idx]]
+	return indices[:, num_points:] - indices[:, :num_points]
+
 def compute_event_in_bin(data, count, appender=None, size=40):
 	count = tf.cast(count, tf.int32)
 	event_bag = list()
@@ -4953,16 +5857,8 @@ def clean_dict_for_na_model(all_run_fun_pdf, run_model_flags):
 #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%#
 
 def compute_count_metric(all_times_true, all_times_pred, t_b_plus, t_e_plus):
-	idx_tb = [bisect_right(t_out, t_b) for t_out, t_b in zip(all_times_pred, t_b_plus)]
-	idx_te = [bisect_right(t_out, t_e) for t_out, t_e in zip(all_times_pred, t_e_plus)]
-	all_counts_pred = [idx_te[idx] - idx_tb[idx] for idx in range(len(t_b_plus))]
-
-	idx_tb = [bisect_right(t_out, t_b) for t_out, t_b in zip(all_times_true, t_b_plus)]
-	idx_te = [bisect_right(t_out, t_e) for t_out, t_e in zip(all_times_true, t_e_plus)]
-	all_counts_true = [idx_te[idx] - idx_tb[idx] for idx in range(len(t_b_plus))]
-
-	all_counts_true = np.array(all_counts_true)
-	all_counts_pred = np.array(all_counts_pred)
+	all_counts_pred = np.array(count_events(all_times_pred, t_b_plus, t_e_plus))
+	all_counts_true = np.array(count_events(all_times_true, t_b_plus, t_e_plus))
 	count_mae_rh = np.mean(np.abs(all_counts_true - all_counts_pred))
 	count_mae_rh_pe = np.abs(all_counts_true - all_counts_pred)
 
@@ -5009,8 +5905,11 @@ def compute_full_horizon_metrics(
 	count_mae_fh_pe = np.mean(np.abs(all_counts_true - all_counts_pred), axis=1)
 	count_mae_fh_per_bin = np.mean(np.abs(all_counts_true - all_counts_pred), axis=0)
 
-	wass_dist_fh, wass_dist_fh_pe = compute_wasserstein_dist(
-		all_times_pred, all_times_true,
+	padded_times_pred = pad_event_seqs(all_times_pred)
+	padded_times_true = pad_event_seqs(all_times_true)
+
+	wass_dist_fh, wass_dist_fh_pe = compute_wasserstein_dist_padded(
+		padded_times_pred, padded_times_true,
 		count_test_out_binend[:, 0] - bin_size,
 		count_test_out_binend[:, -1],
 	)
@@ -5038,8 +5937,8 @@ def compute_full_horizon_metrics(
 		t_b_plus = count_test_out_binend[:, dec_idx] - bin_size
 		t_e_plus = count_test_out_binend[:, dec_idx]
 
-		wass_dist_fh_dec_idx, _ = compute_wasserstein_dist(
-			all_times_pred, all_times_true,
+		wass_dist_fh_dec_idx, _ = compute_wasserstein_dist_padded(
+			padded_times_pred, padded_times_true,
 			t_b_plus, t_e_plus,
 		)
 		wass_dist_fh_per_bin.append(wass_dist_fh_dec_idx)
@@ -5282,55 +6181,89 @@ def compute_hierarchical_mae(all_event_pred_uncut, query_data, all_event_true, c
 	)
 
 def compute_wasserstein_dist(all_event_pred, all_event_true, t_b_plus, t_e_plus):
-	idx_tb = [bisect_right(t_out, t_b) for t_out, t_b in zip(all_event_pred, t_b_plus)]
-	idx_te = [bisect_right(t_out, t_e) for t_out, t_e in zip(all_event_pred, t_e_plus)]
-	all_event_pred = [all_event_pred[idx][idx_tb[idx]:idx_te[idx]] for idx in range(len(t_b_plus))]
-
-	idx_tb = [bisect_right(t_out, t_b) for t_out, t_b in zip(all_event_true, t_b_plus)]
-	idx_te = [bisect_right(t_out, t_e) for t_out, t_e in zip(all_event_true, t_e_plus)]
-	all_event_true = [all_event_true[idx][idx_tb[idx]:idx_te[idx]] for idx in range(len(t_b_plus))]
-
-
-	def w_dist(true_ts, pred_ts, B, E):
-		true_ts = np.array(true_ts) * 1. / (E - B) # Normalize all times
-		pred_ts = np.array(pred_ts) * 1. / (E - B) # Normalize all times
-		E_norm = E * 1. / (E - B)
-		B_norm = B * 1. / (E - B)
-		min_len = min(len(true_ts), len(pred_ts))
-		dist = 0.
-		dist += np.sum(np.abs(true_ts[:min_len] - pred_ts[:min_len]))
-		if len(true_ts) > len(pred_ts):
-			leftover = true_ts[min_len:]
-		elif len(pred_ts) > len(true_ts):
-			leftover = pred_ts[min_len:]
-		else:
-			leftover = None
-	
-		if leftover is not None:
-			dist += np.sum(np.abs(E_norm - leftover))
-	
-		dist = np.sum(dist)
+	return compute_wasserstein_dist_padded(
+		pad_event_seqs(all_event_pred), pad_event_seqs(all_event_true),
+		t_b_plus, t_e_plus,
+	)
 
-		n = min_len
-		if leftover is not None:
-			n += len(leftover)
-	
-		return dist, n
-
-	dist_lst = []
-	n_lst = []
-	for true_ts, pred_ts, B, E in zip(all_event_true, all_event_pred, t_b_plus, t_e_plus):
-		dist, n = w_dist(
-			true_ts,
-			pred_ts,
-			B, E,
-		)
-		dist_lst.append(dist)
-		n_lst.append(n)
+def compute_wasserstein_dist_padded(padded_pred, padded_true, t_b_plus, t_e_plus):
+	'''
+		Wasserstein distance between the predicted and true events in
+		(t_b_plus, t_e_plus] for a whole batch of pad_event_seqs outputs.
+		Times are normalized by E-B, matched in order, and unmatched
+		events are charged their distance to E.
+	'''
+	if len(t_b_plus) == 0:
+		return np.sum([]), []
+
+	# Replay the per-example arithmetic on the first example to get the
+	# dtypes numpy would pick for it, so that the batched sums round the
+	# same way as a per-example evaluation.
+	B, E = t_b_plus[0], t_e_plus[0]
+	pred_dtype = (np.zeros(1, padded_pred[0].dtype) * 1. / (E - B)).dtype
+	true_dtype = (np.zeros(1, padded_true[0].dtype) * 1. / (E - B)).dtype
+	E_norm_dtype = np.asarray(E * 1. / (E - B)).dtype
+	E_norm_sample = np.asarray(E * 1. / (E - B))[()]
+	diff_dtype = np.result_type(pred_dtype, true_dtype)
+	pred_left_dtype = (E_norm_sample - np.zeros(1, pred_dtype)).dtype
+	true_left_dtype = (E_norm_sample - np.zeros(1, true_dtype)).dtype
+	dist_dtype = np.asarray(0. + diff_dtype.type(0)).dtype
+	pred_dist_dtype = np.asarray(dist_dtype.type(0) + pred_left_dtype.type(0)).dtype
+	true_dist_dtype = np.asarray(dist_dtype.type(0) + true_left_dtype.type(0)).dtype
+
+	# Boundaries come as (batch,) or (batch, 1)
+	t_b_plus = np.reshape(np.asarray(t_b_plus), (len(t_b_plus),))
+	t_e_plus = np.reshape(np.asarray(t_e_plus), (len(t_e_plus),))
+	pred_ts, pred_cnt = trim_padded_event_seqs(padded_pred, t_b_plus, t_e_plus)
+	true_ts, true_cnt = trim_padded_event_seqs(padded_true, t_b_plus, t_e_plus)
+
+	# Normalize all times
+	scale = (t_e_plus - t_b_plus)[:, None]
+	pred_ts = pred_ts.astype(pred_dtype) / scale.astype(pred_dtype)
+	true_ts = true_ts.astype(true_dtype) / scale.astype(true_dtype)
+	E_norm = (t_e_plus.astype(E_norm_dtype) * 1. / scale[:, 0].astype(E_norm_dtype))[:, None]
+
+	min_len = np.minimum(true_cnt, pred_cnt)
+	max_cnt = max(pred_ts.shape[1], true_ts.shape[1])
+	pred_ts = np.pad(pred_ts, ((0, 0), (0, max_cnt-pred_ts.shape[1])), 'constant')
+	true_ts = np.pad(true_ts, ((0, 0), (0, max_cnt-true_ts.shape[1])), 'constant')
+	matched_dist = segment_sums(
+		np.abs(true_ts.astype(diff_dtype) - pred_ts.astype(diff_dtype)),
+		min_len,
+	)
 
-	sum_dist = np.sum(dist_lst)
-	n = np.sum(n_lst)
-	avg_dist = sum_dist / n * 1.
+	# Leftover events of the longer sequence, shifted to the front
+	positions = np.minimum(min_len[:, None] + np.arange(max_cnt), max_cnt-1)
+	pred_left = np.abs(
+		E_norm.astype(pred_left_dtype)
+		- np.take_along_axis(pred_ts, positions, axis=1).astype(pred_left_dtype)
+	)
+	true_left = np.abs(
+		E_norm.astype(true_left_dtype)
+		- np.take_along_axis(true_ts, positions, axis=1).astype(true_left_dtype)
+	)
+	pred_left_dist = segment_sums(pred_left, np.maximum(pred_cnt-min_len, 0))
+	true_left_dist = segment_sums(true_left, np.maximum(true_cnt-min_len, 0))
+
+	has_pred_left = (pred_cnt > true_cnt)
+	has_true_left = (true_cnt > pred_cnt)
+	row_dtypes = [dist_dtype]
+	if has_pred_left.any():
+		row_dtypes.append(pred_dist_dtype)
+	if has_true_left.any():
+		row_dtypes.append(true_dist_dtype)
+	dist = matched_dist.astype(dist_dtype).astype(np.result_type(*row_dtypes))
+	dist[has_pred_left] = (
+		matched_dist[has_pred_left].astype(pred_dist_dtype)
+		+ pred_left_dist[has_pred_left].astype(pred_dist_dtype)
+	)
+	dist[has_true_left] = (
+		matched_dist[has_true_left].astype(true_dist_dtype)
+		+ true_left_dist[has_true_left].astype(true_dist_dtype)
+	)
+
+	sum_dist = np.sum(dist)
+	dist_lst = list(dist)
 
 	return sum_dist, dist_lst
 
@@ -5555,6 +6488,42 @@ def compute_threshold_loss(all_event_pred_uncut, query_data):
 #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%#
 # Interval pdf prediction loss
 # Query 2 and 3
+def tile_test_data(test_data, num_samples):
+	'''
+		Repeats every example of test_data num_samples times along the
+		batch axis, copies of an example are adjacent. Normalizers and
+		other non per-example entries are passed through.
+	'''
+	num_examples = len(test_data[0])
+	tiled_test_data = list()
+	for each in test_data:
+		if np.ndim(each) > 0 and len(each) == num_examples:
+			each = np.repeat(np.asarray(each), num_samples, axis=0)
+		tiled_test_data.append(each)
+	return tiled_test_data
+
+def sample_event_trajectories(run_fun, args, models, data, test_data, num_samples, **kwargs):
+	'''
+		Monte Carlo samples of the events predicted by run_fun.
+		All samples of all examples are simulated as one tiled batch, so
+		the encoder and the simulation loop run once instead of once per
+		sample. Returns the event times as an (examples x samples x events)
+		array padded with +inf.
+	'''
+	num_examples = len(test_data[0])
+	_, all_times_pred = run_fun(
+		args, models, data, tile_test_data(test_data, num_samples), **kwargs
+	)[:2]
+
+	# Some models return the events of an example per bin, concatenate
+	# them as the per-sample loop did
+	all_times_pred = [
+		np.array([t for each in seq for t in np.ravel(each).tolist()], dtype=np.float64)
+		for seq in all_times_pred
+	]
+	all_times_pred = pad_event_seqs(all_times_pred)[0]
+	return all_times_pred.reshape(num_examples, num_samples, -1)
+
 def compute_time_range_pdf(all_run_fun_pdf, model_data, query_data, dataset_name):
 	[arguments, models, data, test_data] = model_data
 	[interval_range_count_less, interval_range_count_more, less_threshold,
@@ -5578,21 +6547,14 @@ def compute_time_range_pdf(all_run_fun_pdf, model_data, query_data, dataset_name
 
 	x_range = np.round(np.array([(event_test_in_lasttime), (event_test_in_lasttime+(arguments.bin_size*arguments.out_bin_sz))]))[:,:,0].T.astype(int)
 
-	interval_counts_more_true = np.zeros((len(event_test_in_lasttime), no_points))
-	interval_counts_less_true = np.zeros((len(event_test_in_lasttime), no_points))
-
-	for batch_idx in range(len(event_test_in_lasttime)):
-		all_begins = np.linspace(x_range[batch_idx][0], x_range[batch_idx][1], no_points)
-		for begin_idx in range(len(all_begins)):
-			interval_start_cand = np.array([all_begins[begin_idx]])
-			interval_end_cand = np.array([all_begins[begin_idx] + interval_size])
-			interval_count_in_range_pred = count_events(np.expand_dims(np.array(event_test_out_times[batch_idx]), axis=0), 
-														interval_start_cand, interval_end_cand)
-			if more_threshold[batch_idx] <= interval_count_in_range_pred:
-				interval_counts_more_true[batch_idx][begin_idx]+=1.0
+	all_begins = np.linspace(x_range[:,0], x_range[:,1], no_points).T
+	all_ends = all_begins + interval_size
+	more_threshold = np.asarray(more_threshold)
+	less_threshold = np.asarray(less_threshold)
 
-			if less_threshold[batch_idx] >= interval_count_in_range_pred:
-				interval_counts_less_true[batch_idx][begin_idx]+=1.0
+	interval_counts_true = count_events_grid(pad_event_seqs(event_test_out_times), all_begins, all_ends)
+	interval_counts_more_true = (more_threshold[:, None] <= interval_counts_true).astype(np.float64)
+	interval_counts_less_true = (less_threshold[:, None] >= interval_counts_true).astype(np.float64)
 
 	# interval_counts_more_true = interval_counts_more_true / np.expand_dims(np.sum(interval_counts_more_true, axis=1), axis=-1)
 	# interval_counts_less_true = interval_counts_less_true / np.expand_dims(np.sum(interval_counts_less_true, axis=1), axis=-1)
@@ -5609,52 +6571,33 @@ def compute_time_range_pdf(all_run_fun_pdf, model_data, query_data, dataset_name
 		interval_counts_more_rank = np.zeros((len(event_test_in_lasttime), no_points))
 		interval_counts_less_rank = np.zeros((len(event_test_in_lasttime), no_points))
 
-		for each_sim_idx in range(sample_count):
-			# print('Simulating sample number', each_sim_idx)
-
-			if all_run_count_fun_name[run_count_fun_idx] == 'wgan_simu':
-				simul_end_time = x_range[:,1]
-				_, all_event_pred_uncut = all_run_count_fun[run_count_fun_idx](arguments, models, data, test_data, simul_end_time=simul_end_time)
-
-			elif (all_run_count_fun_name[run_count_fun_idx] == 'rmtpp_mse_simu' or \
-				 all_run_count_fun_name[run_count_fun_idx] == 'rmtpp_mse_var_simu' or \
-				 all_run_count_fun_name[run_count_fun_idx] == 'rmtpp_nll_simu'):
-
-				simul_end_time = x_range[:,1]
-				_, all_event_pred_uncut = all_run_count_fun[run_count_fun_idx](arguments, models, data, test_data,
-																				simul_end_time=simul_end_time, 
-																				rmtpp_type=all_run_count_fun_rmtpp[run_count_fun_idx])
+		run_fun_kwargs = dict()
+		if all_run_count_fun_rmtpp[run_count_fun_idx] is not None:
+			run_fun_kwargs['rmtpp_type'] = all_run_count_fun_rmtpp[run_count_fun_idx]
+		all_times_samples = sample_event_trajectories(
+			all_run_count_fun[run_count_fun_idx],
+			arguments, models, data, test_data,
+			sample_count, **run_fun_kwargs
+		)
 
-			else:
-				_, all_event_pred_uncut = all_run_count_fun[run_count_fun_idx](arguments, models, data, test_data, 
-																				rmtpp_type=all_run_count_fun_rmtpp[run_count_fun_idx])
-
-			all_times_pred = list()
-			for idx in range(len(all_event_pred_uncut)):
-				lst = list()
-				for each in all_event_pred_uncut[idx]:
-					lst = lst+each.tolist()
-				all_times_pred.append(lst)
-			all_times_pred = np.array(all_times_pred)
-
-			for batch_idx in range(len(all_times_pred)):
-				all_begins = np.linspace(x_range[batch_idx][0], x_range[batch_idx][1], no_points)
-				interval_position_more = 1.0
-				interval_position_less = 1.0
-				for begin_idx in range(len(all_begins)):
-					interval_start_cand = np.array([all_begins[begin_idx]])
-					interval_end_cand = np.array([all_begins[begin_idx] + interval_size])
-
-					interval_count_in_range_pred = count_events(all_times_pred[batch_idx:batch_idx+1], interval_start_cand, interval_end_cand)
-					if more_threshold[batch_idx] <= interval_count_in_range_pred:
-						interval_counts_more[batch_idx][begin_idx]+=1.0
-						interval_counts_more_rank[batch_idx][begin_idx]+=(1.0/interval_position_more)
-						interval_position_more += 1.0
-
-					if less_threshold[batch_idx] >= interval_count_in_range_pred:
-						interval_counts_less[batch_idx][begin_idx]+=1.0
-						interval_counts_less_rank[batch_idx][begin_idx]+=(1.0/interval_position_less)
-						interval_position_less += 1.0
+		num_examples = len(all_times_samples)
+		interval_counts_pred = count_events_grid(
+			pad_event_seqs(all_times_samples.reshape(num_examples*sample_count, -1)),
+			np.repeat(all_begins, sample_count, axis=0),
+			np.repeat(all_ends, sample_count, axis=0),
+		).reshape(num_examples, sample_count, no_points)
+
+		# The k-th interval of a sample that crosses the threshold adds 1/k
+		# to the rank counts
+		more_hits = (more_threshold[:, None, None] <= interval_counts_pred)
+		less_hits = (less_threshold[:, None, None] >= interval_counts_pred)
+		more_ranks = np.where(more_hits, 1.0 / np.maximum(np.cumsum(more_hits, axis=-1), 1), 0.)
+		less_ranks = np.where(less_hits, 1.0 / np.maximum(np.cumsum(less_hits, axis=-1), 1), 0.)
+		for each_sim_idx in range(sample_count):
+			interval_counts_more += more_hits[:, each_sim_idx]
+			interval_counts_less += less_hits[:, each_sim_idx]
+			interval_counts_more_rank += more_ranks[:, each_sim_idx]
+			interval_counts_less_rank += less_ranks[:, each_sim_idx]
 
 		more_results.append(interval_counts_more)
 		less_results.append(interval_counts_less)
@@ -5666,9 +6609,10 @@ def compute_time_range_pdf(all_run_fun_pdf, model_data, query_data, dataset_name
 	more_results_rank = np.array(more_results_rank)
 	less_results_rank = np.array(less_results_rank)
 
-	all_begins = np.linspace(x_range[:,0], x_range[:,1], no_points).T
 	crps_loss_more = -1*np.ones((len(all_run_count_fun)))
 	crps_loss_less = -1*np.ones((len(all_run_count_fun)))
+	crps_weights_more = np.zeros(more_results_rank.shape)
+	crps_weights_less = np.zeros(less_results_rank.shape)
 	cross_entropy_more = -1*np.ones((len(all_run_count_fun)))
 	cross_entropy_less = -1*np.ones((len(all_run_count_fun)))
 	for run_count_fun_idx in range(len(all_run_count_fun)):
@@ -5682,8 +6626,8 @@ def compute_time_range_pdf(all_run_fun_pdf, model_data, query_data, dataset_name
 		all_counts_sum_more = np.expand_dims(np.sum(more_results_rank[run_count_fun_idx], axis=1), axis=-1)
 		all_counts_sum_less = np.expand_dims(np.sum(less_results_rank[run_count_fun_idx], axis=1), axis=-1)
 
-		crps_loss_more[run_count_fun_idx] = np.mean(ps.crps_ensemble(interval_range_count_more, all_begins, weights=more_results_rank[run_count_fun_idx]/all_counts_sum_more))
-		crps_loss_less[run_count_fun_idx] = np.mean(ps.crps_ensemble(interval_range_count_less, all_begins, weights=less_results_rank[run_count_fun_idx]/all_counts_sum_more))
+		crps_weights_more[run_count_fun_idx] = more_results_rank[run_count_fun_idx]/all_counts_sum_more
+		crps_weights_less[run_count_fun_idx] = less_results_rank[run_count_fun_idx]/all_counts_sum_more
 
 		# Cross Entropy calculations
 		all_counts_sum_more = np.sum(more_results[run_count_fun_idx], axis=1)
@@ -5701,6 +6645,18 @@ def compute_time_range_pdf(all_run_fun_pdf, model_data, query_data, dataset_name
 		cross_entropy_less[run_count_fun_idx] = np.mean((interval_counts_less_true * (1.0 - less_results[run_count_fun_idx]/all_counts_sum_less)) +\
 												((1.0 - interval_counts_less_true) * less_results[run_count_fun_idx]/all_counts_sum_less))
 
+	# CRPS of all models in one call over (models x examples x points)
+	if len(all_run_count_fun) > 0:
+		crps_forecasts = np.broadcast_to(all_begins, crps_weights_more.shape)
+		crps_loss_more = np.mean(ps.crps_ensemble(
+			np.broadcast_to(interval_range_count_more, crps_weights_more.shape[:-1]),
+			crps_forecasts, weights=crps_weights_more,
+		), axis=-1)
+		crps_loss_less = np.mean(ps.crps_ensemble(
+			np.broadcast_to(interval_range_count_less, crps_weights_less.shape[:-1]),
+			crps_forecasts, weights=crps_weights_less,
+		), axis=-1)
+
 	print("CRPS for More")
 	for run_count_fun_idx in range(len(all_run_count_fun)):
 		print("Model", all_run_count_fun_name[run_count_fun_idx], ": Score =", crps_loss_more[run_count_fun_idx])
@@ -5844,12 +6800,11 @@ def run_model(dataset_name, model_name, dataset, args, results, prev_models=None
 		nc_event_train_out_gaps = dataset['nc_event_train_out_gaps'].astype(np.float32)
 		nc_event_train_out_feats = dataset['nc_event_train_out_feats'].astype(np.float32)
 		nc_event_train_out_types = dataset['nc_event_train_out_types']
-		train_dataset_gaps = tf.data.Dataset.from_tensor_slices(
+		train_dataset_gaps = build_train_dataset(
+			args,
 			(nc_event_train_in_gaps, nc_event_train_in_feats, nc_event_train_in_types,
-			 nc_event_train_out_gaps, nc_event_train_out_feats, nc_event_train_out_types)
-		).batch(
-			batch_size,
-			drop_remainder=True
+			 nc_event_train_out_gaps, nc_event_train_out_feats, nc_event_train_out_types),
+			batch_size
 		)
 		nc_event_dev_in_gaps = dataset['nc_event_dev_in_gaps']
 		nc_event_dev_in_feats = dataset['nc_event_dev_in_feats'].astype(np.float32)
@@ -5883,12 +6838,11 @@ def run_model(dataset_name, model_name, dataset, args, results, prev_models=None
 		nc_comp_train_out_gaps = dataset['nc_comp_train_out_gaps']
 		nc_comp_train_out_feats = dataset['nc_comp_train_out_feats'].astype(np.float32)
 		nc_comp_train_out_types = dataset['nc_comp_train_out_types']
-		train_dataset_gaps_comp = tf.data.Dataset.from_tensor_slices(
+		train_dataset_gaps_comp = build_train_dataset(
+			args,
 			(nc_comp_train_in_gaps, nc_comp_train_in_feats, nc_comp_train_in_types,
-			 nc_comp_train_out_gaps, nc_comp_train_out_feats, nc_comp_train_out_types)
-		).batch(
-			batch_size,
-			drop_remainder=True
+			 nc_comp_train_out_gaps, nc_comp_train_out_feats, nc_comp_train_out_types),
+			batch_size
 		)
 		nc_comp_dev_in_gaps = dataset['nc_comp_dev_in_gaps']
 		nc_comp_dev_in_feats = dataset['nc_comp_dev_in_feats']
@@ -6054,6 +7008,9 @@ def run_model(dataset_name, model_name, dataset, args, results, prev_models=None
 			print("")
 
 
+			# Solver telemetry records of the optimizer models of this dataset
+			dataset_solve_records = dict()
+
 			# ----- Start: Stale models, not updated according to latest code ----- #
 			if 'run_rmtpp_count_with_optimization' in run_model_flags and run_model_flags['run_rmtpp_count_with_optimization']:
 				print("Prediction for run_rmtpp_count_with_optimization model")
@@ -6087,7 +7044,15 @@ def run_model(dataset_name, model_name, dataset, args, results, prev_models=None
 
 			if 'run_rmtpp_with_optimization_fixed_cnt' in run_model_flags and run_model_flags['run_rmtpp_with_optimization_fixed_cnt']:
 				print("Prediction for run_rmtpp_with_optimization_fixed_cnt model")
-				_, all_times_pred = run_rmtpp_with_optimization_fixed_cnt(args, models, data, test_data)
+				_, all_times_pred, solve_records = run_rmtpp_with_optimization_fixed_cnt(args, models, data, test_data)
+				write_solver_telemetry_to_file(
+					os.path.join(
+						args.output_dir,
+						args.current_dataset + '__' + 'run_rmtpp_with_optimization_fixed_cnt',
+					),
+					solve_records,
+				)
+				dataset_solve_records['run_rmtpp_with_optimization_fixed_cnt'] = solve_records
 				(
 					deep_mae_rh,
 					count_mae_rh,
@@ -6177,6 +7142,8 @@ def run_model(dataset_name, model_name, dataset, args, results, prev_models=None
 				all_best_opt_nc_losses = 0.
 				all_best_cont_nc_losses = 0.
 				all_best_nc_count_losses = 0.
+				all_opt_search_stats = None
+				solve_records = None
 				if inference_model_name in \
 					['rmtpp_nll_opt', 'rmtpp_mse_opt',
 					 'rmtpp_mse_var_opt', 'rmtpp_mse_coopt',
@@ -6191,6 +7158,8 @@ def run_model(dataset_name, model_name, dataset, args, results, prev_models=None
 						all_best_opt_nc_losses,
 						all_best_cont_nc_losses,
 						all_best_nc_count_losses,
+						all_opt_search_stats,
+						solve_records,
 					) = run_rmtpp_optimizer_model(
 						args,
 						models,
@@ -6228,7 +7197,7 @@ def run_model(dataset_name, model_name, dataset, args, results, prev_models=None
 					test_data_out_gaps_bin_comp = None
 					(
 						all_times_pred, all_types_pred, all_counts_pred,
-						event_dist_params, count_dist_params,
+						event_dist_params, count_dist_params, solve_records,
 					) = run_rmtpp_optimizer_model_comp(
 						args,
 						models,
@@ -6474,7 +7443,17 @@ def run_model(dataset_name, model_name, dataset, args, results, prev_models=None
 					all_best_opt_nc_losses,
 					all_best_cont_nc_losses,
 					all_best_nc_count_losses,
+					opt_search_stats=all_opt_search_stats,
 				)
+				if solve_records is not None:
+					write_solver_telemetry_to_file(
+						os.path.join(
+							args.output_dir,
+							args.current_dataset + '__' + inference_model_name,
+						),
+						solve_records,
+					)
+					dataset_solve_records[inference_model_name] = solve_records
 				#threshold_mae = compute_threshold_loss(all_times_pred, query_2_data)
 				print("____________________________________________________________________")
 				print("")
@@ -6482,6 +7461,10 @@ def run_model(dataset_name, model_name, dataset, args, results, prev_models=None
 				# Save count_dist_params for bin-count plots
 				dist_params_dict[inference_model_name] = {'count_dist_params':count_dist_params}
 
+			if dataset_solve_records:
+				utils.write_solver_telemetry_summary(
+					args.output_dir, args.current_dataset, dataset_solve_records,
+				)
 
 			print("")
 
@@ -15,9 +15,9 @@ class EncoderLayer(tf.keras.Model):
         self.pos_ffn = PositionwiseFeedForward(
             d_model, d_inner, dropout=dropout, normalize_before=normalize_before)
 
-    def call(self, enc_input, feats, non_pad_mask=None, slf_attn_mask=None):
+    def call(self, enc_input, feats, non_pad_mask=None, slf_attn_mask=None, cache=None):
         enc_output, enc_slf_attn = self.slf_attn(
-            enc_input, enc_input, enc_input, mask=slf_attn_mask)
+            enc_input, enc_input, enc_input, mask=slf_attn_mask, cache=cache)
         non_pad_mask = tf.cast(tf.expand_dims(non_pad_mask, axis=-1), tf.float32)
 
         #enc_output = tf.concat([enc_output, feats], axis=-1)
@@ -22,7 +22,7 @@ class ScaledDotProductAttention(tf.keras.Model):
 
         if mask is not None:
             #attn = attn.masked_fill(mask, -1e9)
-            attn = tf.where(mask, attn, -1e9)
+            attn = tf.where(mask, -1e9, attn)
 
         attn = self.dropout(tf.nn.softmax(attn, axis=-1))
         #output = torch.matmul(attn, v)
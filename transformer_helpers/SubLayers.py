@@ -13,6 +13,14 @@ import tensorflow_probability as tfp
 import tensorflow_addons as tfa
 
 
+class AttentionCache(object):
+    """ Keys/values of the earlier steps, for incremental decoding. """
+
+    def __init__(self):
+        self.k = None
+        self.v = None
+
+
 class MultiHeadAttention(tf.keras.Model):
     """ Multi-Head Attention module """
 
@@ -44,7 +52,7 @@ class MultiHeadAttention(tf.keras.Model):
         #self.dropout = nn.Dropout(dropout)
         self.dropout = tf.keras.layers.Dropout(dropout)
 
-    def call(self, q, k, v, mask=None):
+    def call(self, q, k, v, mask=None, cache=None):
         d_k, d_v, n_head = self.d_k, self.d_v, self.n_head
         sz_b, len_q, len_k, len_v = q.shape[0], q.shape[1], k.shape[1], v.shape[1]
 
@@ -64,6 +72,13 @@ class MultiHeadAttention(tf.keras.Model):
         k = tf.transpose(k, perm=[0, 2, 1, 3])
         v = tf.transpose(v, perm=[0, 2, 1, 3])
 
+        # Incremental decoding: attend over the keys/values of earlier calls too.
+        if cache is not None:
+            if cache.k is not None:
+                k = tf.concat([cache.k, k], axis=2)
+                v = tf.concat([cache.v, v], axis=2)
+            cache.k, cache.v = k, v
+
         if mask is not None:
             mask = tf.expand_dims(mask, axis=1)  # For head axis broadcasting.
 
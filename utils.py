@@ -5,6 +5,15 @@ import matplotlib.pyplot as plt
 from bisect import bisect_right
 from modules import Hawkes as hk
 import time
+import hashlib
+import itertools
+import json
+import csv
+import glob
+import queue
+import subprocess
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from scipy.stats import entropy
 from collections import Counter
 
@@ -212,6 +221,7 @@ def write_opt_losses_to_file(
 	opt_losses,
 	cont_losses,
 	count_losses,
+	opt_search_stats=None,
 ):
 	np.save(
 		output_path + '__' + 'opt_losses',
@@ -225,6 +235,87 @@ def write_opt_losses_to_file(
 		output_path + '__' + 'count_losses',
 		count_losses,
 	)
+	# Per-example, per-bin counters of the optimizer search (e.g. memo hits)
+	if opt_search_stats is not None:
+		for stat_name, stat_val in opt_search_stats.items():
+			np.save(
+				output_path + '__' + 'opt_' + stat_name,
+				stat_val,
+			)
+
+# Columns of the solver telemetry records, the context columns added by the
+# optimizer models (batch_idx, dec_idx, count, ...) follow in sorted order
+SOLVE_RECORD_FIELDS = [
+	'solver', 'status', 'num_iters', 'scs_fallback',
+	'canon_time', 'solve_time', 'wall_time',
+]
+
+def get_solve_record_fields(solve_records):
+	context_fields = set()
+	for record in solve_records:
+		context_fields.update(record.keys())
+	context_fields = sorted(context_fields - set(SOLVE_RECORD_FIELDS))
+	return SOLVE_RECORD_FIELDS + context_fields
+
+def write_solver_telemetry_to_file(output_path, solve_records):
+	# One row per solve of the optimizer, next to the opt losses
+	with open(output_path + '__' + 'solver_telemetry.csv', 'w', newline='') as fp:
+		writer = csv.DictWriter(fp, fieldnames=get_solve_record_fields(solve_records))
+		writer.writeheader()
+		writer.writerows(solve_records)
+
+def write_solver_telemetry_summary(output_dir, dataset_name, model_solve_records):
+	'''
+	Per inference model summary of the solver telemetry of one dataset:
+	solves per solver/status, SCS fallbacks, iterations and a log-scale
+	histogram of the canonicalization and solve times.
+	'''
+	all_times = [
+		np.array([record[time_name] for record in solve_records
+				  if record[time_name] is not None], dtype=np.float64)
+		for solve_records in model_solve_records.values()
+		for time_name in ['canon_time', 'solve_time']
+	]
+	all_times = np.concatenate(all_times + [np.zeros(0)])
+	all_times = all_times[all_times > 0.]
+	if len(all_times) > 0:
+		time_bins = np.logspace(
+			np.floor(np.log10(np.min(all_times))),
+			np.ceil(np.log10(np.max(all_times))) + 1e-6,
+			num=11,
+		)
+	else:
+		time_bins = np.array([0., 1.])
+
+	summary_path = os.path.join(output_dir, dataset_name + '__' + 'solver_telemetry_summary.txt')
+	with open(summary_path, 'w') as fp:
+		for model_name, solve_records in model_solve_records.items():
+			fp.write('{}: {} solves\n'.format(model_name, len(solve_records)))
+			if len(solve_records) == 0:
+				continue
+			solver_status = Counter((record['solver'], record['status']) for record in solve_records)
+			for (solver, status), num_solves in sorted(solver_status.items(), key=str):
+				fp.write('  solver {} status {}: {}\n'.format(solver, status, num_solves))
+			fp.write('  scs fallbacks: {}\n'.format(
+				sum(bool(record['scs_fallback']) for record in solve_records)))
+			num_iters = np.array([record['num_iters'] for record in solve_records
+								  if record['num_iters'] is not None], dtype=np.float64)
+			if len(num_iters) > 0:
+				fp.write('  iterations: mean {:.2f} median {:.0f} max {:.0f}\n'.format(
+					np.mean(num_iters), np.median(num_iters), np.max(num_iters)))
+			for time_name in ['canon_time', 'solve_time', 'wall_time']:
+				times = np.array([record[time_name] for record in solve_records
+								  if record[time_name] is not None], dtype=np.float64)
+				fp.write('  {}: total {:.4f}s mean {:.6f}s\n'.format(
+					time_name, np.sum(times), np.mean(times) if len(times) > 0 else 0.))
+				if time_name in ['canon_time', 'solve_time']:
+					if np.any(times <= 0.):
+						fp.write('    0s {:6d}\n'.format(np.sum(times <= 0.)))
+					hist, _ = np.histogram(times[times > 0.], bins=time_bins)
+					for bin_lo, bin_hi, bin_count in zip(time_bins[:-1], time_bins[1:], hist):
+						fp.write('    [{:.1e}, {:.1e})s {:6d} {}\n'.format(
+							bin_lo, bin_hi, bin_count, '#' * int(np.ceil(50. * bin_count / max(np.max(hist), 1)))))
+	print('Solver telemetry summary written to', summary_path)
 
 def normal_approx(pb_mean, pb_var, threshold):
 	unit_normal_dist = tfd.Normal(loc=tf.zeros_like(pb_mean), scale=tf.ones_like(pb_mean))
@@ -265,6 +356,28 @@ def denormalize_avg(data, norm_a, norm_d):
 	return data*norm_d
 
 def get_bins(timestamps, binsize):
+	'''
+		Vectorized get_bins_loop for sorted timestamps. The event that
+		closes bin k is the first one after the event that closed bin k-1
+		and past the end of bin k, so its index is
+		k + max_{i<=k}(searchsorted(bin end i) - i).
+	'''
+	timestamps = np.asarray(timestamps)
+	num_events = len(timestamps)
+	if num_events == 0:
+		return np.array([])
+	num_bins = int(min(num_events, max(np.ceil(timestamps[-1]/binsize), 0) + 2))
+	bin_ends = np.cumsum(np.full(num_bins, binsize))
+	bin_ids = np.arange(num_bins)
+	close_ind = bin_ids + np.maximum.accumulate(
+		np.searchsorted(timestamps, bin_ends, side='right') - bin_ids
+	)
+	close_ind = close_ind[close_ind < num_events]
+	if len(close_ind) == 0:
+		return np.array([])
+	return np.diff(np.concatenate([[-1], close_ind])) - 1
+
+def get_bins_loop(timestamps, binsize):
    	cnt=0
    	bincounts=[]
    	t_b=0
@@ -410,6 +523,60 @@ def generate_plots(args, dataset_name, dataset, per_model_count, test_sample_idx
 def create_bin(times, types, bin_size, num_bins):
 	"""
 
+	Args:
+		times (list): A sequence of raw timestamps
+		bin_size (int): Length of the bin
+
+	Returns:
+		cnt_bin (list): Number of events in each bin
+		end_hr_bin (list): End time of each bin
+		bintotimes (list of lists): list of lists of timestamps in each bin
+	"""
+	times = np.asarray(times)
+	types = np.asarray(types)
+	num_bins = int(max(np.ceil(num_bins), 0))
+
+	end_hr_bin = np.cumsum(np.full(num_bins, bin_size))
+	# A bin ends at the first event past its end time, the running maximum
+	# keeps this true for unsorted times as in create_bin_loop.
+	last_ind = np.searchsorted(np.maximum.accumulate(times), end_hr_bin, side='right')
+	cnt_bin = np.diff(np.concatenate([[0], last_ind]))
+
+	all_gaps = np.concatenate([[0.], times[1:] - times[:-1]])
+	if num_bins > 0:
+		split_ind, end_ind = last_ind[:-1], last_ind[-1]
+	else:
+		split_ind, end_ind = [], 0
+	bintotimes = [list(seq) for seq in np.split(times[:end_ind], split_ind)][:num_bins]
+	bintogaps = [list(seq) for seq in np.split(all_gaps[:end_ind], split_ind)][:num_bins]
+	bintotypes = [list(seq) for seq in np.split(types[:end_ind], split_ind)][:num_bins]
+
+	cnt_bin, end_hr_bin = cnt_bin.tolist(), end_hr_bin.tolist()
+
+	print('Total bins generated', len(bintotimes))
+	print('Each bin has Average', int(round(np.mean(cnt_bin))), 'timestamps')
+	return cnt_bin, end_hr_bin, bintotimes, bintogaps, bintotypes
+
+def check_binning_equivalence(times, types, bin_size, num_bins):
+	'''
+		Compares create_bin and get_bins against their loop versions
+	'''
+	outputs = create_bin(times, types, bin_size, num_bins)
+	outputs_loop = create_bin_loop(times, types, bin_size, num_bins)
+	for name, out, out_loop in zip(
+		['counts', 'bin ends', 'times', 'gaps', 'types'], outputs, outputs_loop
+	):
+		if len(out) != len(out_loop) or any(
+			not np.array_equal(np.asarray(a), np.asarray(b)) for a, b in zip(out, out_loop)
+		):
+			assert False, "create_bin "+name+" differ from create_bin_loop"
+	if not np.array_equal(get_bins(times, bin_size), get_bins_loop(times, bin_size)):
+		assert False, "get_bins differs from get_bins_loop"
+	print('create_bin and get_bins match their loop versions')
+
+def create_bin_loop(times, types, bin_size, num_bins):
+	"""
+
 	Args:
 		times (list): A sequence of raw timestamps
 		bin_size (int): Length of the bin
@@ -503,8 +670,43 @@ def get_data_in_next_n_bins(n, inp, out, bin_size):
 		out_n_bins.append(out[i])
 	return out_n_bins
 
+def get_strided_windows(data, start, win_len, num_wins, stride):
+	'''
+		Read-only view of num_wins windows of win_len elements of data,
+		the i-th one starting at start+i*stride. Nothing is copied, so the
+		windows are not writeable; copy them before mutating.
+	'''
+	data = data[start:]
+	return np.lib.stride_tricks.as_strided(
+		data,
+		shape=(num_wins, win_len) + data.shape[1:],
+		strides=(stride*data.strides[0],) + data.strides,
+		writeable=False,
+	)
+
+def get_regular_array(data):
+	'''
+		data as a numeric ndarray, None if it is ragged.
+	'''
+	try:
+		data_arr = np.asarray(data)
+	except ValueError:
+		return None
+	if data_arr.dtype == object or data_arr.ndim == 0:
+		return None
+	return data_arr
+
 def create_nowcast_io_seqs(data, chunk_len, stride):
 
+	data_arr = get_regular_array(data)
+	if data_arr is not None:
+		num_wins = len(range(0, max(0, len(data_arr)-chunk_len), stride))
+		if num_wins == 0:
+			return np.array([]), np.array([])
+		data_in = get_strided_windows(data_arr, 0, chunk_len, num_wins, stride)
+		data_out = get_strided_windows(data_arr, 1, chunk_len, num_wins, stride)
+		return data_in, data_out
+
 	data_in, data_out = [], []
 	for idx in range(0, len(data), stride):
 		if idx+chunk_len < len(data):
@@ -517,6 +719,15 @@ def create_nowcast_io_seqs(data, chunk_len, stride):
 
 def create_forecast_io_seqs(data, enc_len, dec_len, stride):
 
+	data_arr = get_regular_array(data)
+	if data_arr is not None:
+		num_wins = len(range(0, max(0, len(data_arr)-enc_len-dec_len), stride))
+		if num_wins == 0:
+			return np.array([]), np.array([])
+		data_in = get_strided_windows(data_arr, 0, enc_len, num_wins, stride)
+		data_out = get_strided_windows(data_arr, enc_len, dec_len, num_wins, stride)
+		return data_in, data_out
+
 	data_in, data_out = [], []
 	for idx in range(0, len(data), stride):
 		if idx+enc_len+dec_len < len(data):
@@ -792,30 +1003,69 @@ def get_rand_interval_count(event_test_out_times):
 	return test_time_out_tb_plus, test_time_out_te_plus, test_out_event_count_true, test_out_all_event_true
 
 def get_interval_count_more_than_threshold(times_out, interval_size, threshold):
+	'''
+		For each sequence, the start of the first interval of interval_size
+		that ends at an event and holds more than threshold events, -1 if
+		there is none.
+	'''
 	threshold = threshold.astype(int)
 	interval_range_count_more = np.ones(len(times_out)) * -1
 	for batch_idx in range(len(times_out)):
+		times = np.asarray(times_out[batch_idx])
 		events_count = threshold[batch_idx]
-		for idx in range(events_count, len(times_out[batch_idx]), 1):
-			if (times_out[batch_idx][idx]-interval_size <= times_out[batch_idx][idx-events_count]):
-				interval_range_count_more[batch_idx] = \
-					max(times_out[batch_idx][idx]-interval_size, times_out[batch_idx][0])
-				break
+		if events_count >= len(times):
+			continue
+		# times[idx]-interval_size <= times[idx-events_count] for idx >= events_count
+		found = (times[events_count:]-interval_size <= times[:len(times)-events_count])
+		if np.any(found):
+			idx = events_count + np.argmax(found)
+			interval_range_count_more[batch_idx] = max(times[idx]-interval_size, times[0])
 
 	return interval_range_count_more
 
 def get_interval_count_less_than_threshold(times_out, interval_size, threshold):
+	'''
+		For each sequence, the first event starting an interval of
+		interval_size that holds fewer than threshold events, -1 if there
+		is none.
+	'''
 	threshold = threshold.astype(int)
 	interval_range_count_less = np.ones(len(times_out)) * -1
 	for batch_idx in range(len(times_out)):
+		times = np.asarray(times_out[batch_idx])
 		events_count = threshold[batch_idx]
-		for idx in range(len(times_out[batch_idx])-events_count):
-			if (times_out[batch_idx][idx]+interval_size <= times_out[batch_idx][idx+events_count]):
-				interval_range_count_less[batch_idx] = times_out[batch_idx][idx]
-				break
+		if events_count >= len(times):
+			continue
+		# times[idx]+interval_size <= times[idx+events_count] for idx < len-events_count
+		found = (times[:len(times)-events_count]+interval_size <= times[events_count:])
+		if np.any(found):
+			interval_range_count_less[batch_idx] = times[np.argmax(found)]
 
 	return interval_range_count_less
 
+def get_interval_threshold_bounds(times_out, interval_size):
+	'''
+		Per sorted sequence, the largest threshold for which
+		get_interval_count_more_than_threshold finds an interval and the
+		smallest one for which get_interval_count_less_than_threshold
+		does (np.inf if none). Both are found from the event counts of the
+		intervals of interval_size starting/ending at every event.
+	'''
+	max_more_thresh = np.zeros(len(times_out))
+	min_less_thresh = np.ones(len(times_out)) * np.inf
+	for batch_idx in range(len(times_out)):
+		times = np.asarray(times_out[batch_idx])
+		idxs = np.arange(len(times))
+		# Events in the interval ending at each event
+		more_counts = idxs - np.searchsorted(times, times-interval_size, side='left')
+		max_more_thresh[batch_idx] = np.max(more_counts)
+		# Events from each event to the first one at least interval_size later
+		less_ends = np.searchsorted(times, times+interval_size, side='left')
+		less_counts = (less_ends - idxs)[less_ends < len(times)]
+		if len(less_counts) > 0:
+			min_less_thresh[batch_idx] = np.min(less_counts)
+	return max_more_thresh, min_less_thresh
+
 def get_interval_count_with_threshold(event_test_out_times, interval_size, dataset_name, threshold=None):
 	test_sample_count = len(event_test_out_times)
 
@@ -824,31 +1074,54 @@ def get_interval_count_with_threshold(event_test_out_times, interval_size, datas
 		interval_range_count_less = None
 		more_thresh = 1
 		less_thresh = 1
-		for thresh in range(1, len(event_test_out_times)):
-			threshold = np.ones(test_sample_count) * thresh
-			threshold = threshold.astype(int)
-			interval_range_count_more_tmp \
-				= get_interval_count_more_than_threshold(event_test_out_times,
-														 interval_size,
-														 threshold)
-			if np.any(interval_range_count_more_tmp == -1):
-				break
-
-			interval_range_count_more = interval_range_count_more_tmp
-			more_thresh = thresh
-
-		for thresh in range(len(event_test_out_times), 1, -1):
-			threshold = np.ones(test_sample_count) * thresh
-			threshold = threshold.astype(int)
-			interval_range_count_less_tmp \
-				= get_interval_count_less_than_threshold(event_test_out_times,
-														 interval_size,
-														 threshold)
-			if np.any(interval_range_count_less_tmp == -1):
-				break
-
-			interval_range_count_less = interval_range_count_less_tmp
-			less_thresh = thresh
+		if all(np.all(np.diff(times) >= 0) for times in event_test_out_times):
+			# Both queries succeed on a contiguous range of thresholds, so the
+			# sweeps below reduce to the bounds over all the sequences
+			max_more_thresh, min_less_thresh \
+				= get_interval_threshold_bounds(event_test_out_times, interval_size)
+			max_less_thresh = min(len(times)-1 for times in event_test_out_times)
+
+			last_more_thresh = min(np.min(max_more_thresh), test_sample_count-1)
+			if last_more_thresh >= 1:
+				more_thresh = int(last_more_thresh)
+				interval_range_count_more \
+					= get_interval_count_more_than_threshold(event_test_out_times,
+															 interval_size,
+															 np.ones(test_sample_count) * more_thresh)
+
+			last_less_thresh = max(np.max(min_less_thresh), 2)
+			if test_sample_count >= last_less_thresh and test_sample_count <= max_less_thresh:
+				less_thresh = int(last_less_thresh)
+				interval_range_count_less \
+					= get_interval_count_less_than_threshold(event_test_out_times,
+															 interval_size,
+															 np.ones(test_sample_count) * less_thresh)
+		else:
+			for thresh in range(1, len(event_test_out_times)):
+				threshold = np.ones(test_sample_count) * thresh
+				threshold = threshold.astype(int)
+				interval_range_count_more_tmp \
+					= get_interval_count_more_than_threshold(event_test_out_times,
+															 interval_size,
+															 threshold)
+				if np.any(interval_range_count_more_tmp == -1):
+					break
+
+				interval_range_count_more = interval_range_count_more_tmp
+				more_thresh = thresh
+
+			for thresh in range(len(event_test_out_times), 1, -1):
+				threshold = np.ones(test_sample_count) * thresh
+				threshold = threshold.astype(int)
+				interval_range_count_less_tmp \
+					= get_interval_count_less_than_threshold(event_test_out_times,
+															 interval_size,
+															 threshold)
+				if np.any(interval_range_count_less_tmp == -1):
+					break
+
+				interval_range_count_less = interval_range_count_less_tmp
+				less_thresh = thresh
 
 		less_thresh = np.ones(test_sample_count) * less_thresh
 		more_thresh = np.ones(test_sample_count) * more_thresh
@@ -962,7 +1235,79 @@ def get_num_bins(timestamps, bin_size):
 	return num_bins
 
 
+# Arguments that change the output of build_processed_data
+PROCESSED_DATA_ARGS = [
+	'bin_size', 'in_bin_sz', 'out_bin_sz', 'enc_len', 'batch_size',
+	'comp_enc_len', 'comp_bin_sz', 'stride_len', 'interval_size',
+]
+
+def get_processed_data_cache_path(dataset_name, args):
+	'''
+		Content-addressed cache file of build_processed_data. The key hashes
+		the data files, the preprocessing args, the source of this module
+		and the numpy random state, which preprocessing draws from.
+	'''
+	key = hashlib.sha256()
+	key.update(dataset_name.encode())
+	for file_name in ['data/'+dataset_name+'.txt', 'data/'+dataset_name+'_types.txt']:
+		if os.path.isfile(file_name):
+			with open(file_name, 'rb') as f:
+				key.update(hashlib.sha256(f.read()).digest())
+	for arg_name in PROCESSED_DATA_ARGS:
+		key.update((arg_name+'='+repr(getattr(args, arg_name))).encode())
+	with open(os.path.abspath(__file__), 'rb') as f:
+		key.update(hashlib.sha256(f.read()).digest())
+	rng_state = np.random.get_state()
+	key.update(rng_state[1].tobytes())
+	key.update(repr(rng_state[2:]).encode())
+	return os.path.join(args.data_cache_dir, dataset_name+'_'+key.hexdigest()[:32]+'.npz')
+
 def get_processed_data(dataset_name, args):
+	'''
+		build_processed_data with an on-disk cache, see --data_cache.
+		A cache hit also restores args.num_types, args.comp_bin_sz and the
+		numpy random state left by the preprocessing.
+	'''
+	if args.data_cache == 'bypass':
+		return build_processed_data(dataset_name, args)
+
+	cache_path = get_processed_data_cache_path(dataset_name, args)
+	if args.data_cache == 'use' and not args.check_binning and os.path.isfile(cache_path):
+		print('Loading processed', dataset_name, 'data from', cache_path)
+		with np.load(cache_path, allow_pickle=True) as cache:
+			dataset = dict()
+			for name in cache.files:
+				value = cache[name]
+				if value.dtype == object and value.ndim == 0:
+					value = value.item()
+				dataset[name] = value
+		args.num_types = dataset.pop('__num_types')
+		args.comp_bin_sz = dataset.pop('__comp_bin_sz')
+		np.random.set_state(dataset.pop('__rng_state'))
+		return dataset
+
+	dataset = build_processed_data(dataset_name, args)
+
+	cache = dict()
+	for name, value in list(dataset.items()) + [
+		('__num_types', args.num_types),
+		('__comp_bin_sz', args.comp_bin_sz),
+		('__rng_state', np.random.get_state()),
+	]:
+		if not isinstance(value, np.ndarray):
+			wrapped = np.empty((), dtype=object)
+			wrapped[()] = value
+			value = wrapped
+		cache[name] = value
+	os.makedirs(args.data_cache_dir, exist_ok=True)
+	tmp_path = cache_path + '.' + str(os.getpid()) + '.tmp'
+	with open(tmp_path, 'wb') as f:
+		np.savez(f, **cache)
+	os.replace(tmp_path, cache_path)
+	print('Saved processed', dataset_name, 'data to', cache_path)
+	return dataset
+
+def build_processed_data(dataset_name, args):
 
 	bin_size = args.bin_size
 	in_bin_sz = args.in_bin_sz
@@ -985,6 +1330,8 @@ def get_processed_data(dataset_name, args):
 	args.num_types = len(np.unique(types))
 	types, _ = reset_indices(types) # Make sure type-indieces are in the range [Y]
 	num_bins = get_num_bins(timestamps, bin_size)
+	if args.check_binning:
+		check_binning_equivalence(timestamps, types, bin_size, num_bins)
 	count_counts, count_binend, bintotimes, bintogaps, bintotypes = create_bin(timestamps, types, bin_size, num_bins)
 
 	args.comp_bin_sz = set_comp_bin_sz(count_counts)
@@ -1002,6 +1349,8 @@ def get_processed_data(dataset_name, args):
 	gaps_comp = timestamps_comp[1:] - timestamps_comp[:-1]
 	gaps_comp = gaps_comp.astype(np.float32)
 	types_comp = np.ones_like(types)
+	if args.check_binning:
+		check_binning_equivalence(timestamps_comp, types_comp, bin_size, num_bins)
 	_, _, bintotimes_comp, bintogaps_comp, bintotypes_comp = create_bin(timestamps_comp, types_comp, bin_size, num_bins)
 
 
@@ -1125,8 +1474,10 @@ def get_processed_data(dataset_name, args):
 		count_test_binend, args.in_bin_sz, args.out_bin_sz, args.out_bin_sz,
 	)
 
+	# The windows are strided views, mean and std are taken over a
+	# contiguous copy to keep their summation order
 	count_train_in_counts, count_train_normm, count_train_norms \
-		= normalize_data(count_train_in_counts)
+		= normalize_data(np.ascontiguousarray(count_train_in_counts))
 	count_train_out_counts = normalize_data_given_param(count_train_out_counts,
 													count_train_normm,
 													count_train_norms)
@@ -1195,7 +1546,7 @@ def get_processed_data(dataset_name, args):
 	event_test_in_lasttime = np.array([seq[-1] for seq in event_test_in_times])
 
 	nc_event_train_in_gaps, event_train_norma, event_train_normd \
-		= normalize_avg(nc_event_train_in_gaps)
+		= normalize_avg(np.ascontiguousarray(nc_event_train_in_gaps))
 	nc_event_train_out_gaps = normalize_avg_given_param(
 		nc_event_train_out_gaps, event_train_norma, event_train_normd
 	)
@@ -1253,7 +1604,7 @@ def get_processed_data(dataset_name, args):
 
 
 	nc_comp_train_in_gaps, comp_train_norma, comp_train_normd \
-		= normalize_avg(nc_comp_train_in_gaps)
+		= normalize_avg(np.ascontiguousarray(nc_comp_train_in_gaps))
 	nc_comp_train_out_gaps = normalize_avg_given_param(
 		nc_comp_train_out_gaps, comp_train_norma, comp_train_normd
 	)
@@ -1474,3 +1825,128 @@ def get_processed_data(dataset_name, args):
 	}
 
 	return dataset
+
+HPARAM_GRID_ARGS = [
+	('learning_rate', 'lr'),
+	('hidden_layer_size', 'hls'),
+	('embed_size', 'embds'),
+	('enc_len', 'enc'),
+	('bin_size', 'bin'),
+]
+
+def get_hparam_grid(args):
+	'''
+		All combinations of the values given to the HPARAM_GRID_ARGS,
+		one dict of arg_name: value per configuration.
+	'''
+	grid_values = list()
+	for arg_name, _ in HPARAM_GRID_ARGS:
+		arg_val = getattr(args, arg_name)
+		grid_values.append(arg_val if isinstance(arg_val, list) else [arg_val])
+	arg_names = [arg_name for arg_name, _ in HPARAM_GRID_ARGS]
+	return [dict(zip(arg_names, config)) for config in itertools.product(*grid_values)]
+
+def get_hparam_config_name(hparams):
+	return '_'.join(
+		short_name+str(hparams[arg_name]) for arg_name, short_name in HPARAM_GRID_ARGS
+	)
+
+def run_hparam_grid(args, hparam_grid):
+	'''
+		Runs main.py once per configuration of hparam_grid, each in its own
+		process pinned to its share of the CPUs and with its own output_dir
+		and saved_models. The results files of all the runs are merged into
+		hparam_results.json and hparam_results.txt in args.output_dir.
+	'''
+	if args.parallel_hparam:
+		num_workers = args.hparam_workers if args.hparam_workers > 0 else multiprocessing.cpu_count()
+	else:
+		num_workers = 1
+	num_workers = min(num_workers, len(hparam_grid))
+
+	if hasattr(os, 'sched_getaffinity'):
+		cpus = sorted(os.sched_getaffinity(0))
+	else:
+		cpus = list(range(multiprocessing.cpu_count()))
+	cpu_share = max(1, len(cpus) // num_workers)
+	free_cpus = queue.Queue()
+	for worker_idx in range(num_workers):
+		if len(cpus) >= num_workers:
+			free_cpus.put(cpus[worker_idx*cpu_share:(worker_idx+1)*cpu_share])
+		else:
+			free_cpus.put([cpus[worker_idx % len(cpus)]])
+
+	def get_config_dirs(hparams):
+		config_name = get_hparam_config_name(hparams)
+		return (
+			config_name,
+			os.path.join(args.output_dir, 'hparam', config_name),
+			os.path.join(args.saved_models, 'hparam', config_name),
+		)
+
+	def run_config(hparams):
+		config_name, config_output_dir, config_saved_models = get_config_dirs(hparams)
+		os.makedirs(config_output_dir, exist_ok=True)
+
+		# argparse keeps the last value of an option, so the overrides are
+		# appended to the original command line
+		cmd = [sys.executable] + sys.argv
+		cmd += ['--output_dir', config_output_dir, '--saved_models', config_saved_models]
+		for arg_name, arg_val in hparams.items():
+			cmd += ['--'+arg_name, str(arg_val)]
+
+		worker_cpus = free_cpus.get()
+		env = dict(os.environ)
+		env['TF_NUM_INTRAOP_THREADS'] = str(len(worker_cpus))
+		env['TF_NUM_INTEROP_THREADS'] = str(min(2, len(worker_cpus)))
+		env['OMP_NUM_THREADS'] = str(len(worker_cpus))
+		preexec_fn = None
+		if hasattr(os, 'sched_setaffinity'):
+			preexec_fn = lambda: os.sched_setaffinity(0, worker_cpus)
+		print('Running hyperparameters', config_name, 'on CPUs', worker_cpus)
+		try:
+			with open(os.path.join(config_output_dir, 'log.txt'), 'w') as log_fp:
+				returncode = subprocess.call(cmd, stdout=log_fp, stderr=subprocess.STDOUT,
+											 env=env, preexec_fn=preexec_fn)
+		finally:
+			free_cpus.put(worker_cpus)
+		print('Finished hyperparameters', config_name, 'with return code', returncode)
+		return returncode
+
+	# The work happens in the child processes, threads are enough to wait on them
+	pool = ThreadPool(num_workers)
+	returncodes = pool.map(run_config, hparam_grid)
+	pool.close()
+	pool.join()
+
+	summary = dict()
+	for hparams, returncode in zip(hparam_grid, returncodes):
+		config_name, config_output_dir, _ = get_config_dirs(hparams)
+		config_results = dict()
+		for results_path in sorted(glob.glob(os.path.join(config_output_dir, 'results_*.json'))):
+			with open(results_path) as fp:
+				config_results[os.path.basename(results_path)[len('results_'):-len('.json')]] = json.load(fp)
+		summary[config_name] = {
+			'hparams': hparams,
+			'returncode': returncode,
+			'results': config_results,
+		}
+
+	with open(os.path.join(args.output_dir, 'hparam_results.json'), 'w') as fp:
+		json.dump(summary, fp, indent=4)
+	with open(os.path.join(args.output_dir, 'hparam_results.txt'), 'w') as fp:
+		fp.write('Hyperparameters & Dataset & Model Name & Count MAE & Wass Dist')
+		for config_name, config_summary in summary.items():
+			if config_summary['returncode'] != 0:
+				fp.write('\n {} failed with return code {}, see {}'.format(
+					config_name, config_summary['returncode'],
+					os.path.join(get_config_dirs(config_summary['hparams'])[1], 'log.txt')))
+			for dataset_name, results in config_summary['results'].items():
+				for model_name, metrics_dict in results.items():
+					fp.write('\n {} & {} & {} & {} & {} \\\\'.format(
+						config_name, dataset_name, model_name,
+						metrics_dict.get('count_mae_fh'), metrics_dict.get('wass_dist_fh')))
+		fp.write('\n')
+	print('Merged hyperparameter results in', os.path.join(args.output_dir, 'hparam_results.txt'))
+
+	return returncodes